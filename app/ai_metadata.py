@@ -1,11 +1,7 @@
-import os, json, base64
-from typing import Dict, Any, List, Optional
+import os, json, base64, hashlib
+from typing import Dict, Any, Callable, List, Optional, Sequence, Union
 from .schema import LOC15_SCHEMA, MAX_OCR_CHARS, MAX_OUTPUT_TOKENS, DEFAULT_MODEL
-
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
+from .metrics import usage_fields
 
 SYSTEM_INSTRUCTIONS = (
     "You are a meticulous academic-library cataloger and metadata specialist. "
@@ -56,38 +52,85 @@ USER_FIELD_RULES = (
     "• field_confidence: 0–100 integers for each populated field; 0 if null\n"
 )
 
-def _get_client() -> OpenAI:
-    if OpenAI is None:
+def prompt_version() -> str:
+    """Short hash of the prompts and schema; cached model responses are only reused when it matches."""
+    h = hashlib.sha256()
+    for part in (SYSTEM_INSTRUCTIONS, USER_FIELD_RULES, json.dumps(LOC15_SCHEMA, sort_keys=True)):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()[:16]
+
+_client_factory: Optional[Callable[[], Any]] = None
+
+def set_client_factory(factory: Optional[Callable[[], Any]]) -> None:
+    """Route all model calls through factory() instead of the default OpenAI() client (e.g. a local stand-in).
+
+    The default client also honours OPENAI_BASE_URL, which is enough to point it at a compatible server.
+    """
+    global _client_factory
+    _client_factory = factory
+
+def _get_client() -> Any:
+    if _client_factory is not None:
+        return _client_factory()
+    try:
+        from openai import OpenAI  # imported on first use: the SDK takes about a second to load
+    except Exception:
         raise RuntimeError("openai not installed. pip install openai")
     if not os.getenv("OPENAI_API_KEY"):
         raise RuntimeError("OPENAI_API_KEY not set")
-    return OpenAI()
+    # Retries and backoff are handled by ratelimit.call_with_retries, which needs to see every 429.
+    return OpenAI(max_retries=0)
+
+def _sniff_mime(img_bytes: bytes) -> str:
+    if img_bytes[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if img_bytes[:4] == b"RIFF" and img_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
 
 def _image_to_data_url(img_bytes: bytes) -> str:
     b64 = base64.b64encode(img_bytes).decode("utf-8")
-    return f"data:image/png;base64,{b64}"
+    return f"data:{_sniff_mime(img_bytes)};base64,{b64}"
+
+# Several images are the pages of one object (recto/verso or numbered pages, see grouping.py).
+Images = Union[bytes, Sequence[bytes]]
 
-def transcribe_with_model(img_bytes: bytes, max_chars: int = MAX_OCR_CHARS, model: str = DEFAULT_MODEL) -> str:
+def _image_parts(img_bytes: Images) -> List[Dict[str, Any]]:
+    images = [img_bytes] if isinstance(img_bytes, bytes) else list(img_bytes)
+    return [{"type": "image_url", "image_url": {"url": _image_to_data_url(b)}} for b in images]
+
+def transcribe_with_model(img_bytes: Images, max_chars: int = MAX_OCR_CHARS, model: str = DEFAULT_MODEL, usage: Optional[Dict[str, int]] = None) -> str:
+    """usage, when given, receives the call's prompt/completion/cached token counts."""
     client = _get_client()
-    data_url = _image_to_data_url(img_bytes)
+    parts = _image_parts(img_bytes)
+    instruction = "Transcribe ALL visible text. Preserve line breaks; prefix clearly handwritten lines with '[handwritten] '. Use '[illegible]'/'[unclear]' for unreadable parts. Return PLAIN TEXT only."
+    if len(parts) > 1:
+        instruction += " The images are the pages of one item, in order; start each page with '[page N]'."
     resp = client.chat.completions.create(
         model=model,
         messages=[{
             "role": "user",
-            "content": [
-                {"type": "text", "text": "Transcribe ALL visible text. Preserve line breaks; prefix clearly handwritten lines with '[handwritten] '. Use '[illegible]'/'[unclear]' for unreadable parts. Return PLAIN TEXT only."},
-                {"type": "image_url", "image_url": {"url": data_url}},
-            ],
+            "content": [{"type": "text", "text": instruction}] + parts,
         }],
         temperature=0,
         max_tokens=900,
     )
+    if usage is not None:
+        usage.update(usage_fields(resp))
     text = (resp.choices[0].message.content or "").strip()
     return text[:max_chars]
 
-def extract_metadata(img_bytes: bytes, ocr_text: str, filename: str, model: str = DEFAULT_MODEL, known_collection: str = "", known_repository: str = "", known_permalink: str = "") -> Dict[str, Any]:
-    client = _get_client()
-    data_url = _image_to_data_url(img_bytes)
+def metadata_request(img_bytes: Images, ocr_text: str, filename: str, model: str = DEFAULT_MODEL, known_collection: str = "", known_repository: str = "", known_permalink: str = "",
+                     ocr_reliable: bool = True) -> Dict[str, Any]:
+    """Keyword arguments for chat.completions.create; also used verbatim as the body of batch requests.
+
+    img_bytes may be a list of page images of one object, described together as a single item.
+    With ocr_reliable=False the model is told to transcribe from the image rather than trust the OCR text.
+    The system prompt and field rules come first and never vary, so the provider can cache that prefix;
+    everything per-file follows them.
+    """
+    images = _image_parts(img_bytes)
     ocr_text = (ocr_text or "").strip()[:MAX_OCR_CHARS]
 
     hints = []
@@ -95,39 +138,63 @@ def extract_metadata(img_bytes: bytes, ocr_text: str, filename: str, model: str
     if known_repository: hints.append(f"default.repository={known_repository}")
     if known_permalink:  hints.append(f"default.permalink={known_permalink}")
 
-    content: List[Dict[str, Any]] = [
-        {"type": "text", "text": f"FILENAME: {filename}\n\n{USER_FIELD_RULES}"},
-        {"type": "image_url", "image_url": {"url": data_url}},
-        {"type": "text", "text": f"OCR TEXT:\n{ocr_text if ocr_text else '(none)'}"}
-    ]
+    content: List[Dict[str, Any]] = [{"type": "text", "text": USER_FIELD_RULES}, {"type": "text", "text": f"FILENAME: {filename}"}]
+    if len(images) > 1:
+        content.append({"type": "text", "text": f"PAGES: the {len(images)} images below are the sides/pages of ONE item, in file order. "
+                                                 "Describe the item once; transcribe every page, marking each with [page N]."})
+    content += images
+    label = "OCR TEXT" if ocr_reliable else "OCR TEXT (unreliable; transcribe from the image for transcript and text_reading)"
+    content.append({"type": "text", "text": f"{label}:\n{ocr_text if ocr_text else '(none)'}"})
     if hints:
         content.append({"type": "text", "text": "HINTS:\n" + "\n".join(hints)})
 
-    try:
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "system", "content": SYSTEM_INSTRUCTIONS},
-                      {"role": "user", "content": content}],
-            response_format={
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "loc15_metadata",
-                    "schema": LOC15_SCHEMA,
-                    "strict": True,
-                },
+    return {
+        "model": model,
+        "messages": [{"role": "system", "content": SYSTEM_INSTRUCTIONS},
+                     {"role": "user", "content": content}],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "loc15_metadata",
+                "schema": LOC15_SCHEMA,
+                "strict": True,
             },
-            max_tokens=MAX_OUTPUT_TOKENS,
-        )
-        raw = resp.choices[0].message.content or "{}"
-        try:
-            parsed = json.loads(raw)
-            if not parsed or len(parsed) == 0:
-                print(f"WARNING: API returned empty metadata for {filename}. Raw response: {raw[:200]}")
-            return parsed
-        except Exception as parse_err:
-            print(f"WARNING: JSON parse error for {filename}: {parse_err}")
-            i, j = raw.find("{"), raw.rfind("}")
-            return json.loads(raw[i:j+1]) if i >= 0 and j > i else {}
+        },
+        "max_tokens": MAX_OUTPUT_TOKENS,
+    }
+
+def parse_metadata(raw: str, filename: str) -> Dict[str, Any]:
+    try:
+        parsed = json.loads(raw)
+        if not parsed or len(parsed) == 0:
+            print(f"WARNING: API returned empty metadata for {filename}. Raw response: {raw[:200]}")
+        return parsed
+    except Exception as parse_err:
+        print(f"WARNING: JSON parse error for {filename}: {parse_err}")
+        i, j = raw.find("{"), raw.rfind("}")
+        return json.loads(raw[i:j+1]) if i >= 0 and j > i else {}
+
+class EmptyMetadataError(RuntimeError):
+    """The model answered, but with no usable metadata."""
+
+def extract_metadata(img_bytes: Images, ocr_text: str, filename: str, model: str = DEFAULT_MODEL, known_collection: str = "", known_repository: str = "", known_permalink: str = "", raise_errors: bool = False, usage: Optional[Dict[str, int]] = None,
+                     ocr_reliable: bool = True) -> Dict[str, Any]:
+    """Returns {} on any failure, or raises (EmptyMetadataError for an empty answer) when raise_errors is set.
+
+    usage, when given, receives the call's prompt/completion/cached token counts.
+    """
+    client = _get_client()
+    request = metadata_request(img_bytes, ocr_text, filename, model, known_collection, known_repository, known_permalink, ocr_reliable)
+    try:
+        resp = client.chat.completions.create(**request)
+        if usage is not None:
+            usage.update(usage_fields(resp))
+        md = parse_metadata(resp.choices[0].message.content or "{}", filename)
+        if not md and raise_errors:
+            raise EmptyMetadataError(f"empty metadata for {filename}")
+        return md
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"ERROR extracting metadata for {filename}: {e}")
         return {}
@@ -0,0 +1,212 @@
+import os, json, time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from .ai_metadata import metadata_request, parse_metadata, _get_client
+from .cache import ResultCache, file_sha256, make_key
+from .ocr import ocr_is_weak
+from .pipeline import prepare_item, make_envelope, write_envelope, metadata_key, report_suffix, _prompt_filename
+from .grouping import Item, item_name, item_paths
+
+# Offline metadata extraction through the OpenAI Batch API.
+#   submit:  prepare each file as usual (hash, cache, OCR, payload), write the exact chat-completions
+#            request extract_metadata would send to <batch_dir>/<name>.requests.jsonl, upload it and
+#            record a <name>.manifest.json mapping custom_id -> source files (grouped objects keep
+#            their key and member files).
+#   collect: poll the batches in the manifests and expand finished results into the usual envelopes.
+# Both steps are idempotent: files already submitted and not yet collected are not resubmitted,
+# and collected manifests are not read again. Files whose request failed are picked up by the next submit.
+# The client comes from ai_metadata._get_client, so set_client_factory/OPENAI_BASE_URL redirect it.
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024  # the Batch API accepts input files up to 200 MB
+PENDING_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+def _manifests(batch_dir: str) -> List[Path]:
+    return sorted(Path(batch_dir).glob("*.manifest.json"))
+
+def _load(path: Path) -> Dict[str, Any]:
+    return json.loads(path.read_text(encoding="utf-8"))
+
+def _save(path: Path, manifest: Dict[str, Any]) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _submitted(batch_dir: str) -> Tuple[Set[str], Set[str]]:
+    """(custom_ids, source paths) of the requests submitted and not yet collected."""
+    ids, paths = set(), set()
+    for m in _manifests(batch_dir):
+        manifest = _load(m)
+        if not manifest.get("collected"):
+            ids.update(manifest["items"])
+            paths.update(f["path"] for item in manifest["items"].values() for f in item["files"])
+    return ids, paths
+
+def _item_sha256(item: Item) -> str:
+    # The job sha256 prepare_item would compute: the file's, or for a grouped object a key over its members'.
+    hashes = [file_sha256(p) for p in item_paths(item)]
+    return hashes[0] if len(hashes) == 1 else make_key("group", *hashes)
+
+class _BatchWriter:
+    """Accumulates request lines into a JSONL file and uploads it as a batch once full."""
+
+    def __init__(self, batch_dir: str, model: str, client):
+        self.batch_dir, self.model, self.client = batch_dir, model, client
+        self.batch_ids: List[str] = []
+        self._seq = 0
+        self._open()
+
+    def _open(self) -> None:
+        self._seq += 1
+        self.name = f"batch-{time.strftime('%Y%m%d-%H%M%S')}-{self._seq:03d}"
+        self.path = Path(self.batch_dir) / f"{self.name}.requests.jsonl"
+        self.fh = open(self.path, "w", encoding="utf-8")
+        self.items: Dict[str, Dict[str, Any]] = {}
+        self.size = 0
+
+    def add(self, custom_id: str, body: Dict[str, Any], item: Dict[str, Any]) -> None:
+        line = json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}, ensure_ascii=False) + "\n"
+        if self.items and (self.size + len(line.encode("utf-8")) > MAX_BATCH_BYTES or len(self.items) >= MAX_BATCH_REQUESTS):
+            self.flush()
+            self._open()
+        self.fh.write(line)
+        self.size += len(line.encode("utf-8"))
+        self.items[custom_id] = item
+
+    def flush(self) -> None:
+        self.fh.close()
+        if not self.items:
+            self.path.unlink()
+            return
+        with open(self.path, "rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=uploaded.id, endpoint=BATCH_ENDPOINT, completion_window="24h",
+                                           metadata={"description": f"mini_loc15 {self.name}"})
+        _save(Path(self.batch_dir) / f"{self.name}.manifest.json", {
+            "batch_id": batch.id, "input_file_id": uploaded.id, "requests": self.path.name,
+            "model": self.model, "submitted": time.strftime("%Y-%m-%dT%H:%M:%S"), "collected": False,
+            "items": self.items,
+        })
+        self.batch_ids.append(batch.id)
+        print(f"↑ Submitted {len(self.items)} requests as batch {batch.id} ({self.size / 1024 ** 2:.1f} MB)")
+
+def submit(paths: Iterable[Item], out_dir: str, batch_dir: str, collection: str, repository: str, permalink: str, model: str,
+           cache: Optional[ResultCache] = None, image_opts: Optional[Dict[str, Any]] = None,
+           pdf_opts: Optional[Dict[str, Any]] = None, client=None, dedup: Optional[int] = None) -> List[str]:
+    """Prepare files and upload their metadata requests as Batch API jobs. Returns the new batch ids.
+
+    Cached results are written straight away. Weak-OCR files get no separate transcription round
+    (as with --single-call): their request marks the OCR text as unreliable and the model transcribes the image.
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    client = client or _get_client()
+    already, submitted_paths = _submitted(batch_dir)
+    writer = _BatchWriter(batch_dir, model, client)
+    try:
+        for path in paths:
+            name = item_name(path)
+            missing = [p for p in item_paths(path) if not Path(p).exists()]
+            if missing:
+                print(f"Skip missing: {', '.join(missing)}")
+                continue
+            # A file already in a pending batch is recognized by path and hash, before any OCR or payload work.
+            if item_paths(path)[0] in submitted_paths and metadata_key(_item_sha256(path), model, collection, repository, permalink) in already:
+                print(f"⊘ Skipping {name} (already submitted)")
+                continue
+            try:
+                job = prepare_item(path, out_dir, collection, repository, permalink, model, cache, image_opts, pdf_opts, dedup)
+            except Exception as e:
+                print(f"✗ {name}: {e}")
+                continue
+            if job.get("skip"):
+                print(f"⊘ Skipping {name} (already processed)")
+                continue
+            if "metadata" in job:
+                key = write_envelope(make_envelope(job["metadata"], job["filename"], job["conf"], model, job["sha256"], context=job.get("context")),
+                                     out_dir, job["path"], key=job.get("key"))
+                print(f"✓ {name} -> {key}{report_suffix(job)}")
+                continue
+            # Identical files share one request; every copy gets the envelope on collect.
+            custom_id = metadata_key(job["sha256"], model, collection, repository, permalink)
+            target = {"path": job["path"], "filename": job["filename"]}
+            if "key" in job:
+                target["key"] = job["key"]
+            if job.get("context"):
+                target["context"] = job["context"]
+            if custom_id in already:
+                print(f"⊘ Skipping {name} (already submitted)")
+                continue
+            if custom_id in writer.items:
+                writer.items[custom_id]["files"].append(target)
+                continue
+            body = metadata_request(job["img_bytes"], job["text"], _prompt_filename(job), model, collection, repository, permalink,
+                                    ocr_reliable=not ocr_is_weak(job["text"], job["conf"]))
+            writer.add(custom_id, body, {"sha256": job["sha256"], "confidence": job["conf"], "files": [target]})
+    finally:
+        writer.flush()
+    return writer.batch_ids
+
+def _read_file(client, file_id: str) -> str:
+    return client.files.content(file_id).text
+
+def _collect_one(manifest: Dict[str, Any], batch, out_dir: str, cache: Optional[ResultCache], client) -> Dict[str, int]:
+    counts = {"written": 0, "failed": 0}
+    if getattr(batch, "output_file_id", None):
+        for line in _read_file(client, batch.output_file_id).splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            item = manifest["items"].get(result.get("custom_id"))
+            if item is None:
+                continue
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                counts["failed"] += len(item["files"])
+                print(f"✗ {', '.join(f['filename'] for f in item['files'])}: {result.get('error') or response.get('status_code')}")
+                continue
+            raw = response["body"]["choices"][0]["message"].get("content") or "{}"
+            md = parse_metadata(raw, item["files"][0]["filename"])
+            if cache is not None and md:
+                cache.put("metadata", result["custom_id"], {"metadata": md, "confidence": item["confidence"]})
+            for f in item["files"]:
+                key = write_envelope(make_envelope(md, f["filename"], item["confidence"], manifest["model"], item["sha256"], context=f.get("context")),
+                                     out_dir, f["path"], key=f.get("key"))
+                counts["written"] += 1
+                print(f"✓ {f['filename']} -> {key}")
+    if getattr(batch, "error_file_id", None):
+        for line in _read_file(client, batch.error_file_id).splitlines():
+            if line.strip():
+                result = json.loads(line)
+                item = manifest["items"].get(result.get("custom_id"), {"files": []})
+                counts["failed"] += len(item["files"])
+                print(f"✗ {', '.join(f['filename'] for f in item['files'])}: {result.get('error')}")
+    return counts
+
+def collect(batch_dir: str, out_dir: str, cache: Optional[ResultCache] = None, client=None,
+            wait: bool = False, poll_interval: float = 60.0) -> int:
+    """Write envelopes for every finished batch; with wait=True keep polling until none is pending.
+
+    Returns the number of batches still pending.
+    """
+    client = client or _get_client()
+    while True:
+        pending = 0
+        for m in _manifests(batch_dir):
+            manifest = _load(m)
+            if manifest.get("collected"):
+                continue
+            batch = client.batches.retrieve(manifest["batch_id"])
+            status = batch.status
+            if status in PENDING_STATUSES:
+                pending += 1
+                print(f"… Batch {manifest['batch_id']} is {status}")
+                continue
+            counts = _collect_one(manifest, batch, out_dir, cache, client)
+            manifest.update({"collected": True, "status": status, "collected_at": time.strftime("%Y-%m-%dT%H:%M:%S")})
+            _save(m, manifest)
+            print(f"✓ Batch {manifest['batch_id']} {status}: {counts['written']} written, {counts['failed']} failed")
+        if not pending or not wait:
+            return pending
+        time.sleep(poll_interval)
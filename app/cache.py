@@ -0,0 +1,94 @@
+import os, json, time, sqlite3, hashlib, threading
+from typing import Any, Optional
+
+# Content-addressed result cache. Entries live in one SQLite file, split by kind:
+#   "ocr"        -> OCR text/confidence, keyed by image content hash
+#   "transcript" -> model transcription, keyed by content hash + model
+#   "metadata"   -> extract_metadata response, keyed by content hash + model + prompt version + hints
+# Least-recently-used entries are evicted once the total payload size exceeds max_bytes, down to 90%
+# of it. Each connection keeps a running total, so a put doesn't have to sum the table.
+
+DEFAULT_CACHE_DIR = ".cache"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def make_key(*parts: Any) -> str:
+    return hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+class ResultCache:
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+
+    # Connections are per thread and per process, so the cache can be handed to pool workers.
+    def __getstate__(self):
+        return {"cache_dir": self.cache_dir, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.cache_dir, "results.sqlite3"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " size INTEGER NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (kind, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM entries WHERE kind=? AND key=?", (kind, key)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE entries SET last_used=? WHERE kind=? AND key=?", (time.time(), kind, key))
+        return json.loads(row[0])
+
+    def put(self, kind: str, key: str, value: Any) -> None:
+        raw = json.dumps(value, ensure_ascii=False)
+        size = len(raw.encode("utf-8"))
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (kind, key, value, size, last_used) VALUES (?, ?, ?, ?, ?)",
+            (kind, key, raw, size, time.time()),
+        )
+        self._account(conn, size)
+
+    def size(self) -> int:
+        return self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def _account(self, conn: sqlite3.Connection, added: int) -> None:
+        total = getattr(self._local, "total", None)
+        self._local.total = self.size() if total is None else total + added
+        if self._local.total > self.max_bytes:
+            self._local.total = self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        # Recount, since other processes write here too, then drop the least recently used; returns the new total.
+        total = self.size()
+        if total <= self.max_bytes:
+            return total
+        excess = total - int(self.max_bytes * 0.9)
+        freed = 0
+        victims = []
+        for kind, key, size in conn.execute("SELECT kind, key, size FROM entries ORDER BY last_used"):
+            victims.append((kind, key))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM entries WHERE kind=? AND key=?", victims)
+        return total - freed
@@ -0,0 +1,219 @@
+import os, math, sqlite3, threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from PIL import Image
+from .imaging import open_frame
+
+# Perceptual hashes for near-duplicate detection (re-scans, duplicate exports, the same item with
+# a different crop or exposure). Each image gets a 64-bit pHash (low-frequency DCT signs) and
+# dHash (horizontal gradient signs), computed from a JPEG draft decode at ~1/8 scale.
+#
+# The index splits each pHash into BANDS bytes, each with its own SQLite index. Two hashes within
+# Hamming distance d < BANDS agree on at least one byte, so a lookup fetches the rows matching any
+# band and checks their real distance: exhaustive up to distance BANDS - 1, and fast because each
+# band is selective.
+
+INDEX_FILE = "loc15.phash.sqlite3"
+BANDS = 8
+DEFAULT_MAX_DISTANCE = 6
+HASH_DECODE_BUDGET_MB = 16  # TIFF masters are reduced to a few megapixels before hashing
+DHASH_SLACK = 2  # dHash is less tolerant of exposure changes; allow it this multiple of the pHash distance
+
+_DCT_SIZE = 32
+_DCT_KEEP = 8
+_DCT = [[math.cos(math.pi * (2 * x + 1) * u / (2 * _DCT_SIZE)) for x in range(_DCT_SIZE)] for u in range(_DCT_KEEP)]
+
+def _load_gray(path: str) -> Image.Image:
+    if not path.lower().endswith((".jpg", ".jpeg")):
+        return open_frame(path, 0, HASH_DECODE_BUDGET_MB).convert("L")
+    with Image.open(path) as im:
+        im.draft("L", (_DCT_SIZE * 2, _DCT_SIZE * 2))
+        return im.convert("L")
+
+def phash(gray: Image.Image) -> int:
+    px = list(gray.resize((_DCT_SIZE, _DCT_SIZE), Image.LANCZOS).getdata())
+    rows = [px[y * _DCT_SIZE:(y + 1) * _DCT_SIZE] for y in range(_DCT_SIZE)]
+    # Separable DCT-II, only the lowest _DCT_KEEP frequencies in each direction.
+    r = [[sum(c * p for c, p in zip(_DCT[u], row)) for u in range(_DCT_KEEP)] for row in rows]
+    coeffs = [sum(_DCT[v][y] * r[y][u] for y in range(_DCT_SIZE)) for v in range(_DCT_KEEP) for u in range(_DCT_KEEP)]
+    median = sorted(coeffs[1:])[len(coeffs[1:]) // 2]  # the DC term only reflects overall brightness
+    return sum(1 << i for i, c in enumerate(coeffs) if c > median)
+
+def dhash(gray: Image.Image) -> int:
+    px = list(gray.resize((9, 8), Image.LANCZOS).getdata())
+    return sum(1 << (y * 8 + x) for y in range(8) for x in range(8) if px[y * 9 + x] < px[y * 9 + x + 1])
+
+def image_hashes(path: str) -> Tuple[int, int]:
+    """(pHash, dHash) of an image file."""
+    gray = _load_gray(path)
+    return phash(gray), dhash(gray)
+
+def distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+def to_hex(h: int) -> str:
+    return f"{h:016x}"
+
+def _signed(h: int) -> int:
+    # SQLite integers are signed 64-bit.
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+def _bands(h: int) -> List[int]:
+    return [(h >> (8 * i)) & 0xFF for i in range(BANDS)]
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS hashes (key TEXT PRIMARY KEY, phash INTEGER NOT NULL, dhash INTEGER NOT NULL, "
+    + ", ".join(f"b{i} INTEGER NOT NULL" for i in range(BANDS)) + ")",
+] + [f"CREATE INDEX IF NOT EXISTS hashes_b{i} ON hashes (b{i})" for i in range(BANDS)]
+
+class PerceptualIndex:
+    """Perceptual hashes of processed images by result key, with Hamming-distance lookups."""
+    _open: Dict[Tuple[int, str], "PerceptualIndex"] = {}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    @classmethod
+    def for_output(cls, out_dir: str) -> "PerceptualIndex":
+        path = os.path.abspath(os.path.join(out_dir, INDEX_FILE))
+        key = (os.getpid(), path)
+        if key not in cls._open:
+            cls._open[key] = cls(path)
+        return cls._open[key]
+
+    # Connections are per thread and per process, so the index can be handed to pool workers.
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def put(self, key: str, ph: int, dh: int) -> None:
+        self._conn().execute(
+            f"INSERT OR REPLACE INTO hashes (key, phash, dhash, {', '.join(f'b{i}' for i in range(BANDS))}) "
+            f"VALUES ({', '.join('?' * (3 + BANDS))})", [key, _signed(ph), _signed(dh)] + _bands(ph))
+
+    def delete(self, key: str) -> None:
+        self._conn().execute("DELETE FROM hashes WHERE key=?", (key,))
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def __contains__(self, key: str) -> bool:
+        return self._conn().execute("SELECT 1 FROM hashes WHERE key=?", (key,)).fetchone() is not None
+
+    def near(self, ph: int, dh: int, max_distance: int = DEFAULT_MAX_DISTANCE,
+             exclude: Optional[str] = None) -> List[Tuple[int, str]]:
+        """(pHash distance, key) of indexed images within max_distance, closest first."""
+        where = " OR ".join(f"b{i}=?" for i in range(BANDS))
+        rows = self._conn().execute(f"SELECT key, phash, dhash FROM hashes WHERE {where}", _bands(ph)).fetchall()
+        hits = []
+        for key, p, d in rows:
+            if key == exclude:
+                continue
+            dp = distance(ph, p & 0xFFFFFFFFFFFFFFFF)
+            if dp <= max_distance and distance(dh, d & 0xFFFFFFFFFFFFFFFF) <= max(DHASH_SLACK * max_distance, 1):
+                hits.append((dp, key))
+        return sorted(hits)
+
+    def clusters(self, max_distance: int = DEFAULT_MAX_DISTANCE) -> List[List[str]]:
+        """Groups of two or more keys linked by near-duplicate pairs, largest first."""
+        parent: Dict[str, str] = {}
+        def find(k: str) -> str:
+            while parent.get(k, k) != k:
+                parent[k] = parent.get(parent[k], parent[k])
+                k = parent[k]
+            return k
+        for key, p, d in self._conn().execute("SELECT key, phash, dhash FROM hashes").fetchall():
+            for _, other in self.near(p & 0xFFFFFFFFFFFFFFFF, d & 0xFFFFFFFFFFFFFFFF, max_distance, exclude=key):
+                a, b = find(key), find(other)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+        groups: Dict[str, List[str]] = {}
+        for k in parent:
+            groups.setdefault(find(k), []).append(k)
+        return sorted((sorted(set(g) | {root}) for root, g in groups.items()), key=lambda g: (-len(g), g[0]))
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+def find_duplicate(store: Any, index: PerceptualIndex, key: str, ph: int, dh: int,
+                   max_distance: int = DEFAULT_MAX_DISTANCE) -> Optional[Tuple[str, int, Dict[str, Any]]]:
+    """Closest processed near-duplicate with metadata: (original key, distance, its envelope), or None.
+
+    Links always point at an original, never at another duplicate.
+    """
+    for dist, other in index.near(ph, dh, max_distance, exclude=key):
+        envelope = store.get(other)
+        if not envelope or not envelope.get("metadata"):
+            continue
+        root = envelope.get("context", {}).get("duplicate_of")
+        if root and root != key:
+            root_envelope = store.get(root)
+            if root_envelope and root_envelope.get("metadata"):
+                return root, dist, root_envelope
+        return other, dist, envelope
+    return None
+
+def _hash_file(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        return image_hashes(path)
+    except Exception:
+        return None
+
+def backfill(store: Any, index: PerceptualIndex, search_dirs: List[str] = (), workers: int = 1) -> int:
+    """Index items processed without --dedup: hashes from the envelope context, else from the source image.
+
+    Sources are looked up at the stored path, then by filename in search_dirs. Returns the number indexed.
+    """
+    todo: List[Tuple[str, str]] = []
+    n = 0
+    for key, envelope in store.iter_envelopes():
+        if key in index:
+            continue
+        ctx = envelope.get("context", {})
+        if "phash" in ctx:
+            index.put(key, int(ctx["phash"], 16), int(ctx["dhash"], 16))
+            n += 1
+            continue
+        candidates = [p for p in [store.path_of(key)] if p] + [os.path.join(d, ctx.get("filename", "")) for d in search_dirs]
+        src = next((p for p in candidates if os.path.isfile(p) and not p.lower().endswith(".pdf")), None)
+        if src:
+            todo.append((key, src))
+    if todo:
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+            for (key, _), hashes in zip(todo, pool.map(_hash_file, [src for _, src in todo], chunksize=16)):
+                if hashes is not None:
+                    index.put(key, *hashes)
+                    n += 1
+    return n
+
+def cluster_report(store: Any, index: PerceptualIndex, max_distance: int = DEFAULT_MAX_DISTANCE) -> List[List[Dict[str, Any]]]:
+    """Duplicate clusters as lists of {key, filename, duplicate_of, distance (pHash, to the cluster's first key)}."""
+    report = []
+    for keys in index.clusters(max_distance):
+        hashes = {k: (p & 0xFFFFFFFFFFFFFFFF) for k, p in index._conn().execute(
+            f"SELECT key, phash FROM hashes WHERE key IN ({', '.join('?' * len(keys))})", keys)}
+        rows = []
+        for k in keys:
+            ctx = (store.get(k) or {}).get("context", {})
+            rows.append({"key": k, "filename": ctx.get("filename", ""), "duplicate_of": ctx.get("duplicate_of"),
+                         "distance": distance(hashes[keys[0]], hashes[k])})
+        report.append(rows)
+    return report
@@ -1,4 +1,20 @@
-from typing import Dict, Any, List
+import os, csv, json, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except Exception:
+    pyarrow = None
+    pq = None
+
+# Bulk export streams the result store in key order, batch by batch: envelopes are parsed and
+# flattened to SAMPLE_HEADERS rows in worker processes, and at most a few batches are in flight,
+# so memory stays flat however large the store is. A watermark file remembers the newest
+# "updated" time exported, so the next run with the same file picks up only what changed.
+
+EXPORT_FORMATS = ("csv", "jsonl", "parquet")
 
 SAMPLE_HEADERS = [
     "Identifier","Title","Series","Issue","Creator","Contributors","Correspondents","Date",
@@ -45,3 +61,107 @@ def to_sample_row(envelope: Dict[str, Any]) -> Dict[str, str]:
         "Object ID": md.get("call_number") or md.get("reproduction_number") or "",
     }
     return row
+
+def _convert(rows: List[Tuple[str, str, float]]) -> Tuple[List[Dict[str, str]], float]:
+    """Parse one batch of (key, envelope text, updated) into sample rows; returns (rows, newest updated)."""
+    return [to_sample_row(json.loads(raw)) for _, raw, _ in rows], max(u for _, _, u in rows)
+
+def iter_sample_rows(store, valid: Optional[bool] = None, since: Optional[float] = None, date_from: Optional[str] = None,
+                     date_to: Optional[str] = None, workers: int = 1, batch: int = 500,
+                     until: Optional[float] = None) -> Iterator[Tuple[List[Dict[str, str]], float]]:
+    """(sample rows, newest updated) per store batch, in key order; parsed in `workers` processes when > 1."""
+    batches = store.iter_batches(valid=valid, since=since, date_from=date_from, date_to=date_to, batch=batch, until=until)
+    if workers <= 1:
+        for rows in batches:
+            yield _convert(rows)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window: deque = deque()
+        for rows in batches:
+            window.append(pool.submit(_convert, rows))
+            if len(window) >= workers * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+class _Writer:
+    def __init__(self, path: str, fmt: str):
+        self.fmt = fmt
+        self._f = None
+        self._pq = None
+        if fmt == "parquet":
+            if pq is None:
+                raise RuntimeError("pyarrow not installed. pip install pyarrow")
+            self._schema = pyarrow.schema([(h, pyarrow.string()) for h in SAMPLE_HEADERS])
+            self._pq = pq.ParquetWriter(path, self._schema, compression="zstd")
+        else:
+            self._f = open(path, "w", encoding="utf-8", newline="")
+            if fmt == "csv":
+                self._csv = csv.DictWriter(self._f, fieldnames=SAMPLE_HEADERS)
+                self._csv.writeheader()
+
+    def write(self, rows: List[Dict[str, str]]) -> None:
+        if self._pq is not None:
+            self._pq.write_table(pyarrow.Table.from_pylist(rows, schema=self._schema))
+        elif self.fmt == "csv":
+            self._csv.writerows(rows)
+        else:
+            self._f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in rows)
+
+    def close(self) -> None:
+        if self._pq is not None:
+            self._pq.close()
+        if self._f is not None:
+            self._f.close()
+
+def read_watermark(path: str) -> Optional[float]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return float(json.load(f)["updated"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def write_watermark(path: str, updated: float, count: int) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"updated": updated, "count": count, "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S%z")}, f)
+    os.replace(tmp, path)
+
+def export_format(path: str, fmt: str = "") -> str:
+    """fmt, or the format implied by path's extension; ValueError if unknown, RuntimeError if its writer isn't installed."""
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}; use one of {', '.join(EXPORT_FORMATS)}")
+    if fmt == "parquet" and pq is None:
+        raise RuntimeError("pyarrow not installed. pip install pyarrow")
+    return fmt
+
+def export_samples(store, path: str, fmt: str = "", valid: Optional[bool] = None, date_from: Optional[str] = None,
+                   date_to: Optional[str] = None, watermark: str = "", workers: int = 1, batch: int = 500) -> int:
+    """Write store items as SAMPLE_HEADERS rows to path (csv, jsonl or parquet; default from the extension).
+
+    With a watermark file only items updated after it are written, and the file is advanced once the
+    export is complete. The export covers items updated up to a cutoff taken when it starts, and the
+    cutoff becomes the new watermark: items rewritten while pages are being read fall after it and
+    go out with the next export, never skipped. The output is written to a temp file and renamed, so a failed run leaves the
+    previous export and watermark in place. Returns the number of rows written.
+    """
+    fmt = export_format(path, fmt)
+    since = read_watermark(watermark) if watermark else None
+    tmp = f"{path}.part"
+    writer = _Writer(tmp, fmt)
+    cutoff = store.version()[1]
+    n = 0
+    try:
+        for rows, _ in iter_sample_rows(store, valid, since, date_from, date_to, workers, batch, until=cutoff):
+            writer.write(rows)
+            n += len(rows)
+    except BaseException:
+        writer.close()
+        os.remove(tmp)
+        raise
+    writer.close()
+    os.replace(tmp, path)
+    if watermark and (cutoff or since is not None):
+        write_watermark(watermark, max(cutoff, since or 0.0), n)
+    return n
@@ -1,12 +1,9 @@
-import os
-from io import BytesIO
-from typing import List, Tuple
+import os, json, hashlib, threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from pathlib import Path
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from .metrics import Metrics, timed
 
 try:
     from dotenv import load_dotenv
@@ -17,8 +14,16 @@ except Exception:
 # Minimal Drive helper that mirrors the user's pattern.
 
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
+MIME_TYPES = ("application/pdf", "image/png", "image/jpeg", "image/tiff", "image/bmp", "image/gif", "image/webp")
+FILE_FIELDS = "id, name, mimeType, md5Checksum, modifiedTime, size, parents, trashed"
+CHUNK_SIZE = 8 * 1024 * 1024
+STATE_FILE = ".gdrive_sync.json"
 
-def _get_creds() -> Credentials:
+def _get_creds() -> Any:
+    # The Google client libraries load only when Drive is actually used.
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
     creds = None
     token = os.getenv("GOOGLE_TOKEN_JSON", "")
     client_secret = os.getenv("GOOGLE_CLIENT_SECRET_JSON", "")
@@ -37,48 +42,215 @@ def _get_creds() -> Credentials:
                     f.write(creds.to_json())
     return creds
 
-def pull_files_from_folder(folder_id: str, out_dir: str, mime_types: Tuple[str, ...] = (
-    "application/pdf", "image/png", "image/jpeg", "image/tiff", "image/bmp", "image/gif", "image/webp"
-)) -> List[str]:
+def drive_service_factory() -> Callable[[], Any]:
+    """Return a callable giving each thread its own Drive service (httplib2 connections are not thread-safe)."""
+    from googleapiclient.discovery import build
+    creds = _get_creds()
+    local = threading.local()
+    def factory():
+        if getattr(local, "service", None) is None:
+            local.service = build("drive", "v3", credentials=creds)
+        return local.service
+    return factory
+
+def _md5(path: Path) -> str:
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _load_state(out_dir: str, folder_id: str) -> Dict[str, Any]:
+    try:
+        state = json.loads((Path(out_dir) / STATE_FILE).read_text(encoding="utf-8"))
+        if state.get("folder_id") == folder_id:
+            return state
+    except Exception:
+        pass
+    return {"folder_id": folder_id, "page_token": None, "files": {}}
+
+def _save_state(out_dir: str, state: Dict[str, Any]) -> None:
+    path = Path(out_dir) / STATE_FILE
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(state, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _list_folder(service, folder_id: str, mime_types: Tuple[str, ...]) -> List[Dict[str, Any]]:
+    mime_q = " or ".join([f"mimeType='{m}'" for m in mime_types])
+    query = f"'{folder_id}' in parents and trashed=false and ({mime_q})"
+    page_token = None
+    files = []
+    while True:
+        resp = service.files().list(q=query, pageToken=page_token, pageSize=1000, fields=f"nextPageToken, files({FILE_FIELDS})").execute()
+        files.extend(resp.get("files", []))
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            return files
+
+def _list_changes(service, page_token: str) -> Tuple[List[Dict[str, Any]], str]:
+    """Return (changes since page_token, token for the next sync)."""
+    changes = []
+    while True:
+        resp = service.changes().list(pageToken=page_token, pageSize=1000, spaces="drive",
+                                      fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}))").execute()
+        changes.extend(resp.get("changes", []))
+        if resp.get("newStartPageToken"):
+            return changes, resp["newStartPageToken"]
+        page_token = resp["nextPageToken"]
+
+def _is_current(f: Dict[str, Any], known: Optional[Dict[str, Any]], path: Path) -> bool:
+    if not path.exists():
+        return False
+    if known and known.get("name") == f["name"] and known.get("md5Checksum") == f.get("md5Checksum") \
+            and known.get("modifiedTime") == f.get("modifiedTime") and str(path.stat().st_size) == str(f.get("size", path.stat().st_size)):
+        return True
+    # Unknown to the manifest (e.g. downloaded by an older version): trust it only if the checksum matches.
+    # Drive omits md5Checksum for native Google files.
+    return not f.get("md5Checksum") or _md5(path) == f["md5Checksum"]
+
+def download_file(service, f: Dict[str, Any], path: Path, chunk_size: int = CHUNK_SIZE) -> Path:
+    """Stream a Drive file to <path>.part in ranged chunks, resuming an existing .part, then rename into place."""
+    part = path.with_name(path.name + ".part")
+    offset = part.stat().st_size if part.exists() else 0
+    resumed = offset > 0
+    size = int(f["size"]) if f.get("size") else None
+    request = service.files().get_media(fileId=f["id"])
+    with open(part, "ab") as fh:
+        while size is None or offset < size:
+            headers = dict(request.headers or {}, range=f"bytes={offset}-{offset + chunk_size - 1}")
+            resp, content = request.http.request(request.uri, method="GET", headers=headers)
+            if resp.status == 416:  # range starts past the end: the .part is already complete
+                break
+            if resp.status not in (200, 206):
+                raise RuntimeError(f"download of {f['name']} failed: HTTP {resp.status}")
+            if resp.status == 200 and offset:
+                # Server ignored the range; start over.
+                fh.seek(0)
+                fh.truncate()
+                offset = 0
+            fh.write(content)
+            offset += len(content)
+            if resp.status == 200 or len(content) < chunk_size:
+                break
+    if f.get("md5Checksum") and _md5(part) != f["md5Checksum"]:
+        part.unlink()
+        if resumed:  # the .part was left by an older revision of the file; fetch it whole
+            return download_file(service, f, path, chunk_size)
+        raise RuntimeError(f"checksum mismatch for {f['name']}; partial download discarded")
+    os.replace(part, path)
+    return path
+
+def sync_folder(folder_id: str, out_dir: str, mime_types: Tuple[str, ...] = MIME_TYPES, workers: int = 4,
+                service_factory: Optional[Callable[[], Any]] = None, metrics: Optional[Metrics] = None,
+                listing: Optional[List[str]] = None) -> Iterator[str]:
+    """Sync a Drive folder into out_dir, yielding each local path as soon as it is present.
+
+    Files already on disk are yielded first while the first downloads run; iterate it directly to
+    overlap downloading with processing.
+
+    The first sync lists the whole folder; later syncs only read the Drive changes feed from the
+    page token saved in out_dir/.gdrive_sync.json. Downloads run on `workers` threads, stream to
+    .part files that later runs resume, and are checked against md5Checksum before the atomic rename.
+    service_factory returns a Drive v3 service per thread (default: OAuth via drive_service_factory).
+    Download wall time and bytes are recorded as "download" stage events when metrics is given.
+    listing, when given, is extended with the local path of every file in the folder (present or still
+    to be downloaded) before the first path is yielded, e.g. so recto/verso pairs can be grouped as they land.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    service_factory = service_factory or drive_service_factory()
+    service = service_factory()
+    state = _load_state(out_dir, folder_id)
+    known: Dict[str, Dict[str, Any]] = state["files"]
+
+    if state.get("page_token"):
+        changes, next_token = _list_changes(service, state["page_token"])
+        listed = {}
+        for c in changes:
+            f = c.get("file") or {}
+            in_folder = folder_id in f.get("parents", []) and f.get("mimeType") in mime_types
+            if c.get("removed") or f.get("trashed") or not in_folder:
+                known.pop(c["fileId"], None)
+            else:
+                listed[f["id"]] = f
+        print(f"→ {len(listed)} changed files in folder {folder_id} since last sync")
+        candidates = list(listed.values())
+    else:
+        next_token = service.changes().getStartPageToken().execute()["startPageToken"]
+        candidates = _list_folder(service, folder_id, mime_types)
+        known = state["files"] = {f["id"]: known[f["id"]] for f in candidates if f["id"] in known}
+
+    changed_ids = {f["id"] for f in candidates}
+    ready: List[str] = []
+    todo = deque()
+    for f in candidates:
+        path = Path(out_dir) / f["name"]
+        prev = known.get(f["id"])
+        if prev and prev.get("name") != f["name"] and (Path(out_dir) / prev["name"]).exists():
+            os.replace(Path(out_dir) / prev["name"], path)  # renamed on Drive
+        if _is_current(f, prev, path):
+            print(f"⊘ Skipping {f['name']} (already exists)")
+            known[f["id"]] = {k: f.get(k) for k in ("name", "md5Checksum", "modifiedTime", "size")}
+            ready.append(str(path))
+        else:
+            todo.append(f)
+    # Files untouched since the last sync are still part of the folder.
+    for file_id, meta in known.items():
+        path = Path(out_dir) / meta["name"]
+        if file_id not in changed_ids and path.exists():
+            ready.append(str(path))
+
+    if listing is not None:
+        listing.extend(ready + [str(Path(out_dir) / f["name"]) for f in todo])
+    workers = max(1, workers)
+    downloads, failed, complete = len(todo), 0, False
+    def fetch(f):
+        print(f"→ Downloading {f['name']} …")
+        events: List[Dict[str, Any]] = []
+        with timed(events, "download") as ev:
+            path = download_file(service_factory(), f, Path(out_dir) / f["name"])
+            ev["bytes"] = path.stat().st_size
+        if metrics is not None:
+            metrics.record_job({"filename": f["name"], "events": events}, "downloaded")
+        return path
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gdrive") as pool:
+            # Downloads are submitted lazily: a new one starts only after the consumer has taken a
+            # finished file, so at most `workers` downloaded files wait on the consumer at any time.
+            futures: Dict[Future, Dict[str, Any]] = {}
+            def refill():
+                while todo and len(futures) < workers:
+                    f = todo.popleft()
+                    futures[pool.submit(fetch, f)] = f
+            refill()
+            yield from ready
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    f = futures.pop(fut)
+                    try:
+                        path = fut.result()
+                    except Exception as e:
+                        failed += 1
+                        print(f"✗ {f['name']}: {e}")
+                        continue
+                    known[f["id"]] = {k: f.get(k) for k in ("name", "md5Checksum", "modifiedTime", "size")}
+                    yield str(path)
+                refill()
+        complete = True
+    finally:
+        # Only advance the changes token when everything landed, so failed files are retried next time.
+        if complete and not failed:
+            state["page_token"] = next_token
+        _save_state(out_dir, state)
+    print(f"✓ Synced {len(known)} files from folder {folder_id} ({downloads - failed} downloaded, {failed} failed)")
+
+def pull_files_from_folder(folder_id: str, out_dir: str, mime_types: Tuple[str, ...] = MIME_TYPES, workers: int = 4) -> List[str]:
     """Download files from Drive folder to out_dir. Returns list of local paths.
-    
+
     Args:
         folder_id: Google Drive folder ID
         out_dir: Local directory to save files
         mime_types: Tuple of MIME types to download
+        workers: Parallel downloads
     """
-    os.makedirs(out_dir, exist_ok=True)
-    service = build("drive", "v3", credentials=_get_creds())
-    mime_q = " or ".join([f"mimeType='{m}'" for m in mime_types])
-    query = f"'{folder_id}' in parents and ({mime_q})"
-    page_token = None
-    saved = []
-    while True:
-        resp = service.files().list(q=query, pageToken=page_token, pageSize=1000, fields="nextPageToken, files(id, name, mimeType)").execute()
-        for f in resp.get("files", []):
-            name = f["name"]
-            file_id = f["id"]
-            path = Path(out_dir) / name
-            
-            # Skip if file already exists
-            if path.exists():
-                print(f"⊘ Skipping {name} (already exists)")
-                saved.append(str(path))
-                continue
-            
-            print(f"→ Downloading {name} …")
-            request = service.files().get_media(fileId=file_id)
-            fh = BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            with open(path, "wb") as o:
-                o.write(fh.getvalue())
-            saved.append(str(path))
-        page_token = resp.get("nextPageToken")
-        if not page_token:
-            break
-    
-    print(f"✓ Downloaded {len(saved)} files from folder {folder_id}")
-    return saved
+    return list(sync_folder(folder_id, out_dir, mime_types, workers=workers))
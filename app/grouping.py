@@ -0,0 +1,88 @@
+import os, re
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+# Objects scanned as several files (BC-0688_Recto.jpg + BC-0688_Verso.jpg, or numbered pages)
+# are processed as one item: one model call over all their pages and one envelope keyed by the
+# object id, listing its member files in context.files.
+# The group pattern is matched against each file stem: its "object" group names the item and its
+# "part" group orders the members (recto/front before verso/back, then pages by number). Files that
+# don't match, and objects with only one file, are processed on their own as before.
+
+DEFAULT_GROUP_PATTERN = r"(?P<object>.+?)[ _-](?P<part>recto|verso|front|back|p(?:age|g)?[ _-]?\d+)"
+PART_ORDER = ("recto", "front", "verso", "back")
+
+# An input item: a single path, or (object key, member paths in page order).
+Item = Union[str, Tuple[str, List[str]]]
+
+def compile_pattern(pattern: str) -> "re.Pattern":
+    rx = re.compile(pattern, re.IGNORECASE)
+    if "object" not in rx.groupindex:
+        raise ValueError(f"group pattern needs an (?P<object>...) group: {pattern}")
+    return rx
+
+def _part_order(part: str) -> Tuple[int, int, str]:
+    part = part.lower()
+    if part in PART_ORDER:
+        return 0, PART_ORDER.index(part), part
+    digits = re.sub(r"\D", "", part)
+    return (1, int(digits), part) if digits else (2, 0, part)
+
+def object_of(path: str, rx: "re.Pattern") -> Optional[Tuple[str, Tuple[int, int, str]]]:
+    """(object id, sort key) for a member file, or None if the stem doesn't match."""
+    m = rx.fullmatch(Path(path).stem)
+    if not m:
+        return None
+    part = m.group("part") if "part" in rx.groupindex and m.group("part") else ""
+    return m.group("object"), _part_order(part)
+
+def group_paths(paths: Iterable[str], pattern: str = DEFAULT_GROUP_PATTERN,
+                expected: Optional[List[str]] = None) -> Iterator[Item]:
+    """Yield unmatched paths and single-file objects as-is, and other objects as (object key, member paths).
+
+    Members are grouped per directory, and each object is yielded once. A group is held until the
+    end of input, or, when expected lists every path the source will produce, until all of its
+    expected members have arrived. expected may be filled while paths is consumed (gdrive.sync_folder
+    lists the whole folder before yielding its first file); members missing from it wait for the end.
+    """
+    rx = compile_pattern(pattern)
+    pending: "OrderedDict[Tuple[str, str], List[Tuple[Tuple[int, int, str], str]]]" = OrderedDict()
+    wanted: Dict[Tuple[str, str], int] = {}
+    seen_expected: Set[str] = set()
+    listed = 0
+
+    def group_of(path: str) -> Optional[Tuple[Tuple[str, str], Tuple[int, int, str]]]:
+        found = object_of(path, rx)
+        return None if found is None else ((os.path.dirname(os.path.abspath(path)), found[0]), found[1])
+
+    def release(gkey) -> Item:
+        # A lone side (a recto with no verso) stays a plain path, keeping its per-file result key.
+        members = sorted(pending.pop(gkey))
+        return members[0][1] if len(members) == 1 else (gkey[1], [p for _, p in members])
+
+    for path in paths:
+        if expected is not None:
+            for name in expected[listed:]:
+                if os.path.abspath(name) not in seen_expected:
+                    seen_expected.add(os.path.abspath(name))
+                    g = group_of(name)
+                    if g is not None:
+                        wanted[g[0]] = wanted.get(g[0], 0) + 1
+            listed = len(expected)
+        g = group_of(path)
+        if g is None:
+            yield path
+            continue
+        gkey, order = g
+        pending.setdefault(gkey, []).append((order, path))
+        if gkey in wanted and len(pending[gkey]) >= wanted[gkey]:
+            yield release(gkey)
+    while pending:
+        yield release(next(iter(pending)))
+
+def item_paths(item: Item) -> List[str]:
+    return [item] if isinstance(item, str) else list(item[1])
+
+def item_name(item: Item) -> str:
+    return Path(item).name if isinstance(item, str) else f"{item[0]} ({', '.join(Path(p).name for p in item[1])})"
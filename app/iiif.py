@@ -0,0 +1,269 @@
+import io, math, os, re, threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+from PIL import Image, ImageOps
+from .cache import make_key
+from .imaging import BYTES_PER_PIXEL, DEFAULT_DECODE_BUDGET_MB, frame_size, open_frame
+
+# IIIF Image API 3.0 style derivatives: {region}/{size}/{rotation}/{quality}.{format}
+#   region   full | square | x,y,w,h | pct:x,y,w,h
+#   size     max | w, | ,h | w,h | !w,h | pct:n   (prefix ^ to allow upscaling)
+#   rotation 0 | 90 | 180 | 270, prefix ! to mirror
+#   quality  default | color | gray | bitonal
+#   format   jpg | png | webp
+# Scans are decoded through imaging.open_frame at the smallest scale that still covers the output,
+# within decode_budget_mb, so a huge master never has to fit in memory at full resolution.
+# Renders are keyed by source path + mtime + size + request, held in a byte-bounded LRU in
+# memory and persisted under cache_dir so restarts don't re-decode full-resolution scans. The disk
+# cache is byte-bounded too: request parameters come from clients, so it can't be allowed to grow.
+
+# Bump when rendering changes so cached derivatives are not reused.
+DERIVATIVE_VERSION = "iiif-2"
+FORMATS = {"jpg": ("JPEG", "image/jpeg"), "png": ("PNG", "image/png"), "webp": ("WEBP", "image/webp")}
+QUALITIES = ("default", "color", "gray", "bitonal")
+MAX_EDGE = 4096
+TILE_SIZE = 512
+MIN_SIZE = 64
+DEFAULT_MEMORY_BYTES = 128 * 1024 ** 2
+DEFAULT_DISK_BYTES = 1024 ** 3
+
+_NUM = r"\d+(?:\.\d+)?"
+
+def parse_region(region: str, width: int, height: int) -> Tuple[int, int, int, int]:
+    """Return (x, y, w, h) in source pixels, clipped to the image."""
+    if region == "full":
+        return 0, 0, width, height
+    if region == "square":
+        side = min(width, height)
+        return (width - side) // 2, (height - side) // 2, side, side
+    m = re.fullmatch(rf"(pct:)?({_NUM}),({_NUM}),({_NUM}),({_NUM})", region)
+    if not m:
+        raise ValueError(f"bad region: {region}")
+    x, y, w, h = (float(v) for v in m.groups()[1:])
+    if m.group(1):
+        x, y, w, h = x * width / 100, y * height / 100, w * width / 100, h * height / 100
+    x, y = int(round(x)), int(round(y))
+    w, h = min(int(round(w)), width - x), min(int(round(h)), height - y)
+    if w <= 0 or h <= 0:
+        raise ValueError(f"region outside image: {region}")
+    return x, y, w, h
+
+def parse_size(size: str, width: int, height: int, max_edge: int = MAX_EDGE) -> Tuple[int, int]:
+    """Return the output (w, h) for a region of width x height."""
+    upscale = size.startswith("^")
+    spec = size[1:] if upscale else size
+    if spec in ("max", "full"):
+        w, h = width, height
+    elif spec.startswith("pct:"):
+        try:
+            pct = float(spec[4:])
+        except ValueError:
+            raise ValueError(f"bad size: {size}")
+        w, h = width * pct / 100, height * pct / 100
+    else:
+        m = re.fullmatch(r"(!)?(\d*),(\d*)", spec)
+        if not m or not (m.group(2) or m.group(3)):
+            raise ValueError(f"bad size: {size}")
+        bw = int(m.group(2)) if m.group(2) else None
+        bh = int(m.group(3)) if m.group(3) else None
+        if m.group(1):
+            if bw is None or bh is None:
+                raise ValueError(f"bad size: {size}")
+            scale = min(bw / width, bh / height)
+            if not upscale:
+                scale = min(scale, 1.0)  # a thumbnail box bigger than the scan returns the scan size
+            w, h = width * scale, height * scale
+        elif bw is None:
+            w, h = width * bh / height, bh
+        elif bh is None:
+            w, h = bw, height * bw / width
+        else:
+            w, h = bw, bh
+    w, h = max(1, int(round(w))), max(1, int(round(h)))
+    if not upscale and (w > width or h > height):
+        raise ValueError(f"size {size} is larger than the region; use ^ to upscale")
+    if max(w, h) > max_edge:
+        scale = max_edge / max(w, h)
+        w, h = max(1, int(w * scale)), max(1, int(h * scale))
+    return w, h
+
+def _rotate(im: Image.Image, rotation: str) -> Image.Image:
+    mirror = rotation.startswith("!")
+    degrees = rotation[1:] if mirror else rotation
+    if degrees not in ("0", "90", "180", "270"):
+        raise ValueError(f"bad rotation: {rotation}")
+    if mirror:
+        im = ImageOps.mirror(im)
+    if degrees != "0":
+        # IIIF rotates clockwise, PIL counter-clockwise.
+        im = im.rotate(-int(degrees), expand=True)
+    return im
+
+def render(path: str, region: str = "full", size: str = "max", rotation: str = "0",
+           quality: str = "default", fmt: str = "jpg", jpeg_quality: int = 85,
+           decode_budget_mb: int = DEFAULT_DECODE_BUDGET_MB) -> bytes:
+    if fmt not in FORMATS:
+        raise ValueError(f"bad format: {fmt}")
+    if quality not in QUALITIES:
+        raise ValueError(f"bad quality: {quality}")
+    width, height = frame_size(path)
+    x, y, w, h = parse_region(region, width, height)
+    out_w, out_h = parse_size(size, w, h)
+    # Budget for the reduction that keeps the region at least out_w x out_h, capped at decode_budget_mb.
+    f = max(1, math.floor(min(w / out_w, h / out_h)))
+    needed_mb = math.ceil(math.ceil(width / f) * math.ceil(height / f) * BYTES_PER_PIXEL / 1024 ** 2)
+    im = open_frame(path, 0, min(decode_budget_mb, max(1, needed_mb)))
+    fx, fy = im.size[0] / width, im.size[1] / height
+    box = (int(x * fx), int(y * fy), max(int(x * fx) + 1, int(round((x + w) * fx))), max(int(y * fy) + 1, int(round((y + h) * fy))))
+    out = im if box == (0, 0) + im.size else im.crop(box)
+    if out.size != (out_w, out_h):
+        out = out.resize((out_w, out_h), Image.LANCZOS, reducing_gap=3.0)
+    out = _rotate(out, rotation)
+    if quality == "gray":
+        out = out.convert("L")
+    elif quality == "bitonal":
+        out = out.convert("1")
+    elif out.mode == "L" and quality == "color":
+        out = out.convert("RGB")
+    pil_fmt = FORMATS[fmt][0]
+    if pil_fmt == "JPEG" and out.mode not in ("RGB", "L"):
+        out = out.convert("RGB")
+    buf = io.BytesIO()
+    if pil_fmt == "PNG":
+        out.save(buf, pil_fmt, optimize=True)
+    else:
+        out.save(buf, pil_fmt, quality=jpeg_quality, **({"method": 4} if pil_fmt == "WEBP" else {"optimize": True}))
+    return buf.getvalue()
+
+def info(path: str, base_url: str) -> Dict:
+    """info.json for an image: dimensions, tile sizes and the pre-scaled sizes a client may request."""
+    width, height = frame_size(path)
+    sizes: List[Dict] = []
+    factor = 1
+    while max(width, height) // factor >= MIN_SIZE and len(sizes) < 8:
+        if max(width, height) // factor <= MAX_EDGE:
+            sizes.append({"width": width // factor, "height": height // factor})
+        factor *= 2
+    scale_factors = [2 ** k for k in range(max(1, math.ceil(math.log2(max(width, height, TILE_SIZE) / TILE_SIZE)) + 1))]
+    return {
+        "@context": "http://iiif.io/api/image/3/context.json",
+        "id": base_url,
+        "type": "ImageService3",
+        "protocol": "http://iiif.io/api/image",
+        "profile": "level2",
+        "width": width,
+        "height": height,
+        "maxWidth": MAX_EDGE,
+        "maxHeight": MAX_EDGE,
+        "sizes": sorted(sizes, key=lambda s: s["width"]),
+        "tiles": [{"width": TILE_SIZE, "scaleFactors": scale_factors}],
+        "extraFormats": ["png", "webp"],
+        "extraQualities": ["color", "gray", "bitonal"],
+        "extraFeatures": ["mirroring", "regionByPct", "regionSquare", "rotationBy90s", "sizeByConfinedWh", "sizeUpscaling"],
+    }
+
+def derivative_key(path: str, *params: str) -> str:
+    st = os.stat(path)
+    return make_key(DERIVATIVE_VERSION, os.path.abspath(path), st.st_mtime_ns, st.st_size, *params)
+
+class DerivativeCache:
+    """Rendered derivatives by key: byte-bounded LRU in memory and in files under cache_dir.
+
+    Concurrent requests for the same key wait for one render instead of decoding the scan twice.
+    Disk hits refresh a file's mtime; once the files exceed max_disk_bytes the least recently used
+    are removed down to 90% of it. Several viewer processes may share cache_dir.
+    """
+
+    def __init__(self, cache_dir: str, max_memory_bytes: int = DEFAULT_MEMORY_BYTES, max_disk_bytes: int = DEFAULT_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._disk_bytes: Optional[int] = None  # running total, from a scan of cache_dir on first write
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._pending: Dict[str, threading.Lock] = {}
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _remember(self, key: str, data: bytes):
+        with self._lock:
+            if key in self._memory or len(data) > self.max_memory_bytes:
+                return
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, old = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old)
+
+    def _lookup(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+        try:
+            with open(self._file(key), "rb") as f:
+                data = f.read()
+            os.utime(self._file(key))
+        except OSError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        # (mtime, size, path) of every cached file.
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def _account(self, added: int) -> None:
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._scan())
+            else:
+                self._disk_bytes += added
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+            # Rescan, since other processes write here too, then drop the oldest files.
+            files = sorted(self._scan())
+            total = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if total <= self.max_disk_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._disk_bytes = total
+
+    def get(self, key: str, build: Callable[[], bytes]) -> bytes:
+        data = self._lookup(key)
+        if data is not None:
+            return data
+        with self._lock:
+            pending = self._pending.setdefault(key, threading.Lock())
+        with pending:
+            data = self._lookup(key)
+            if data is None:
+                data = build()
+                path = self._file(key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+                self._remember(key, data)
+                self._account(len(data))
+        with self._lock:
+            self._pending.pop(key, None)
+        return data
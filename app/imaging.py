@@ -0,0 +1,226 @@
+import math, logging, threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from PIL import Image
+
+try:
+    import pyvips  # optional: shrink-on-load for compressed masters too big to decode whole
+except Exception:
+    pyvips = None
+
+# Bounded-memory decoding for very large scans (300-600 MB preservation-master TIFFs).
+# A frame is decoded so that it holds at most decode_budget_mb of pixels, by the cheapest means:
+#   JPEG      draft(): the decoder itself scales by 1/2, 1/4 or 1/8
+#   TIFF      a reduced-resolution subfile (NewSubfileType bit 0) that fits, if the file has one;
+#             otherwise uncompressed strips/tiles are decoded a band of rows at a time and reduced
+#             as they go, so only one band is ever held at full resolution
+#   other     pyvips thumbnail when installed, else a full decode followed by a reduction
+# Pages of multi-page TIFFs are found from the IFDs alone and decoded one at a time.
+
+DEFAULT_DECODE_BUDGET_MB = 256
+BYTES_PER_PIXEL = 4  # the RGB frame plus its grayscale copy for OCR
+BAND_BYTES = 16 * 1024 ** 2
+_REDUCED = 1  # NewSubfileType: reduced-resolution version of another page
+
+log = logging.getLogger(__name__)
+
+_bomb_lock = threading.Lock()
+_bomb_state = {"depth": 0, "saved": None}
+
+@contextmanager
+def _bounded_by_budget() -> Iterator[None]:
+    # Pillow refuses frames over ~179 MP as decompression bombs; decoding here is bounded by the budget
+    # instead, so the check is lifted while any thread is inside this block.
+    with _bomb_lock:
+        if _bomb_state["depth"] == 0:
+            _bomb_state["saved"], Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+        _bomb_state["depth"] += 1
+    try:
+        yield
+    finally:
+        with _bomb_lock:
+            _bomb_state["depth"] -= 1
+            if _bomb_state["depth"] == 0:
+                Image.MAX_IMAGE_PIXELS = _bomb_state["saved"]
+
+def max_pixels(decode_budget_mb: int = DEFAULT_DECODE_BUDGET_MB) -> int:
+    return max(1, decode_budget_mb) * 1024 ** 2 // BYTES_PER_PIXEL
+
+def reduce_factor(width: int, height: int, limit: int) -> int:
+    """Smallest integer f with ceil(width / f) * ceil(height / f) <= limit."""
+    f = max(1, math.ceil(math.sqrt(width * height / limit)))
+    while math.ceil(width / f) * math.ceil(height / f) > limit:
+        f += 1
+    return f
+
+def _frames(im: Image.Image) -> List[Tuple[int, Tuple[int, int], bool]]:
+    # (index, size, reduced-resolution subfile?) for every frame; seeking only reads the IFD.
+    frames = []
+    for i in range(getattr(im, "n_frames", 1)):
+        im.seek(i)
+        subfile = getattr(im, "tag_v2", {}).get(254, 0) or 0
+        frames.append((i, im.size, bool(subfile & _REDUCED)))
+    im.seek(0)
+    return frames
+
+def page_frames(path: str) -> List[int]:
+    """Frame indices of the pages of an image file, leaving out reduced-resolution subfiles."""
+    with _bounded_by_budget(), Image.open(path) as im:
+        return [i for i, _, reduced in _frames(im) if not reduced] or [0]
+
+def is_multipage(path: str) -> bool:
+    """True for TIFFs with more than one page (reduced-resolution subfiles don't count)."""
+    return path.lower().endswith((".tif", ".tiff")) and len(page_frames(path)) > 1
+
+def frame_size(path: str, frame: int = 0) -> Tuple[int, int]:
+    """(width, height) of one frame, read from the header without decoding pixels."""
+    with _bounded_by_budget(), Image.open(path) as im:
+        im.seek(frame)
+        return im.size
+
+def _subfile(im: Image.Image, page: int, limit: int) -> Optional[int]:
+    # The largest reduced-resolution subfile of this page (the frames up to the next page) within limit.
+    frames = _frames(im)
+    width, height = frames[page][1]
+    best = None
+    for i, (w, h), reduced in frames[page + 1:]:
+        if not reduced:
+            break
+        if w * h <= limit and abs(w / h - width / height) < 0.02 and (best is None or w * h > best[1]):
+            best = (i, w * h)
+    return best[0] if best else None
+
+def _row_bytes(im: Image.Image) -> Optional[int]:
+    tags = getattr(im, "tag_v2", {})
+    if tags.get(284, 1) != 1 or tags.get(274, 1) != 1:  # separate colour planes, or rotated on load
+        return None
+    bits = tags.get(258, (8,))
+    bpp = sum(bits) if isinstance(bits, tuple) and len(bits) > 1 else (bits[0] if isinstance(bits, tuple) else bits) * tags.get(277, 1)
+    return math.ceil(im.size[0] * bpp / 8)
+
+def _bands(im: Image.Image) -> Optional[List[Tuple[int, int, List[Any]]]]:
+    """Split an uncompressed frame's tile list into (y0, y1, tiles) row bands, or None if it can't be."""
+    tiles = list(im.tile)
+    if not tiles or any(t.codec_name != "raw" or not isinstance(t.args, tuple) or t.args[-1] != 1 for t in tiles):
+        return None
+    width = im.size[0]
+    row_bytes = _row_bytes(im)
+    if row_bytes is None:
+        return None
+    rows = max(1, BAND_BYTES // row_bytes)
+    bands: List[Tuple[int, int, List[Any]]] = []
+    if all(t.extents[0] == 0 and t.extents[2] == width for t in tiles):
+        # Strips: cut anywhere, at BAND_BYTES worth of rows.
+        for y in range(0, im.size[1], rows):
+            y1 = min(y + rows, im.size[1])
+            band = []
+            for t in tiles:
+                top, bottom = max(y, t.extents[1]), min(y1, t.extents[3])
+                if top < bottom:
+                    stride = t.args[1] or row_bytes
+                    band.append(t._replace(extents=(0, top - y, width, bottom - y), offset=t.offset + (top - t.extents[1]) * stride))
+            bands.append((y, y1, band))
+        return bands
+    # Tiles: one band per row of tiles.
+    for y0 in sorted(set(t.extents[1] for t in tiles)):
+        row = [t for t in tiles if t.extents[1] == y0]
+        y1 = max(t.extents[3] for t in row)
+        bands.append((y0, y1, [t._replace(extents=(t.extents[0], 0, t.extents[2], t.extents[3] - y0)) for t in row]))
+    return bands
+
+def _decode_band(path: str, frame: int, y0: int, y1: int, tiles: List[Any], mode: str) -> Image.Image:
+    with Image.open(path) as im:
+        im.seek(frame)
+        # Decode just these rows: the tile list and frame size are narrowed to the band.
+        im.tile = tiles
+        im._size = im._tile_size = (im.size[0], y1 - y0)
+        im.load()
+        return _convert(im, mode)
+
+def _banded(path: str, im: Image.Image, frame: int, f: int, mode: str) -> Optional[Image.Image]:
+    bands = _bands(im)
+    if bands is None:
+        return None
+    width, height = im.size
+    out = Image.new(mode, (math.ceil(width / f), math.ceil(height / f)))
+    carry, y_out = None, 0
+    for y0, y1, tiles in bands:
+        band = _decode_band(path, frame, y0, y1, tiles, mode)
+        if carry is not None:
+            joined = Image.new(mode, (width, carry.height + band.height))
+            joined.paste(carry, (0, 0))
+            joined.paste(band, (0, carry.height))
+            band = joined
+        usable = band.height // f * f
+        if usable:
+            out.paste(band.crop((0, 0, width, usable)).reduce(f), (0, y_out))
+            y_out += usable // f
+        carry = band.crop((0, usable, width, band.height)) if usable < band.height else None
+        del band
+    if carry is not None:
+        out.paste(carry.reduce(f), (0, y_out))
+    return out
+
+def _vips(path: str, frame: int, width: int, height: int, mode: str) -> Image.Image:
+    v = pyvips.Image.thumbnail(f"{path}[page={frame}]", width, height=height, size="down")
+    if v.format != "uchar":
+        v = v.cast("uchar")
+    bands = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[v.bands]
+    return Image.frombytes(bands, (v.width, v.height), v.write_to_memory()).convert(mode)
+
+def _working_mode(im: Image.Image) -> str:
+    return "L" if im.mode in ("1", "L", "I", "F") or im.mode.startswith("I;16") else "RGB"
+
+def _convert(im: Image.Image, mode: str) -> Image.Image:
+    # 16-bit samples are scaled to 8 bits rather than clipped.
+    if im.mode.startswith("I;16") or im.mode == "I":
+        im = im.convert("I").point(lambda v: v * (1 / 256))
+    return im.convert(mode)
+
+def open_frame(path: str, frame: int = 0, decode_budget_mb: int = DEFAULT_DECODE_BUDGET_MB,
+               info: Optional[Dict[str, Any]] = None) -> Image.Image:
+    """Decode one frame as an L or RGB image of at most max_pixels(decode_budget_mb) pixels.
+
+    info, when given, receives the frame's full "size" and the decode "method".
+    """
+    limit = max_pixels(decode_budget_mb)
+    with _bounded_by_budget(), Image.open(path) as im:
+        im.seek(frame)
+        width, height = im.size
+        mode = _working_mode(im)
+        f = reduce_factor(width, height, limit)
+        method, out = "full", None
+        if f > 1 and im.format == "JPEG":
+            im.draft(mode, (math.ceil(width / f), math.ceil(height / f)))
+            method = "draft"
+        elif f > 1:
+            sub = _subfile(im, frame, limit) if im.format == "TIFF" else None
+            im.seek(frame if sub is None else sub)
+            if sub is not None:
+                method = "subfile"
+            else:
+                out = _banded(path, im, frame, f, mode)
+                method = "banded"
+                if out is None and pyvips is not None:
+                    out = _vips(path, frame, math.ceil(width / f), math.ceil(height / f), mode)
+                    method = "vips"
+                elif out is None:
+                    method = "full"  # compressed and no pyvips: the whole frame is decoded once
+                    log.warning("%s: frame %d (%dx%d) decoded whole, about %d MB against a %d MB budget; "
+                                "install pyvips to shrink it on load", path, frame, width, height,
+                                width * height * BYTES_PER_PIXEL // 1024 ** 2, decode_budget_mb)
+        if out is None:
+            im.load()
+            out = _convert(im, mode)
+        elif out.mode != mode:
+            out = _convert(out, mode)
+    if out.width * out.height > limit:
+        out = out.reduce(reduce_factor(out.width, out.height, limit))
+    if info is not None:
+        info.update(size=(width, height), method=method)
+    return out
+
+def iter_pages(path: str, decode_budget_mb: int = DEFAULT_DECODE_BUDGET_MB) -> Iterator[Image.Image]:
+    """Decode the pages of a (multi-page) image one at a time, each within the budget."""
+    for frame in page_frames(path):
+        yield open_frame(path, frame, decode_budget_mb)
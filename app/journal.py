@@ -0,0 +1,57 @@
+import os, time, sqlite3, threading
+from typing import Any, Dict, List, Optional
+
+# Durable per-file job journal: pending -> running -> done | failed, with attempt count and last error.
+# Lives next to the envelopes (<out_dir>/.journal.sqlite3) so it travels with them.
+
+JOURNAL_FILE = ".journal.sqlite3"
+STATES = ("pending", "running", "done", "failed")
+
+class JobJournal:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " path TEXT PRIMARY KEY, sha256 TEXT, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT, updated REAL NOT NULL)"
+        )
+
+    @classmethod
+    def for_output(cls, out_dir: str) -> "JobJournal":
+        return cls(os.path.join(out_dir, JOURNAL_FILE))
+
+    def mark(self, path: str, state: str, sha256: Optional[str] = None, error: Optional[str] = None, attempts: int = 0) -> None:
+        """Record a transition; attempts is added to the stored count, error replaces last_error when given."""
+        assert state in STATES, state
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (path, sha256, state, attempts, last_error, updated) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(path) DO UPDATE SET state=excluded.state, attempts=jobs.attempts + excluded.attempts,"
+                " sha256=COALESCE(excluded.sha256, jobs.sha256),"
+                " last_error=CASE WHEN excluded.state='done' THEN NULL ELSE COALESCE(excluded.last_error, jobs.last_error) END,"
+                " updated=excluded.updated",
+                (path, sha256, state, attempts, error, time.time()),
+            )
+
+    def get(self, path: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT path, sha256, state, attempts, last_error, updated FROM jobs WHERE path=?", (path,)).fetchone()
+        return dict(zip(("path", "sha256", "state", "attempts", "last_error", "updated"), row)) if row else None
+
+    def summary(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {state: n for state, n in rows}
+
+    def failed(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT path, attempts, last_error FROM jobs WHERE state='failed' ORDER BY path").fetchall()
+        return [{"path": p, "attempts": a, "last_error": e} for p, a, e in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
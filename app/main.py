@@ -1,11 +1,22 @@
-import os, json, argparse
+import os, argparse, cProfile, itertools
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import Iterable, Iterator, List, Optional
 
-from .schema import LOC15_SCHEMA
-from .ocr import tesseract_ocr, pil_bytes
-from .ai_metadata import extract_metadata, transcribe_with_model
-from .gdrive import pull_files_from_folder
+from .pipeline import process_path, run_batch
+from .batch import submit, collect
+from .journal import JobJournal
+from .ratelimit import DEFAULT_RETRIES
+from .cache import ResultCache, DEFAULT_CACHE_DIR
+from .ocr import DEFAULT_MAX_EDGE, PAYLOAD_FORMATS, OcrEngine
+from .pdf import DEFAULT_PDF_DPI, DEFAULT_PDF_MAX_PAGES
+from .imaging import DEFAULT_DECODE_BUDGET_MB
+from .gdrive import sync_folder
+from .metrics import Metrics
+from .store import ResultStore
+from .exporters import EXPORT_FORMATS, export_format, export_samples
+from .grouping import DEFAULT_GROUP_PATTERN, Item, compile_pattern, group_paths, item_name
+from .validation import revalidate
+from .dedup import BANDS, DEFAULT_MAX_DISTANCE, PerceptualIndex, backfill, cluster_report
 
 try:
     from dotenv import load_dotenv
@@ -13,96 +24,202 @@ try:
 except Exception:
     pass  # Fall back to system env vars if python-dotenv not available
 
-try:
-    from jsonschema import Draft7Validator
-except Exception:
-    Draft7Validator = None
-
-def _validate(obj: Dict[str, Any]) -> str:
-    if Draft7Validator is None:
-        return ""
-    v = Draft7Validator(LOC15_SCHEMA)
-    errs = sorted(v.iter_errors(obj), key=lambda e: e.path)
-    return "; ".join([f"{'.'.join(map(str, e.path))}: {e.message}" for e in errs])
-
-def process_path(path: str, out_dir: str, collection: str, repository: str, permalink: str, model: str) -> None:
-    p = Path(path)
-    if not p.exists():
-        print(f"Skip missing: {p}")
-        return
-    
-    # Check if output already exists
-    out = Path(out_dir) / f"{p.stem}.loc15.json"
-    if out.exists():
-        print(f"⊘ Skipping {p.name} (already processed)")
-        return
-    
-    # OCR first
-    text, conf = tesseract_ocr(str(p))
-    img_bytes = pil_bytes(str(p))
-    if len(text.strip()) < 25:
-        try:
-            t = transcribe_with_model(img_bytes, model=model)
-            if len(t) > len(text):
-                text = t
-                conf = max(conf, 85.0)
-        except Exception:
-            pass
-    # AI metadata
-    md = extract_metadata(img_bytes, text, filename=p.name, model=model, known_collection=collection, known_repository=repository, known_permalink=permalink)
-    # Envelope & validate
-    envelope = {"metadata": md, "context": {"filename": p.name, "processing_confidence": float(conf), "model": model}}
-    err = _validate(md)
-    if err:
-        envelope["context"]["validation_error"] = err
-    # write
-    os.makedirs(out_dir, exist_ok=True)
-    out.write_text(json.dumps(envelope, ensure_ascii=False, indent=2), encoding="utf-8")
-    print(f"✓ {p.name} -> {out}")
-
 def is_supported(name: str) -> bool:
     name = name.lower()
     return name.endswith((".png",".jpg",".jpeg",".tif",".tiff",".bmp",".gif",".webp",".pdf"))
 
 def main():
     ap = argparse.ArgumentParser(description="mini_loc15: tiny OCR + AI LOC15 metadata pipeline")
+    ap.add_argument("command", nargs="?", default="run", choices=["run", "submit", "collect", "import-json", "export-json", "export", "dedup-report", "revalidate"],
+                    help="run: process now (default); submit: upload metadata requests as an offline batch; collect: write envelopes for finished batches; "
+                         "import-json/export-json: copy <stem>.loc15.json files from/to --json-dir into/out of the result store; "
+                         "export: write catalog rows (SAMPLE_HEADERS) to --export-file as CSV, JSONL or Parquet; "
+                         "dedup-report: list clusters of near-duplicate images in the result store; "
+                         "revalidate: normalize and re-check every stored envelope against the current schema, without model calls")
     ap.add_argument("--in", dest="inp", default="", help="Local file or directory")
-    ap.add_argument("--out", dest="out_dir", default="./out", help="Output directory")
+    ap.add_argument("--out", dest="out_dir", default="./out", help="Output directory (holds the result store, loc15.sqlite3)")
+    ap.add_argument("--json-dir", default="", help="import-json/export-json: directory of per-file envelopes (default: --out)")
+    ap.add_argument("--export-file", default="", help="export: output file; the format follows the extension unless --export-format is given")
+    ap.add_argument("--export-format", choices=EXPORT_FORMATS, default=None, help="export: csv, jsonl or parquet")
+    ap.add_argument("--status", choices=["all", "valid", "invalid"], default="all", help="export: filter on schema validation (default: all)")
+    ap.add_argument("--date-from", default=None, help="export: earliest item date, ISO prefix (e.g. 1937 or 1937-06)")
+    ap.add_argument("--date-to", default=None, help="export: latest item date, ISO prefix, inclusive")
+    ap.add_argument("--watermark", default="", help="export: only items changed since the time recorded in this file, which is then advanced")
+    ap.add_argument("--dry-run", action="store_true", help="revalidate: report what would change without writing")
+    ap.add_argument("--single-call", action="store_true", help="Weak OCR: take the transcript from the metadata call instead of a separate transcription call")
+    ap.add_argument("--dedup", action="store_true", help="Reuse the metadata of an already processed near-duplicate image (perceptual hash) instead of calling the model")
+    ap.add_argument("--dedup-distance", type=int, default=DEFAULT_MAX_DISTANCE, help=f"Max pHash Hamming distance (of 64 bits, at most 7) for --dedup and dedup-report (default: {DEFAULT_MAX_DISTANCE})")
+    ap.add_argument("--group", action="store_true", help="Process recto/verso and numbered pages of one object as a single item (one model call, one envelope)")
+    ap.add_argument("--group-pattern", default=DEFAULT_GROUP_PATTERN, help="Regex on file stems with (?P<object>...) naming the item and (?P<part>...) ordering its files (default: _Recto/_Verso/_Front/_Back/_p2 suffixes)")
     ap.add_argument("--gdrive", action="store_true", help="Fetch from Google Drive folder (env GDRIVE_FOLDER_ID) to a temp dir first")
     ap.add_argument("--model", default="gpt-4o", help="OpenAI model (default: gpt-4o)")
     ap.add_argument("--collection", default="", help="Known collection (optional)")
     ap.add_argument("--repository", default="", help="Known repository (optional)")
     ap.add_argument("--permalink", default="", help="Known permalink (optional)")
     ap.add_argument("--dltemp", default="./_gdrive", help="Temp dir for Google Drive downloads")
+    ap.add_argument("--gdrive-workers", type=int, default=4, help="Parallel Google Drive downloads (default: 4)")
+    ap.add_argument("--workers", type=int, default=1, help="OCR/image-prep processes (0 = one per core; default: 1)")
+    ap.add_argument("--api-concurrency", type=int, default=1, help="Concurrent OpenAI requests (default: 1)")
+    ap.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help=f"Retries per model call on 429s, timeouts and 5xx, with exponential backoff (default: {DEFAULT_RETRIES})")
+    ap.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Content-addressed OCR/model result cache (default: ./.cache)")
+    ap.add_argument("--cache-max-mb", type=int, default=2048, help="Evict least-recently-used cache entries beyond this size (default: 2048)")
+    ap.add_argument("--no-cache", action="store_true", help="Disable the result cache")
+    ap.add_argument("--image-max-edge", type=int, default=DEFAULT_MAX_EDGE, help=f"Downscale model payloads to this long edge in px (default: {DEFAULT_MAX_EDGE})")
+    ap.add_argument("--image-token-budget", type=int, default=0, help="Further downscale until the estimated image tokens fit this budget (default: off)")
+    ap.add_argument("--image-format", choices=sorted(PAYLOAD_FORMATS), default="jpeg", help="Model payload encoding (default: jpeg)")
+    ap.add_argument("--image-quality", type=int, default=85, help="Model payload quality 1-100 (default: 85)")
+    ap.add_argument("--decode-budget-mb", type=int, default=DEFAULT_DECODE_BUDGET_MB, help=f"Per-worker pixel memory for decoding one image or page; larger scans are decoded at reduced resolution (default: {DEFAULT_DECODE_BUDGET_MB})")
+    ap.add_argument("--pdf-dpi", type=int, default=DEFAULT_PDF_DPI, help=f"PDF rasterization resolution (default: {DEFAULT_PDF_DPI})")
+    ap.add_argument("--batch-dir", default="./batches", help="submit/collect: where batch request files and manifests are kept")
+    ap.add_argument("--wait", action="store_true", help="collect: keep polling until every submitted batch has finished")
+    ap.add_argument("--pdf-max-pages", type=int, default=DEFAULT_PDF_MAX_PAGES, help=f"Leading PDF pages sent to the model as a montage (default: {DEFAULT_PDF_MAX_PAGES})")
+    ap.add_argument("--trace", default="", help="Append per-file, per-stage timings, bytes, token usage and retries to this JSONL file")
+    ap.add_argument("--metrics-file", default="", help="Write per-stage totals in Prometheus textfile format (e.g. for node_exporter)")
+    ap.add_argument("--profile", default="", help="Run under cProfile and dump stats to this file (inspect with python -m pstats)")
     args = ap.parse_args()
+    if args.pdf_max_pages < 1:
+        ap.error("--pdf-max-pages must be at least 1")
+    if args.decode_budget_mb < 16:
+        ap.error("--decode-budget-mb must be at least 16")
+    if not 0 <= args.dedup_distance < BANDS:
+        ap.error(f"--dedup-distance must be between 0 and {BANDS - 1}")
+    try:
+        compile_pattern(args.group_pattern)
+    except Exception as e:
+        ap.error(f"--group-pattern: {e}")
 
-    paths: List[str] = []
+    if args.command in ("import-json", "export-json"):
+        store = ResultStore.for_output(args.out_dir)
+        json_dir = args.json_dir or args.out_dir
+        if args.command == "import-json":
+            print(f"✓ Imported {store.import_dir(json_dir)} envelopes from {json_dir} into {store.path}")
+        else:
+            print(f"✓ Exported {store.export_dir(json_dir)} envelopes from {store.path} to {json_dir}")
+        return
+    if args.command == "export":
+        if not args.export_file:
+            ap.error("export needs --export-file")
+        try:
+            export_format(args.export_file, args.export_format or "")
+        except (ValueError, RuntimeError) as e:
+            ap.error(f"--export-file: {e}")
+        store = ResultStore.open(args.out_dir)
+        valid = {"all": None, "valid": True, "invalid": False}[args.status]
+        n = export_samples(store, args.export_file, args.export_format or "", valid=valid, date_from=args.date_from,
+                           date_to=args.date_to, watermark=args.watermark, workers=args.workers or (os.cpu_count() or 1))
+        print(f"✓ Exported {n} rows from {store.path} to {args.export_file}")
+        return
+    if args.command == "revalidate":
+        store = ResultStore.open(args.out_dir)
+        report = revalidate(store, workers=args.workers or (os.cpu_count() or 1), dry_run=args.dry_run)
+        for field, n in report["fields"].most_common():
+            print(f"  {field}: {n}")
+        verb = "Would update" if args.dry_run else "Updated"
+        print(f"✓ {verb} {report['updated']} of {report['checked']} envelopes in {store.path}; {report['invalid']} still fail validation")
+        return
+    if args.command == "dedup-report":
+        store = ResultStore.open(args.out_dir)
+        index = PerceptualIndex.for_output(args.out_dir)
+        # Items processed without --dedup are hashed from their source scans first.
+        n = backfill(store, index, [d for d in (args.inp, args.dltemp) if d and os.path.isdir(d)], workers=args.workers or (os.cpu_count() or 1))
+        if n:
+            print(f"→ Hashed {n} items into {index.path}")
+        clusters = cluster_report(store, index, args.dedup_distance)
+        for rows in clusters:
+            print(f"⊘ {len(rows)} near-duplicates:")
+            for r in rows:
+                link = f" → duplicate of {r['duplicate_of']}" if r["duplicate_of"] else ""
+                print(f"  {r['key']} ({r['filename']}, distance {r['distance']}){link}")
+        print(f"✓ {len(clusters)} clusters among {len(index)} hashed items")
+        return
+    # Per-file envelopes the store hasn't seen (a first run, a git pull) are imported, so they count as processed.
+    ResultStore.open(args.out_dir)
+
+    cache = None if args.no_cache else ResultCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    if args.command == "collect":
+        collect(args.batch_dir, args.out_dir, cache=cache, wait=args.wait)
+        return
+
+    local: List[str] = []
+    drive: Optional[Iterator[str]] = None
+    listing: List[str] = []  # every input path, filled in by sync_folder before its first file
+    metrics = Metrics(args.trace, labels={"collection": args.collection, "model": args.model})
 
     if args.gdrive:
         folder_id = os.getenv("GDRIVE_FOLDER_ID", "")
         if not folder_id:
             raise RuntimeError("Set GDRIVE_FOLDER_ID when using --gdrive")
-        dl = pull_files_from_folder(folder_id, args.dltemp)
-        paths.extend([p for p in dl if is_supported(p)])
+        # Lazy: each file is handed to processing as soon as its download completes.
+        drive = (p for p in sync_folder(folder_id, args.dltemp, workers=args.gdrive_workers, metrics=metrics, listing=listing) if is_supported(p))
 
     if args.inp:
         p = Path(args.inp)
         if p.is_file() and is_supported(str(p)):
-            paths.append(str(p))
+            local.append(str(p))
         elif p.is_dir():
             for x in p.rglob("*"):
                 if x.is_file() and is_supported(str(x)):
-                    paths.append(str(x))
+                    local.append(str(x))
 
-    if not paths:
+    if drive is None and not local:
         print("No inputs. Use --in <path> and/or --gdrive.")
         return
+    paths: Iterable[Item] = local if drive is None else itertools.chain(drive, local)
+    if args.group:
+        # Local inputs are all known up front; Drive files are grouped as they arrive, each object
+        # released once every member in the folder listing has landed.
+        listing.extend(local)
+        paths = list(group_paths(local, args.group_pattern)) if drive is None else group_paths(paths, args.group_pattern, expected=listing)
 
-    for path in paths:
-        try:
-            process_path(path, args.out_dir, args.collection, args.repository, args.permalink, args.model)
-        except Exception as e:
-            print(f"✗ {path}: {e}")
+    image_opts = {"max_edge": args.image_max_edge, "token_budget": args.image_token_budget,
+                  "fmt": args.image_format, "quality": args.image_quality, "decode_budget_mb": args.decode_budget_mb}
+    pdf_opts = {"dpi": args.pdf_dpi, "max_pages": args.pdf_max_pages}
+    dedup = args.dedup_distance if args.dedup else None
+
+    if args.command == "submit":
+        submit(paths, args.out_dir, args.batch_dir, args.collection, args.repository, args.permalink, args.model,
+               cache=cache, image_opts=image_opts, pdf_opts=pdf_opts, dedup=dedup)
+        return
+
+    journal = JobJournal.for_output(args.out_dir)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if args.workers != 1 or args.api_concurrency > 1:
+            run_batch(paths, args.out_dir, args.collection, args.repository, args.permalink, args.model,
+                      workers=args.workers, api_concurrency=args.api_concurrency, cache=cache, image_opts=image_opts, pdf_opts=pdf_opts,
+                      journal=journal, retries=args.retries, metrics=metrics, dedup=dedup, single_call=args.single_call)
+        else:
+            # One file at a time: one set of warm OCR workers for the whole run spreads each PDF's pages over the cores.
+            engine = OcrEngine() if (os.cpu_count() or 1) > 1 else None
+            try:
+                for path in paths:
+                    try:
+                        process_path(path, args.out_dir, args.collection, args.repository, args.permalink, args.model, cache=cache, image_opts=image_opts,
+                                     pdf_opts=dict(pdf_opts, ocr_engine=engine), journal=journal, retries=args.retries, metrics=metrics, dedup=dedup,
+                                     single_call=args.single_call)
+                    except Exception as e:
+                        print(f"✗ {path if isinstance(path, str) else item_name(path)}: {e}")
+            finally:
+                if engine is not None:
+                    engine.close()
+    finally:
+        if profiler is not None:
+            # Only the parent process is profiled; pool workers show up as time spent waiting on futures.
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"→ Profile written to {args.profile}")
+        print(metrics.summary())
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file)
+        metrics.close()
+
+    failures = journal.failed()
+    if failures:
+        print(f"✗ {len(failures)} files failed and will be retried on the next run (journal: {journal.path})")
+        for f in failures[:10]:
+            print(f"  {f['path']} (attempts: {f['attempts']}): {f['last_error']}")
 
 if __name__ == "__main__":
     main()
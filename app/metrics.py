@@ -0,0 +1,113 @@
+import os, json, time, threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+# Per-stage instrumentation. Stages run in pool processes and API threads, so they append plain
+# event dicts to job["events"] via timed(); the parent process hands each finished job to
+# Metrics.record_job, which writes the JSONL trace and keeps the per-stage totals that end up in
+# the Prometheus textfile and the end-of-run summary.
+
+STAGES = ("download", "hash", "dedup", "decode", "ocr", "encode", "transcribe", "extract", "validate", "write")
+_COUNTERS = ("seconds", "bytes", "prompt_tokens", "completion_tokens", "cached_tokens", "retries", "rate_limited")
+
+@contextmanager
+def timed(events: Optional[List[Dict[str, Any]]], stage: str, **fields: Any) -> Iterator[Dict[str, Any]]:
+    """Time a block and append {"stage", "seconds", **fields} to events; the block may add fields."""
+    t0 = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        if events is not None:
+            events.append({"stage": stage, "seconds": time.perf_counter() - t0, **fields})
+
+def usage_fields(resp: Any) -> Dict[str, int]:
+    """Token counts from an OpenAI response's usage block (zeros when absent)."""
+    u = getattr(resp, "usage", None)
+    details = getattr(u, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": int(getattr(u, "prompt_tokens", 0) or 0),
+        "completion_tokens": int(getattr(u, "completion_tokens", 0) or 0),
+        "cached_tokens": int(getattr(details, "cached_tokens", 0) or 0),
+    }
+
+def _label_value(value: Any) -> str:
+    # Exposition-format escaping: backslash, double quote and newline.
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    def __init__(self, trace_path: str = "", labels: Optional[Dict[str, str]] = None):
+        self.labels = {k: v for k, v in (labels or {}).items() if v}
+        self.started = time.time()
+        self.totals: Dict[str, Dict[str, float]] = {}
+        self.files: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._trace = open(trace_path, "a", encoding="utf-8") if trace_path else None
+
+    def record(self, file: str, stage: str, seconds: float, **fields: Any) -> None:
+        with self._lock:
+            t = self.totals.setdefault(stage, {"calls": 0})
+            t["calls"] += 1
+            t["seconds"] = t.get("seconds", 0.0) + seconds
+            for k in _COUNTERS[1:]:
+                if fields.get(k):
+                    t[k] = t.get(k, 0) + fields[k]
+            if self._trace is not None:
+                line = {"ts": round(time.time(), 3), "file": file, "stage": stage, "seconds": round(seconds, 4), **self.labels, **fields}
+                self._trace.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    def record_job(self, job: Dict[str, Any], status: str) -> None:
+        for ev in job.get("events", []):
+            ev = dict(ev)
+            self.record(job.get("filename", ""), ev.pop("stage"), ev.pop("seconds"), **ev)
+        self.count(status)
+
+    def count(self, status: str) -> None:
+        with self._lock:
+            self.files[status] = self.files.get(status, 0) + 1
+
+    def write_prometheus(self, path: str) -> None:
+        """Write totals in the node_exporter textfile format."""
+        base = ",".join(f'{k}="{_label_value(v)}"' for k, v in self.labels.items())
+        def lbl(**extra):
+            parts = [base] if base else []
+            parts += [f'{k}="{_label_value(v)}"' for k, v in extra.items()]
+            return "{" + ",".join(parts) + "}"
+        lines = []
+        def metric(name, help_, rows):
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{labels} {value}" for labels, value in rows)
+        with self._lock:
+            metric("loc15_stage_calls_total", "Stage executions.", [(lbl(stage=s), t["calls"]) for s, t in self.totals.items()])
+            metric("loc15_stage_seconds_total", "Wall time spent per stage.", [(lbl(stage=s), round(t["seconds"], 4)) for s, t in self.totals.items()])
+            for k in _COUNTERS[1:]:
+                rows = [(lbl(stage=s), t[k]) for s, t in self.totals.items() if t.get(k)]
+                if rows:
+                    metric(f"loc15_stage_{k}_total", f"{k.replace('_', ' ').capitalize()} per stage.", rows)
+            metric("loc15_files_total", "Files by outcome.", [(lbl(status=s), n) for s, n in self.files.items()])
+            lines.append("# HELP loc15_run_seconds Wall time of the run.")
+            lines.append("# TYPE loc15_run_seconds gauge")
+            lines.append(f"loc15_run_seconds{lbl()} {round(time.time() - self.started, 3)}")
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+    def summary(self) -> str:
+        wall = time.time() - self.started
+        with self._lock:
+            done = self.files.get("done", 0)
+            rows = [f"  {'stage':<11}{'calls':>7}{'total s':>10}{'mean s':>9}{'MB':>9}{'prompt tok':>12}{'cached tok':>12}{'compl tok':>11}{'retries':>9}"]
+            for s in sorted(self.totals, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+                t = self.totals[s]
+                rows.append(f"  {s:<11}{t['calls']:>7}{t['seconds']:>10.1f}{t['seconds'] / t['calls']:>9.2f}"
+                            f"{t.get('bytes', 0) / 1024 ** 2:>9.1f}{int(t.get('prompt_tokens', 0)):>12}{int(t.get('cached_tokens', 0)):>12}"
+                            f"{int(t.get('completion_tokens', 0)):>11}{int(t.get('retries', 0)):>9}")
+            files = ", ".join(f"{n} {s}" for s, n in sorted(self.files.items()))
+        rate = f", {done / wall:.2f} files/s" if wall and done else ""
+        return "\n".join([f"Metrics ({files or 'no files'}; {wall:.1f}s wall{rate}):"] + rows)
+
+    def close(self) -> None:
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
@@ -1,28 +1,192 @@
-import io
-from typing import Tuple
+import io, math, os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from PIL import Image, ImageOps
+from .schema import OCR_MIN_CONFIDENCE
+from .metrics import timed
+from .imaging import DEFAULT_DECODE_BUDGET_MB, open_frame
 try:
     import pytesseract
 except ImportError:
     pytesseract = None
+try:
+    import tesserocr  # optional: keeps the Tesseract engine loaded between pages
+except ImportError:
+    tesserocr = None
+
+_TESS_API = None  # per-process tesserocr handle, created on first use
+
+# Bump when OCR output or confidence semantics change so cached OCR results are not reused.
+OCR_ENGINE_VERSION = "tesseract-words-1"
+
+# Vision models downscale anything larger than this before tokenizing, so bigger payloads
+# only cost upload time. See estimate_image_tokens for the tiling rule.
+DEFAULT_MAX_EDGE = 2048
+PAYLOAD_FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Approximate high-detail image tokens: fit in 2048x2048, shortest side to 768, 170 per 512px tile + 85."""
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * math.ceil(w / 512) * math.ceil(h / 512)
+
+def payload_dimensions(width: int, height: int, max_edge: int = DEFAULT_MAX_EDGE, token_budget: int = 0) -> Tuple[int, int]:
+    """Largest size within max_edge (and token_budget, if set) that keeps the aspect ratio."""
+    scale = min(1.0, max_edge / max(width, height)) if max_edge else 1.0
+    if token_budget:
+        while scale > 0.05 and estimate_image_tokens(round(width * scale), round(height * scale)) > token_budget:
+            scale *= 0.9
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def encode_payload(rgb: Image.Image, source_bytes: int, max_edge: int = DEFAULT_MAX_EDGE, token_budget: int = 0,
+                   fmt: str = "jpeg", quality: int = 85) -> Dict[str, Any]:
+    """Downscale and encode an RGB image for the model.
+
+    Returns the encoded bytes, their mime type and a size report
+    (source file bytes, payload bytes, bytes saved, original and payload dimensions).
+    """
+    pil_fmt, mime = PAYLOAD_FORMATS[fmt.lower()]
+    size = rgb.size
+    target = payload_dimensions(*size, max_edge=max_edge, token_budget=token_budget)
+    small = rgb.resize(target, Image.LANCZOS, reducing_gap=3.0) if target != size else rgb
+    bio = io.BytesIO()
+    small.save(bio, format=pil_fmt, quality=quality, optimize=True)
+    data = bio.getvalue()
+    return {
+        "bytes": data,
+        "mime": mime,
+        "source_bytes": source_bytes,
+        "payload_bytes": len(data),
+        "saved_bytes": source_bytes - len(data),
+        "size": size,
+        "payload_size": target,
+    }
+
+def prepare_image(img_path: str, events: Optional[List[Dict[str, Any]]] = None,
+                  decode_budget_mb: int = DEFAULT_DECODE_BUDGET_MB, **payload_opts: Any) -> Tuple[Image.Image, Dict[str, Any]]:
+    """Decode once; return a grayscale image for OCR and a downscaled model payload.
+
+    The frame is decoded at the largest integer reduction that fits decode_budget_mb (see imaging.open_frame),
+    so huge masters never sit in memory at full resolution.
+    payload_opts are passed to encode_payload (max_edge, token_budget, fmt, quality);
+    decode/encode timings are appended to events (see metrics.timed).
+    """
+    source_bytes = os.path.getsize(img_path)
+    with timed(events, "decode", bytes=source_bytes) as ev:
+        info: Dict[str, Any] = {}
+        im = open_frame(img_path, 0, decode_budget_mb, info)
+        gray = im if im.mode == "L" else ImageOps.grayscale(im)
+        rgb = im if im.mode == "RGB" else im.convert("RGB")
+        del im
+        ev["method"] = info["method"]
+    with timed(events, "encode") as ev:
+        payload = encode_payload(rgb, source_bytes, **payload_opts)
+        ev["bytes"] = payload["payload_bytes"]
+    payload["size"] = info["size"]
+    return gray, payload
+
+def format_payload_report(payload: Dict[str, Any]) -> str:
+    saved = payload["saved_bytes"] / max(1, payload["source_bytes"]) * 100.0
+    w, h = payload["payload_size"]
+    return f"payload {payload['payload_bytes'] / 1024:.0f} KB {w}x{h}, saved {payload['saved_bytes'] / 1024:.0f} KB ({saved:.0f}%)"
+
+def _init_tesseract() -> None:
+    global _TESS_API
+    if _TESS_API is None and tesserocr is not None:
+        _TESS_API = tesserocr.PyTessBaseAPI()
 
-def pil_bytes(img_path: str) -> bytes:
-    with Image.open(img_path) as im:
-        if im.mode not in ("RGB","RGBA"):
-            im = im.convert("RGB")
-        bio = io.BytesIO()
-        im.save(bio, format="PNG")
-        return bio.getvalue()
+def init_ocr_worker() -> None:
+    """Process-pool initializer: load the Tesseract model once so every later page reuses it.
 
-def tesseract_ocr(img_path: str) -> Tuple[str, float]:
-    if pytesseract is None:
+    With tesserocr installed the engine stays resident in the worker; with only pytesseract each
+    page still runs the tesseract binary, limited to one thread so per-core workers don't oversubscribe.
+    """
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    _init_tesseract()
+
+def _text_from_data(data: Dict[str, List[Any]]) -> str:
+    # Rebuild reading text from image_to_data rows: words joined per line, blank line between blocks.
+    lines: List[str] = []
+    last_block = last_line = None
+    for i, word in enumerate(data["text"]):
+        if not word or not word.strip():
+            continue
+        block = (data["page_num"][i], data["block_num"][i])
+        line = block + (data["par_num"][i], data["line_num"][i])
+        if line != last_line:
+            if last_block is not None and block != last_block:
+                lines.append("")
+            lines.append(word)
+        else:
+            lines[-1] += " " + word
+        last_block, last_line = block, line
+    return "\n".join(lines) + ("\n" if lines else "")
+
+def word_confidence(words: List[Tuple[str, float]]) -> float:
+    """Mean Tesseract word confidence (0-100), weighted by word length; 0.0 when nothing was read."""
+    scored = [(len(w), c) for w, c in words if w.strip() and c >= 0]
+    total = sum(n for n, _ in scored)
+    return sum(n * c for n, c in scored) / total if total else 0.0
+
+def _recognize(gray: Image.Image) -> Tuple[str, float]:
+    if _TESS_API is not None:
+        _TESS_API.SetImage(gray)
+        text = _TESS_API.GetUTF8Text()
+        level = tesserocr.RIL.WORD
+        words = [(w.GetUTF8Text(level) or "", w.Confidence(level))
+                 for w in tesserocr.iterate_level(_TESS_API.GetIterator(), level)]
+        return text, word_confidence(words)
+    data = pytesseract.image_to_data(gray, output_type=pytesseract.Output.DICT)
+    words = [(w, float(c)) for w, c in zip(data["text"], data["conf"])]
+    return _text_from_data(data), word_confidence(words)
+
+def tesseract_ocr(img: Union[str, Image.Image]) -> Tuple[str, float]:
+    """OCR a path or an already-decoded image; returns (text, mean word confidence)."""
+    if pytesseract is None and tesserocr is None:
         return "", 0.0
     try:
-        with Image.open(img_path) as im:
-            gray = ImageOps.grayscale(im)
-            text = pytesseract.image_to_string(gray)
-            alnum = sum(c.isalnum() for c in text)
-            conf = min(95.0, max(5.0, (alnum / max(1, len(text))) * 100.0)) if text else 0.0
-            return text, conf
+        _init_tesseract()
+        if isinstance(img, Image.Image):
+            return _recognize(img if img.mode == "L" else ImageOps.grayscale(img))
+        with Image.open(img) as im:
+            return _recognize(ImageOps.grayscale(im))
     except Exception:
         return "", 0.0
+
+def ocr_is_weak(text: str, conf: float, min_conf: float = OCR_MIN_CONFIDENCE) -> bool:
+    """True when OCR read nothing or its word confidence is too low to trust without a model transcription."""
+    return not text.strip() or conf < min_conf
+
+class OcrEngine:
+    """Warm Tesseract workers, one per core, for OCRing many images per call.
+
+    with OcrEngine() as engine:
+        for text, conf in engine.map(images): ...
+    """
+
+    def __init__(self, workers: int = 0):
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_ocr_worker)
+
+    def map(self, images: Iterable[Union[str, Image.Image]], window: int = 0) -> Iterator[Tuple[str, float]]:
+        """OCR images in input order, pulling at most `window` (default 2 per worker) ahead of the consumer."""
+        window = window or 2 * self.workers
+        futures: Deque[Future] = deque()
+        for img in images:
+            futures.append(self._pool.submit(tesseract_ocr, img))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+    def close(self) -> None:
+        self._pool.shutdown(cancel_futures=True)
+
+    def __enter__(self) -> "OcrEngine":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,115 @@
+import math, os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from PIL import Image, ImageOps
+from .ocr import OcrEngine, DEFAULT_MAX_EDGE, encode_payload, tesseract_ocr
+from .metrics import timed
+from .imaging import DEFAULT_DECODE_BUDGET_MB, max_pixels
+
+try:
+    import pypdfium2 as pdfium
+except Exception:
+    pdfium = None
+
+DEFAULT_PDF_DPI = 200
+DEFAULT_PDF_MAX_PAGES = 4
+
+def is_pdf(path: str) -> bool:
+    return path.lower().endswith(".pdf")
+
+def iter_pdf_pages(path: str, dpi: int = DEFAULT_PDF_DPI, decode_budget_mb: int = DEFAULT_DECODE_BUDGET_MB) -> Iterator[Image.Image]:
+    """Rasterize pages one at a time; only the page being consumed is held in memory.
+
+    Oversized pages (posters, maps) are rendered below dpi so each bitmap fits decode_budget_mb.
+    """
+    if pdfium is None:
+        raise RuntimeError("pypdfium2 not installed. pip install pypdfium2")
+    limit = max_pixels(decode_budget_mb)
+    pdf = pdfium.PdfDocument(path)
+    try:
+        for i in range(len(pdf)):
+            page = pdf[i]
+            try:
+                w, h = page.get_size()
+                bitmap = page.render(scale=min(dpi / 72, math.sqrt(limit / max(1.0, w * h))))
+                im = bitmap.to_pil()
+                bitmap.close()
+            finally:
+                page.close()
+            yield im
+    finally:
+        pdf.close()
+
+def page_montage(pages: List[Image.Image], max_edge: int = DEFAULT_MAX_EDGE) -> Image.Image:
+    """Tile page thumbnails left-to-right, top-to-bottom on a white sheet."""
+    cols = math.ceil(math.sqrt(len(pages)))
+    rows = math.ceil(len(pages) / cols)
+    cell_w = max(p.width for p in pages)
+    cell_h = max(p.height for p in pages)
+    sheet = Image.new("RGB", (cols * cell_w, rows * cell_h), "white")
+    for i, p in enumerate(pages):
+        sheet.paste(p, ((i % cols) * cell_w, (i // cols) * cell_h))
+    sheet.thumbnail((max_edge, max_edge))
+    return sheet
+
+def prepare_pages(path: str, pages: Iterator[Image.Image], max_pages: int = DEFAULT_PDF_MAX_PAGES, ocr: bool = True,
+                  ocr_workers: int = 1, events: Optional[List[Dict[str, Any]]] = None,
+                  ocr_engine: Optional[OcrEngine] = None, **payload_opts: Any) -> Tuple[str, float, Dict[str, Any]]:
+    """Stream a document's pages once: OCR every page and build the model payload from the first max_pages pages.
+
+    pages is consumed lazily and OCR'd on ocr_engine, the run's warm Tesseract workers, or on
+    ocr_workers workers started for this document, so peak memory is a few pages regardless of document length. The payload is the single page, or a montage of the
+    leading pages for multi-page documents. With ocr=False only the leading pages are decoded.
+    Returns (text with [page N] markers, length-weighted mean confidence, payload dict).
+    Decode+OCR ("ocr") and montage encoding ("encode") timings are appended to events.
+    """
+    max_edge = payload_opts.get("max_edge") or DEFAULT_MAX_EDGE
+    thumbs: List[Image.Image] = []
+    cols = math.ceil(math.sqrt(max_pages))
+
+    def gray_pages() -> Iterator[Image.Image]:
+        for i, page in enumerate(pages):
+            if i < max_pages:
+                thumb = page.convert("RGB")
+                thumb.thumbnail((max_edge // cols, max_edge // cols))
+                thumbs.append(thumb)
+            elif not ocr:
+                return
+            if ocr:
+                yield ImageOps.grayscale(page)
+            del page
+
+    texts: List[str] = []
+    weighted = chars = 0.0
+    with timed(events, "ocr" if ocr else "decode", bytes=os.path.getsize(path)) as ev:
+        if ocr:
+            if ocr_engine is not None:
+                results = list(ocr_engine.map(gray_pages()))
+            elif ocr_workers > 1:
+                with OcrEngine(ocr_workers) as engine:
+                    results = list(engine.map(gray_pages()))
+            else:
+                results = (tesseract_ocr(g) for g in gray_pages())
+            for n, (text, conf) in enumerate(results, 1):
+                texts.append(f"[page {n}]\n{text.strip()}")
+                weighted += conf * len(text.strip())
+                chars += len(text.strip())
+            ev["pages"] = len(texts)
+        else:
+            for _ in gray_pages():
+                pass
+    if not thumbs:
+        raise RuntimeError(f"{path}: document has no pages")
+    with timed(events, "encode") as ev:
+        sheet = thumbs[0] if len(thumbs) == 1 else page_montage(thumbs, max_edge)
+        payload = encode_payload(sheet, os.path.getsize(path), **payload_opts)
+        ev["bytes"] = payload["payload_bytes"]
+    payload["pages"] = len(texts) if ocr else None
+    return "\n\n".join(texts), (weighted / chars if chars else 0.0), payload
+
+def prepare_pdf(path: str, dpi: int = DEFAULT_PDF_DPI, max_pages: int = DEFAULT_PDF_MAX_PAGES, ocr: bool = True,
+                ocr_workers: int = 1, events: Optional[List[Dict[str, Any]]] = None,
+                decode_budget_mb: int = DEFAULT_DECODE_BUDGET_MB, ocr_engine: Optional[OcrEngine] = None,
+                **payload_opts: Any) -> Tuple[str, float, Dict[str, Any]]:
+    """prepare_pages over a PDF rasterized at dpi."""
+    return prepare_pages(path, iter_pdf_pages(path, dpi, decode_budget_mb), max_pages, ocr, ocr_workers, events,
+                         ocr_engine, **payload_opts)
@@ -0,0 +1,425 @@
+import os, queue, signal, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from typing import Iterable, Dict, Any, List, Optional, Sized, Tuple
+
+from .pdf import is_pdf, prepare_pdf, prepare_pages
+from .imaging import DEFAULT_DECODE_BUDGET_MB, is_multipage, iter_pages
+from .ocr import tesseract_ocr, prepare_image, format_payload_report, ocr_is_weak, init_ocr_worker, OCR_ENGINE_VERSION
+from .ai_metadata import extract_metadata, transcribe_with_model, prompt_version
+from .cache import ResultCache, file_sha256, make_key
+from .journal import JobJournal
+from .ratelimit import AdaptiveLimiter, DEFAULT_RETRIES, call_with_retries
+from .metrics import Metrics, timed
+from .store import ResultStore, result_key
+from .dedup import PerceptualIndex, image_hashes, find_duplicate, to_hex
+from .grouping import Item, item_name, item_paths
+from .validation import validate
+
+# Stages shared by the sequential path (process_path) and the batch engine (run_batch).
+# prepare_stage is CPU-bound and runs in a process pool; model_stage is network-bound and
+# runs in a thread pool; write_envelope always runs in the parent process.
+
+def metadata_key(sha256: str, model: str, collection: str, repository: str, permalink: str) -> str:
+    return make_key(sha256, model, prompt_version(), collection, repository, permalink)
+
+def _already_processed(store: ResultStore, key: str, sha256: str) -> bool:
+    # Envelopes written before content hashing have no sha256; keep treating those as done.
+    # Empty metadata means an earlier run failed (before failures stopped being written), so redo it.
+    envelope = store.get(key)
+    if envelope is None:
+        return False
+    return bool(envelope.get("metadata")) and envelope.get("context", {}).get("sha256", sha256) == sha256
+
+def prepare_stage(path: str, out_dir: str, collection: str, repository: str, permalink: str, model: str,
+                  cache: Optional[ResultCache] = None, image_opts: Optional[Dict[str, Any]] = None,
+                  pdf_opts: Optional[Dict[str, Any]] = None, dedup: Optional[int] = None) -> Dict[str, Any]:
+    """Hash the file, then either reuse cached metadata or decode it once for OCR and the model payload.
+
+    image_opts are passed to ocr.encode_payload (max_edge, token_budget, fmt, quality) and set the
+    decode_budget_mb; pdf_opts to pdf.prepare_pdf (dpi, max_pages, ocr_workers, ocr_engine), whose
+    max_pages and OCR workers also apply to multi-page TIFFs.
+    With dedup set, images also get perceptual hashes, and an image within that Hamming distance of
+    an already processed one reuses its metadata (job["context"]["duplicate_of"]) instead of OCR and model calls.
+    """
+    p = Path(path)
+    job: Dict[str, Any] = {"path": path, "filename": p.name, "events": []}
+    with timed(job["events"], "hash", bytes=p.stat().st_size):
+        job["sha256"] = file_sha256(path)
+    if _already_processed(ResultStore.for_output(out_dir), result_key(path), job["sha256"]):
+        job["skip"] = True
+        return job
+    if dedup is not None and not is_pdf(path):
+        with timed(job["events"], "dedup"):
+            ph, dh = image_hashes(path)
+        job["context"] = {"phash": to_hex(ph), "dhash": to_hex(dh)}
+    if cache is not None:
+        hit = cache.get("metadata", metadata_key(job["sha256"], model, collection, repository, permalink))
+        if hit is not None:
+            job["metadata"], job["conf"] = hit["metadata"], hit["confidence"]
+            return job
+    if "context" in job:
+        with timed(job["events"], "dedup"):
+            match = find_duplicate(ResultStore.for_output(out_dir), PerceptualIndex.for_output(out_dir), result_key(path), ph, dh, dedup)
+        if match is not None:
+            original, dist, envelope = match
+            job["metadata"], job["conf"] = envelope["metadata"], envelope.get("context", {}).get("processing_confidence", 0.0)
+            job["context"].update(duplicate_of=original, duplicate_distance=dist)
+            return job
+    job["text"], job["conf"], payload = _decode(path, job["sha256"], job["events"], cache, image_opts, pdf_opts)
+    job["img_bytes"] = payload.pop("bytes")
+    job["payload"] = payload
+    return job
+
+def _decode(path: str, sha256: str, events: List[Dict[str, Any]], cache: Optional[ResultCache],
+            image_opts: Optional[Dict[str, Any]], pdf_opts: Optional[Dict[str, Any]]) -> Tuple[str, float, Dict[str, Any]]:
+    # One decode for OCR (unless cached) and the model payload: (text, confidence, payload).
+    ocr_key = make_key(sha256, OCR_ENGINE_VERSION)
+    ocr = cache.get("ocr", ocr_key) if cache is not None else None
+    if is_pdf(path):
+        text, conf, payload = prepare_pdf(path, ocr=ocr is None, events=events, **(pdf_opts or {}), **(image_opts or {}))
+    elif is_multipage(path):
+        # Multi-page TIFFs are paged like PDFs, one frame decoded at a time.
+        opts = dict(image_opts or {})
+        pages = iter_pages(path, opts.pop("decode_budget_mb", DEFAULT_DECODE_BUDGET_MB))
+        page_opts = {k: v for k, v in (pdf_opts or {}).items() if k != "dpi"}
+        text, conf, payload = prepare_pages(path, pages, ocr=ocr is None, events=events, **page_opts, **opts)
+    else:
+        gray, payload = prepare_image(path, events=events, **(image_opts or {}))
+        text, conf = "", 0.0
+        if ocr is None:
+            with timed(events, "ocr"):
+                text, conf = tesseract_ocr(gray)
+        del gray
+    if ocr is None:
+        ocr = {"text": text, "confidence": conf}
+        if cache is not None:
+            cache.put("ocr", ocr_key, ocr)
+    return ocr["text"], ocr["confidence"], payload
+
+def prepare_group(key: str, paths: List[str], out_dir: str, collection: str, repository: str, permalink: str, model: str,
+                  cache: Optional[ResultCache] = None, image_opts: Optional[Dict[str, Any]] = None,
+                  pdf_opts: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """prepare_stage for one object scanned as several files (grouping.group_paths), stored under key.
+
+    img_bytes holds one payload per page and text the pages' OCR under [filename] markers. The job's
+    sha256 covers every member, so a changed or newly added side reprocesses the whole object.
+    """
+    names = [Path(p).name for p in paths]
+    job: Dict[str, Any] = {"path": paths[0], "key": key, "filename": names[0], "events": [], "context": {"files": names}}
+    hashes = []
+    for path in paths:
+        with timed(job["events"], "hash", bytes=os.path.getsize(path)):
+            hashes.append(file_sha256(path))
+    job["sha256"] = hashes[0] if len(hashes) == 1 else make_key("group", *hashes)
+    if _already_processed(ResultStore.for_output(out_dir), key, job["sha256"]):
+        job["skip"] = True
+        return job
+    if cache is not None:
+        hit = cache.get("metadata", metadata_key(job["sha256"], model, collection, repository, permalink))
+        if hit is not None:
+            job["metadata"], job["conf"] = hit["metadata"], hit["confidence"]
+            return job
+    texts, payloads = [], []
+    weighted = chars = 0.0
+    for path, name, sha in zip(paths, names, hashes):
+        text, conf, payload = _decode(path, sha, job["events"], cache, image_opts, pdf_opts)
+        texts.append(f"[{name}]\n{text.strip()}")
+        weighted += conf * len(text.strip())
+        chars += len(text.strip())
+        payloads.append(payload)
+    job["text"], job["conf"] = "\n\n".join(texts), (weighted / chars if chars else 0.0)
+    job["img_bytes"] = [payload.pop("bytes") for payload in payloads]
+    job["payload"] = {k: sum(payload[k] for payload in payloads) for k in ("source_bytes", "payload_bytes", "saved_bytes")}
+    job["payload"].update(payload_size=payloads[0]["payload_size"], pages=len(payloads))
+    return job
+
+def prepare_item(item: Item, out_dir: str, collection: str, repository: str, permalink: str, model: str,
+                 cache: Optional[ResultCache] = None, image_opts: Optional[Dict[str, Any]] = None,
+                 pdf_opts: Optional[Dict[str, Any]] = None, dedup: Optional[int] = None) -> Dict[str, Any]:
+    """prepare_stage for a path, prepare_group for an (object key, member paths) item.
+
+    Perceptual dedup applies to single files only.
+    """
+    if isinstance(item, str):
+        return prepare_stage(item, out_dir, collection, repository, permalink, model, cache, image_opts, pdf_opts, dedup)
+    return prepare_group(item[0], item[1], out_dir, collection, repository, permalink, model, cache, image_opts, pdf_opts)
+
+def _prompt_filename(job: Dict[str, Any]) -> str:
+    return ", ".join(job["context"]["files"]) if "files" in job.get("context", {}) else job["filename"]
+
+def _transcribe(job: Dict[str, Any], model: str, cache: Optional[ResultCache],
+                limiter: Optional[AdaptiveLimiter], retries: int) -> str:
+    key = make_key(job["sha256"], model)
+    if cache is not None:
+        hit = cache.get("transcript", key)
+        if hit is not None:
+            return hit
+    t = _api_call("transcribe", job, lambda usage: transcribe_with_model(job["img_bytes"], model=model, usage=usage), limiter, retries)
+    if cache is not None and t:
+        cache.put("transcript", key, t)
+    return t
+
+def _api_call(stage: str, job: Dict[str, Any], fn, limiter: Optional[AdaptiveLimiter], retries: int) -> Any:
+    # fn(usage) makes one model call; timing, token usage and retries are recorded as a stage event.
+    stats: Dict[str, int] = {}
+    with timed(job["events"], stage) as ev:
+        usage: Dict[str, int] = {}
+        try:
+            return call_with_retries(lambda: fn(usage), limiter, retries, stats)
+        finally:
+            ev.update(usage)
+            ev.update(stats)
+            for k, v in stats.items():
+                job["stats"][k] = job["stats"].get(k, 0) + v
+
+def model_stage(job: Dict[str, Any], collection: str, repository: str, permalink: str, model: str,
+                cache: Optional[ResultCache] = None, limiter: Optional[AdaptiveLimiter] = None,
+                retries: int = DEFAULT_RETRIES, single_call: bool = False) -> Dict[str, Any]:
+    """Call the model (transcription fallback + extraction) and build the envelope.
+
+    With single_call, weak OCR gets no separate transcription call: the extraction request says the
+    OCR is unreliable and the transcript comes back in its transcript/text_reading fields.
+    Transient API failures are retried with backoff; a call that still fails raises instead of
+    producing an empty envelope. Retry and 429 counts are left in job["stats"].
+    """
+    text, conf = job.get("text", ""), job["conf"]
+    md = job.get("metadata")
+    job.setdefault("stats", {})
+    job.setdefault("events", [])
+    if md is None:
+        weak = ocr_is_weak(text, conf)
+        if weak and not single_call:
+            try:
+                t = _transcribe(job, model, cache, limiter, retries)
+                if len(t) > len(text):
+                    text = t
+                    conf = max(conf, 85.0)
+            except Exception:
+                pass
+        # AI metadata
+        reliable = not (weak and single_call)
+        md = _api_call("extract", job, lambda usage: extract_metadata(job["img_bytes"], text, filename=_prompt_filename(job), model=model, known_collection=collection, known_repository=repository, known_permalink=permalink, raise_errors=True, usage=usage, ocr_reliable=reliable),
+                       limiter, retries)
+        if not reliable and len(md.get("transcript") or "") > len(text):
+            conf = max(conf, 85.0)
+        if cache is not None and md:
+            cache.put("metadata", metadata_key(job["sha256"], model, collection, repository, permalink), {"metadata": md, "confidence": conf})
+    return make_envelope(md, job["filename"], conf, model, job["sha256"], job["events"], job.get("context"))
+
+def make_envelope(md: Dict[str, Any], filename: str, conf: float, model: str, sha256: str,
+                  events: Optional[List[Dict[str, Any]]] = None, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # Envelope & validate; context adds perceptual hashes, duplicate links or group members from prepare_*.
+    envelope = {"metadata": md, "context": {"filename": filename, "processing_confidence": float(conf), "model": model, "sha256": sha256}}
+    envelope["context"].update(context or {})
+    with timed(events, "validate"):
+        err = validate(md)
+    if err:
+        envelope["context"]["validation_error"] = err
+    return envelope
+
+def write_envelope(envelope: Dict[str, Any], out_dir: str, path: str, events: Optional[List[Dict[str, Any]]] = None,
+                   key: Optional[str] = None) -> str:
+    """Upsert the envelope for path into out_dir's result store (and its perceptual hashes, if any); returns its key.
+
+    key defaults to result_key(path). A grouped object's envelope replaces any per-file envelopes of its members.
+    """
+    key = key or result_key(path)
+    ctx = envelope.get("context", {})
+    store = ResultStore.for_output(out_dir)
+    with timed(events, "write") as ev:
+        ev["bytes"] = store.put(key, envelope, path)
+        if "phash" in ctx:
+            PerceptualIndex.for_output(out_dir).put(key, int(ctx["phash"], 16), int(ctx["dhash"], 16))
+        for name in ctx.get("files", []):
+            if result_key(name) != key and result_key(name) in store:
+                store.delete(result_key(name))
+    return key
+
+def _attempts(job: Optional[Dict[str, Any]]) -> int:
+    # API attempts spent on a job: one per model_stage run plus its retries (0 if served from cache).
+    if not job or "img_bytes" not in job:
+        return 0
+    return 1 + job.get("stats", {}).get("retries", 0)
+
+def _mark(journal: Optional[JobJournal], item: Item, state: str, sha256: Optional[str] = None, **kw: Any) -> None:
+    # The journal tracks files; every member of a grouped object shares the object's state.
+    if journal is None:
+        return
+    if isinstance(item, str):
+        journal.mark(item, state, sha256=sha256, **kw)
+    else:
+        for path in item[1]:
+            journal.mark(path, state, **kw)
+
+def process_path(path: Item, out_dir: str, collection: str, repository: str, permalink: str, model: str,
+                 cache: Optional[ResultCache] = None, image_opts: Optional[Dict[str, Any]] = None,
+                 pdf_opts: Optional[Dict[str, Any]] = None, journal: Optional[JobJournal] = None,
+                 retries: int = DEFAULT_RETRIES, metrics: Optional[Metrics] = None, dedup: Optional[int] = None,
+                 single_call: bool = False) -> None:
+    """Process one path, or one grouped object given as (object key, member paths).
+
+    Pages are OCR'd in this process unless pdf_opts carries an ocr_engine (or ocr_workers) to spread them over.
+    """
+    missing = [p for p in item_paths(path) if not Path(p).exists()]
+    if missing:
+        print(f"Skip missing: {', '.join(missing)}")
+        return
+    name = item_name(path)
+
+    job: Optional[Dict[str, Any]] = None
+    _mark(journal, path, "pending")
+    try:
+        job = prepare_item(path, out_dir, collection, repository, permalink, model, cache, image_opts, pdf_opts, dedup)
+        if job.get("skip"):
+            _mark(journal, path, "done", sha256=job["sha256"])
+            if metrics is not None:
+                metrics.record_job(job, "skipped")
+            print(f"⊘ Skipping {name} (already processed)")
+            return
+        _mark(journal, path, "running", sha256=job["sha256"])
+        envelope = model_stage(job, collection, repository, permalink, model, cache, retries=retries, single_call=single_call)
+        key = write_envelope(envelope, out_dir, job["path"], job["events"], job.get("key"))
+    except Exception as e:
+        _mark(journal, path, "failed", error=str(e), attempts=_attempts(job))
+        if metrics is not None and job is not None:
+            metrics.record_job(job, "failed")
+        raise
+    _mark(journal, path, "done", attempts=_attempts(job))
+    if metrics is not None:
+        metrics.record_job(job, _done_status(job))
+    print(f"✓ {name} -> {key}{report_suffix(job)}")
+
+def _done_status(job: Dict[str, Any]) -> str:
+    if "payload" in job:
+        return "done"
+    return "deduped" if "duplicate_of" in job.get("context", {}) else "cached"
+
+def report_suffix(job: Dict[str, Any]) -> str:
+    ctx = job.get("context", {})
+    if "payload" in job:
+        pages = f"{len(ctx['files'])} files, " if len(ctx.get("files", ())) > 1 else ""
+        return f" ({pages}{format_payload_report(job['payload'])})"
+    if "duplicate_of" in ctx:
+        return f" (duplicate of {ctx['duplicate_of']}, distance {ctx['duplicate_distance']})"
+    return " (cached)"
+
+def _init_worker() -> None:
+    # Pool workers leave Ctrl-C to the parent, which cancels outstanding work and shuts down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_ocr_worker()
+
+def _prefetch(paths: Iterable[str], maxsize: int) -> "queue.Queue[Any]":
+    # Pull inputs on a background thread so a slow source (e.g. a Drive sync) overlaps with processing.
+    # The bounded queue blocks the producer when processing falls behind.
+    q: "queue.Queue[Any]" = queue.Queue(maxsize=maxsize)
+    def feed():
+        try:
+            for path in paths:
+                q.put(path)
+        except Exception as e:
+            print(f"✗ Input source failed: {e}")
+        finally:
+            q.put(_END)
+    threading.Thread(target=feed, name="inputs", daemon=True).start()
+    return q
+
+_END = object()
+
+def run_batch(paths: Iterable[Item], out_dir: str, collection: str, repository: str, permalink: str, model: str,
+              workers: int = 0, api_concurrency: int = 4, cache: Optional[ResultCache] = None,
+              image_opts: Optional[Dict[str, Any]] = None, pdf_opts: Optional[Dict[str, Any]] = None,
+              journal: Optional[JobJournal] = None, retries: int = DEFAULT_RETRIES, metrics: Optional[Metrics] = None,
+              dedup: Optional[int] = None, single_call: bool = False) -> None:
+    """Process paths with OCR/image prep in a process pool and model calls in a bounded thread pool.
+
+    api_concurrency is the ceiling for concurrent model calls; an AIMD limiter starts at half of it,
+    halves on 429s and grows back while calls succeed.
+
+    paths may be a lazy iterable (such as gdrive.sync_folder); files start processing as they arrive.
+    An item may also be a grouped object, (object key, member paths), processed as one file.
+    Files are taken in input order; at most workers + 2 * api_concurrency files are in flight at once,
+    so prepared image payloads never pile up faster than the API can consume them.
+    """
+    workers = workers or os.cpu_count() or 1
+    api_concurrency = max(1, api_concurrency)
+    # Files are already spread across one worker per core, so PDF pages are OCR'd inside each worker.
+    pdf_opts = {k: v for k, v in (pdf_opts or {}).items() if k != "ocr_engine"}
+    pdf_opts["ocr_workers"] = 1
+
+    total = len(paths) if isinstance(paths, Sized) else None
+    done = skipped = failed = 0
+    source_bytes = payload_bytes = 0
+    window = workers + 2 * api_concurrency
+    source = _prefetch(paths, window)
+    exhausted = False
+    inflight: Dict[Any, Tuple[str, str, Optional[Dict[str, Any]]]] = {}
+    cpu = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    api = ThreadPoolExecutor(max_workers=api_concurrency, thread_name_prefix="api")
+    limiter = AdaptiveLimiter(api_concurrency, initial=max(1, api_concurrency // 2))
+
+    def progress() -> str:
+        n = done + skipped + failed
+        return f"[{n}/{total}]" if total is not None else f"[{n}]"
+
+    print(f"→ Processing {total if total is not None else 'incoming'} files ({workers} OCR workers, {api_concurrency} API workers)")
+    try:
+        while not exhausted or inflight:
+            while not exhausted and len(inflight) < window:
+                try:
+                    path = source.get(block=not inflight, timeout=0.5)
+                except queue.Empty:
+                    break
+                if path is _END:
+                    exhausted = True
+                elif not all(Path(p).exists() for p in item_paths(path)):
+                    print(f"Skip missing: {', '.join(p for p in item_paths(path) if not Path(p).exists())}")
+                else:
+                    _mark(journal, path, "pending")
+                    inflight[cpu.submit(prepare_item, path, out_dir, collection, repository, permalink, model, cache, image_opts, pdf_opts, dedup)] = ("prepare", path, None)
+            if not inflight:
+                continue
+            # Wake up periodically while inputs are still arriving so new files are picked up promptly.
+            finished, _ = wait(inflight, timeout=None if exhausted else 0.5, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                stage, path, job = inflight.pop(fut)
+                name = item_name(path)
+                try:
+                    result = fut.result()
+                    if stage == "prepare":
+                        if result.get("skip"):
+                            _mark(journal, path, "done", sha256=result["sha256"])
+                            if metrics is not None:
+                                metrics.record_job(result, "skipped")
+                            skipped += 1
+                            print(f"⊘ {progress()} Skipping {name} (already processed)")
+                            continue
+                        if "payload" in result:
+                            source_bytes += result["payload"]["source_bytes"]
+                            payload_bytes += result["payload"]["payload_bytes"]
+                        _mark(journal, path, "running", sha256=result["sha256"])
+                        inflight[api.submit(model_stage, result, collection, repository, permalink, model, cache, limiter, retries, single_call)] = ("api", path, result)
+                        continue
+                    key = write_envelope(result, out_dir, job["path"], job["events"], job.get("key"))
+                    _mark(journal, path, "done", attempts=_attempts(job))
+                    if metrics is not None:
+                        metrics.record_job(job, _done_status(job))
+                    done += 1
+                    print(f"✓ {progress()} {name} -> {key}{report_suffix(job)}")
+                except Exception as e:
+                    _mark(journal, path, "failed", error=str(e), attempts=_attempts(job))
+                    if metrics is not None:
+                        metrics.record_job(job or {"filename": name}, "failed")
+                    failed += 1
+                    print(f"✗ {progress()} {path if isinstance(path, str) else name}: {e}")
+    except KeyboardInterrupt:
+        print(f"\n✗ Interrupted: {done} written, {len(inflight)} unfinished")
+        for fut in inflight:
+            fut.cancel()
+    finally:
+        cpu.shutdown(wait=False, cancel_futures=True)
+        api.shutdown(wait=False, cancel_futures=True)
+    if exhausted and not inflight:
+        print(f"✓ Batch complete: {done} written, {skipped} skipped, {failed} failed (API concurrency settled at {limiter.limit:.1f})")
+        if source_bytes:
+            print(f"  Model payloads: {payload_bytes / 1024 ** 2:.1f} MB sent for {source_bytes / 1024 ** 2:.1f} MB of source images")
@@ -0,0 +1,102 @@
+import random, threading, time
+from typing import Any, Callable, Dict, Optional
+
+# Retry/backoff and adaptive concurrency for model calls.
+# call_with_retries retries transient failures (429, timeouts, 5xx, empty answers) with exponential
+# backoff, honouring Retry-After when the server sends one. AdaptiveLimiter is an AIMD controller:
+# it halves the number of concurrent calls when the API throttles and adds one slot per window of
+# successful calls, settling just under the account's rate limit.
+
+DEFAULT_RETRIES = 4
+BASE_DELAY = 2.0
+MAX_DELAY = 60.0
+
+def _status(e: Exception) -> Optional[int]:
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+def is_rate_limited(e: Exception) -> bool:
+    return _status(e) == 429 or type(e).__name__ == "RateLimitError"
+
+def is_retryable(e: Exception) -> bool:
+    status = _status(e)
+    return (is_rate_limited(e) or status == 408 or (status is not None and status >= 500)
+            or isinstance(e, (TimeoutError, ConnectionError))
+            or type(e).__name__ in ("APITimeoutError", "APIConnectionError", "EmptyMetadataError"))
+
+def _retry_after(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveLimiter:
+    """Caps concurrent calls at `limit`, which moves between minimum and maximum (AIMD)."""
+
+    def __init__(self, maximum: int, initial: Optional[int] = None, minimum: int = 1, cooldown: float = 2.0):
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        self.limit = float(initial if initial is not None else self.maximum)
+        self.cooldown = cooldown
+        self._active = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self._active >= max(self.minimum, int(self.limit)):
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, throttled: bool = False) -> None:
+        with self._cond:
+            self._active -= 1
+            now = time.monotonic()
+            if throttled:
+                # One decrease per burst: calls already in flight when the limit was hit will 429 too.
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def release_neutral(self) -> None:
+        """Free the slot without moving the limit: the call failed for a reason other than throttling."""
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+def call_with_retries(fn: Callable[[], Any], limiter: Optional[AdaptiveLimiter] = None, retries: int = DEFAULT_RETRIES,
+                      stats: Optional[Dict[str, int]] = None) -> Any:
+    """Call fn(), retrying transient failures; counts retries and 429s into stats when given."""
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = fn()
+        except Exception as e:
+            throttled = is_rate_limited(e)
+            if limiter is not None:
+                # Only 429s say anything about capacity; 5xx and timeouts leave the limit alone.
+                if throttled:
+                    limiter.release(throttled=True)
+                else:
+                    limiter.release_neutral()
+            if stats is not None and throttled:
+                stats["rate_limited"] = stats.get("rate_limited", 0) + 1
+            if attempt >= retries or not is_retryable(e):
+                raise
+            delay = _retry_after(e) or min(MAX_DELAY, BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+            attempt += 1
+            if stats is not None:
+                stats["retries"] = stats.get("retries", 0) + 1
+            time.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.release()
+        return result
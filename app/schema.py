@@ -9,7 +9,7 @@ LOC15_SCHEMA: Dict[str, Any] = {
         "contributors":{"type": ["array", "null"], "items": {"type": "string"}, "maxItems": 8},
         "correspondents":{"type": ["array", "null"], "items": {"type": "string"}, "maxItems": 12},
         "publisher":{"type": ["string", "null"], "maxLength": 160},
-        "date":   {"type": ["string", "null"], "pattern": r"^(\\d{4}(-\\d{2}(-\\d{2})?)?|undated)$"},
+        "date":   {"type": ["string", "null"], "pattern": r"^(\d{4}(-\d{2}(-\d{2})?)?|undated)$"},
         "place":  {"type": ["string", "null"], "maxLength": 160},
         "language":{"type": ["string", "null"], "maxLength": 80},
 
@@ -55,5 +55,6 @@ LOC15_SCHEMA: Dict[str, Any] = {
 }
 
 MAX_OCR_CHARS = 12000
+OCR_MIN_CONFIDENCE = 60.0  # mean Tesseract word confidence below which a model transcription is requested
 MAX_OUTPUT_TOKENS = 4096
 DEFAULT_MODEL = "gpt-4o"
@@ -0,0 +1,499 @@
+import os, re, json, time, heapq, hashlib, sqlite3, threading
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .schema import LOC15_SCHEMA
+
+# Indexed result store: one SQLite file (<out_dir>/loc15.sqlite3) instead of one pretty-printed
+# <stem>.loc15.json per image. Items are keyed by the source file's stem, the same name the per-file
+# layout used, and hold the compact envelope plus a few denormalized columns for cheap listing, among
+# them digest, the sha256 of the compact envelope, so callers can tell changed items without reading them.
+# Field-level queries run on the envelope JSON inside SQLite. import_dir/export_dir convert to and
+# from the per-file layout, which stays the interchange format (and what the repo checks in under out/).
+
+STORE_FILE = "loc15.sqlite3"
+ENVELOPE_SUFFIX = ".loc15.json"
+LIST_COLUMNS = ("key", "filename", "sha256", "model", "confidence", "valid", "title", "date", "creator", "digest", "updated")
+CONTEXT_FIELDS = ("filename", "processing_confidence", "model", "sha256", "validation_error")
+FACETS = ("subjects", "theme", "genre", "decade", "creator")
+FACET_SAMPLE = 500  # facet counts over at most this many hits
+TOTAL_CAP = 5000  # hits counted and ranked: beyond this many, the total is a lower bound
+_COLUMNS = ("key", "filename", "path", "sha256", "model", "confidence", "valid", "title", "date", "creator", "envelope", "digest",
+            "updated")
+# Update times are store write times and strictly increase: a write is stamped after every committed one,
+# even if the clock steps back, so "updated <= MAX(updated) read earlier" never misses a later write.
+_STAMP = "max(?, coalesce((SELECT MAX(updated) FROM items), 0) + 1e-6)"
+_UPDATE = (f"UPDATE items SET {', '.join(f'{c}=?' for c in _COLUMNS if c not in ('key', 'path', 'updated'))},"
+           f" updated={_STAMP} WHERE key=?")
+# An upsert without a source path (an imported envelope) keeps the path already recorded, and one that
+# changes neither the envelope nor the path is a no-op, so rewriting an unchanged item keeps its update time.
+_UPSERT = (f"INSERT INTO items ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * (len(_COLUMNS) - 1))}, {_STAMP})"
+           f" ON CONFLICT(key) DO UPDATE SET "
+           + ", ".join("path=coalesce(nullif(excluded.path, ''), items.path)" if c == "path" else f"{c}=excluded.{c}" for c in _COLUMNS[1:])
+           + " WHERE items.digest IS NOT excluded.digest OR (excluded.path != '' AND items.path IS NOT excluded.path)")
+# files: the size and mtime of each per-file envelope when it was last imported or exported, with the
+# update time of its item then, so import_dir/export_dir can skip files already in sync without reading them.
+_SYNC = ("INSERT INTO files (path, key, size, mtime_ns, updated) SELECT ?, key, ?, ?, updated FROM items WHERE key = ?"
+         " ON CONFLICT(path) DO UPDATE SET key=excluded.key, size=excluded.size, mtime_ns=excluded.mtime_ns, updated=excluded.updated")
+
+# Search: items_fts (FTS5, rowid = items.id) and facets are maintained by triggers on items, so every
+# writer keeps them current. Upserts keep an item's id stable; INSERT OR REPLACE would bypass the
+# delete trigger. items_fts keeps 2- and 3-character prefix indexes for search-as-you-type.
+_FTS_INSERT = "INSERT INTO items_fts (rowid, title, description, subjects, transcript, text_reading)"
+
+def _md(row: str, field: str) -> str:
+    return f"json_extract({row}.envelope, '$.metadata.{field}')"
+
+def _fts_values(row: str) -> str:
+    return (f"{row}.id, coalesce({_md(row, 'title')}, '') || ' ' || coalesce({_md(row, 'generated_title')}, ''), {_md(row, 'description')},"
+            f" (SELECT group_concat(value, ' ; ') FROM json_each({row}.envelope, '$.metadata.subjects')),"
+            f" {_md(row, 'transcript')}, {_md(row, 'text_reading')}")
+
+def _index_sql(row: str) -> str:
+    arrays = " UNION ALL ".join(
+        f"SELECT {row}.id, '{f}', value FROM json_each({row}.envelope, '$.metadata.{f}') WHERE type = 'text' AND value != ''"
+        for f in ("subjects", "theme", "genre"))
+    return (
+        f"{_FTS_INSERT} VALUES ({_fts_values(row)});"
+        f" INSERT INTO facets (item, facet, value) {arrays}"
+        f" UNION ALL SELECT {row}.id, 'creator', {_md(row, 'creator')} WHERE coalesce({_md(row, 'creator')}, '') != ''"
+        f" UNION ALL SELECT {row}.id, 'decade', substr({_md(row, 'date')}, 1, 3) || '0s'"
+        f" WHERE {_md(row, 'date')} GLOB '[0-9][0-9][0-9][0-9]*';"
+    )
+
+def _unindex_sql(row: str) -> str:
+    return f"DELETE FROM items_fts WHERE rowid = {row}.id; DELETE FROM facets WHERE item = {row}.id;"
+
+_UPDATE_TRIGGER = f"CREATE TRIGGER IF NOT EXISTS items_au AFTER UPDATE ON items BEGIN {_unindex_sql('old')} {_index_sql('new')} END"
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS items ("
+    " id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, filename TEXT, path TEXT, sha256 TEXT, model TEXT, confidence REAL,"
+    " valid INTEGER NOT NULL, title TEXT, date TEXT, creator TEXT, envelope TEXT NOT NULL, digest TEXT,"
+    " updated REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS items_sha256 ON items (sha256)",
+    "CREATE INDEX IF NOT EXISTS items_updated ON items (updated)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5"
+    " (title, description, subjects, transcript, text_reading, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    "CREATE TABLE IF NOT EXISTS facets (item INTEGER NOT NULL, facet TEXT NOT NULL, value TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS facets_value ON facets (facet, value, item)",
+    "CREATE INDEX IF NOT EXISTS facets_item ON facets (item, facet, value)",
+    f"CREATE TRIGGER IF NOT EXISTS items_ai AFTER INSERT ON items BEGIN {_index_sql('new')} END",
+    f"CREATE TRIGGER IF NOT EXISTS items_ad AFTER DELETE ON items BEGIN {_unindex_sql('old')} END",
+    _UPDATE_TRIGGER,
+    "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, key TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,"
+    " updated REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS files_key ON files (key)",
+)
+
+def _digest(envelope_json: str) -> str:
+    return hashlib.sha256(envelope_json.encode("utf-8")).hexdigest()
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        columns = [r[1] for r in conn.execute("PRAGMA table_info(items)")]
+        legacy = bool(columns) and "id" not in columns
+        if legacy:
+            # First layout: keyed rows without an explicit id and no search index. Rebuild it;
+            # copying the rows through the insert trigger fills the index.
+            conn.execute("DROP INDEX IF EXISTS items_sha256")
+            conn.execute("DROP INDEX IF EXISTS items_updated")
+            conn.execute("ALTER TABLE items RENAME TO items_v1")
+        elif columns and "digest" not in columns:
+            conn.execute("ALTER TABLE items ADD COLUMN digest TEXT")
+        fts = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'items_fts'").fetchone()
+        reindex = fts is not None and "prefix" not in fts[0]
+        if reindex:
+            # Search index from before prefix indexes: rebuilt from the items below.
+            conn.execute("DROP TABLE items_fts")
+        for stmt in _SCHEMA:
+            conn.execute(stmt)
+        if reindex:
+            conn.execute(f"{_FTS_INSERT} SELECT {_fts_values('items')} FROM items")
+        if legacy:
+            copied = [c for c in _COLUMNS if c != "digest"]
+            conn.execute(f"INSERT INTO items ({', '.join(copied)}) SELECT {', '.join(copied)} FROM items_v1")
+            conn.execute("DROP TABLE items_v1")
+        if columns and "digest" not in columns:
+            # Fill in digests without the update trigger: the search index doesn't change.
+            conn.create_function("envelope_digest", 1, _digest, deterministic=True)
+            conn.execute("DROP TRIGGER items_au")
+            conn.execute("UPDATE items SET digest = envelope_digest(envelope)")
+            conn.execute(_UPDATE_TRIGGER)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _fts_query(text: str) -> str:
+    # Words are quoted (no FTS syntax from user input) and ANDed; the last one matches as a prefix once
+    # it has 3 characters, so "le" doesn't expand to every term starting with it.
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{w}"' + ("*" if i == len(words) - 1 and len(w) >= 3 else "") for i, w in enumerate(words))
+
+def _top_facets(rows: Sequence[Tuple[str, str, int]], facet_limit: int) -> Dict[str, List[List[Any]]]:
+    facets: Dict[str, List[List[Any]]] = {f: [] for f in FACETS}
+    for facet, value, n in rows:
+        if len(facets[facet]) < facet_limit:
+            facets[facet].append([value, n])
+    return facets
+
+def result_key(path: str) -> str:
+    return Path(path).stem
+
+def envelope_json(envelope: Dict[str, Any]) -> str:
+    return json.dumps(envelope, ensure_ascii=False, indent=2)
+
+def write_json(envelope: Dict[str, Any], out: Path) -> None:
+    # Write to a sibling temp file and rename so an interrupted run never leaves a truncated envelope behind.
+    os.makedirs(out.parent, exist_ok=True)
+    tmp = out.with_name(out.name + ".tmp")
+    tmp.write_text(envelope_json(envelope), encoding="utf-8")
+    os.replace(tmp, out)
+
+def _json_path(field: str) -> str:
+    if field in LOC15_SCHEMA["properties"]:
+        return f"$.metadata.{field}"
+    if field in CONTEXT_FIELDS:
+        return f"$.context.{field}"
+    raise ValueError(f"unknown field: {field}")
+
+class ResultStore:
+    _open: Dict[Tuple[int, str], "ResultStore"] = {}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    @classmethod
+    def for_output(cls, out_dir: str) -> "ResultStore":
+        """The store for out_dir, shared by every caller in this process."""
+        path = os.path.abspath(os.path.join(out_dir, STORE_FILE))
+        key = (os.getpid(), path)
+        if key not in cls._open:
+            cls._open[key] = cls(path)
+        return cls._open[key]
+
+    @classmethod
+    def open(cls, out_dir: str) -> "ResultStore":
+        """for_output, importing per-file envelopes in out_dir that were added or changed since the store last saw them.
+
+        This covers the first use of an existing per-file layout and envelopes changed since, e.g. by a
+        git pull of the checked-in out/, whatever their mtimes.
+        """
+        store = cls.for_output(out_dir)
+        n = store.import_dir(out_dir, changed_only=True)
+        if n:
+            print(f"→ Imported {n} envelopes from {out_dir} into {store.path}")
+        return store
+
+    # Connections are per thread and per process, so the store can be handed to pool workers.
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            _migrate(conn)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _row(self, key: str, envelope: Dict[str, Any], path: str, updated: float) -> Tuple:
+        md, ctx = envelope.get("metadata") or {}, envelope.get("context") or {}
+        text = json.dumps(envelope, ensure_ascii=False, separators=(",", ":"))
+        return (key, ctx.get("filename"), path, ctx.get("sha256"), ctx.get("model"), ctx.get("processing_confidence"),
+                0 if ctx.get("validation_error") else 1, md.get("title") or md.get("generated_title"), md.get("date"),
+                md.get("creator"), text, _digest(text), updated)
+
+    def put(self, key: str, envelope: Dict[str, Any], path: str = "", updated: Optional[float] = None) -> int:
+        """Insert or replace one item; returns the stored envelope size in bytes."""
+        row = self._row(key, envelope, path, time.time() if updated is None else updated)
+        self._conn().execute(_UPSERT, row)
+        return len(row[10].encode("utf-8"))
+
+    def put_many(self, items: Sequence[Tuple[str, Dict[str, Any], str, Optional[float]]]) -> int:
+        """Upsert (key, envelope, path, updated) rows in one transaction; returns how many items changed."""
+        now = time.time()
+        return self._write((_UPSERT, [self._row(k, e, p, now if u is None else u) for k, e, p, u in items]))
+
+    def update_many(self, items: Sequence[Tuple[str, Dict[str, Any]]]) -> None:
+        """Replace the envelopes of existing items, keeping their recorded source paths."""
+        now = time.time()
+        rows = []
+        for key, envelope in items:
+            row = self._row(key, envelope, "", now)
+            rows.append(row[1:2] + row[3:] + (key,))
+        self._write((_UPDATE, rows))
+
+    def _write(self, *statements: Tuple[str, Sequence[Tuple]]) -> int:
+        # executemany each (sql, rows) in one transaction; returns the rows changed by the first.
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            changed = [conn.executemany(sql, rows).rowcount for sql, rows in statements]
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return changed[0]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT envelope FROM items WHERE key=?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def path_of(self, key: str) -> Optional[str]:
+        """Source path recorded when the item was written ("" for imported envelopes)."""
+        row = self._conn().execute("SELECT path FROM items WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def sha256(self, key: str) -> Optional[str]:
+        row = self._conn().execute("SELECT sha256 FROM items WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def delete(self, key: str) -> None:
+        self._write(("DELETE FROM items WHERE key=?", [(key,)]), ("DELETE FROM files WHERE key=?", [(key,)]))
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def __contains__(self, key: str) -> bool:
+        return self._conn().execute("SELECT 1 FROM items WHERE key=?", (key,)).fetchone() is not None
+
+    def version(self) -> Tuple[int, float]:
+        """(item count, latest update time): changes whenever an item is written or deleted.
+
+        Items written after this call get later update times, so the time is a safe export watermark.
+        """
+        n, updated = self._conn().execute("SELECT COUNT(*), COALESCE(MAX(updated), 0) FROM items").fetchone()
+        return n, updated
+
+    def list(self, columns: Sequence[str] = LIST_COLUMNS, offset: int = 0, limit: Optional[int] = None,
+             valid: Optional[bool] = None, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Summary rows ordered by key, without touching the envelopes."""
+        bad = [c for c in columns if c not in LIST_COLUMNS]
+        if bad:
+            raise ValueError(f"unknown column: {', '.join(bad)}")
+        where, args = self._where(valid, since)
+        sql = f"SELECT {', '.join(columns)} FROM items{where} ORDER BY key LIMIT ? OFFSET ?"
+        rows = self._conn().execute(sql, args + [-1 if limit is None else limit, offset]).fetchall()
+        return [dict(zip(columns, r)) for r in rows]
+
+    def iter_envelopes(self, valid: Optional[bool] = None, since: Optional[float] = None,
+                       batch: int = 500) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Stream (key, envelope) in key order, batch rows at a time."""
+        where, args = self._where(valid, since)
+        last = ""
+        while True:
+            sql = f"SELECT key, envelope FROM items{where}{' AND' if where else ' WHERE'} key > ? ORDER BY key LIMIT ?"
+            rows = self._conn().execute(sql, args + [last, batch]).fetchall()
+            for key, raw in rows:
+                yield key, json.loads(raw)
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+    def iter_batches(self, valid: Optional[bool] = None, since: Optional[float] = None, date_from: Optional[str] = None,
+                     date_to: Optional[str] = None, batch: int = 500, until: Optional[float] = None) -> Iterator[List[Tuple[str, str, float]]]:
+        """Stream lists of (key, envelope JSON text, updated) in key order, left unparsed so callers can parse in parallel."""
+        where, args = self._where(valid, since, date_from, date_to, until)
+        last = ""
+        while True:
+            sql = f"SELECT key, envelope, updated FROM items{where}{' AND' if where else ' WHERE'} key > ? ORDER BY key LIMIT ?"
+            rows = self._conn().execute(sql, args + [last, batch]).fetchall()
+            if rows:
+                yield rows
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+    def find(self, limit: Optional[int] = None, **fields: Any) -> List[str]:
+        """Keys whose metadata/context fields equal the given values; list fields match any element."""
+        clauses, args = [], []
+        for field, value in fields.items():
+            clauses.append("EXISTS (SELECT 1 FROM json_each(items.envelope, ?) WHERE json_each.value = ?)")
+            args += [_json_path(field), value]
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._conn().execute(f"SELECT key FROM items{where} ORDER BY key LIMIT ?", args + [-1 if limit is None else limit]).fetchall()
+        return [r[0] for r in rows]
+
+    @staticmethod
+    def _where(valid: Optional[bool], since: Optional[float], date_from: Optional[str] = None,
+               date_to: Optional[str] = None, until: Optional[float] = None) -> Tuple[str, List[Any]]:
+        """date_from/date_to compare ISO date prefixes, inclusive ("1938" to "1938-12" covers all of 1938).
+
+        since/until bound items.updated: since exclusive, until inclusive.
+        """
+        clauses, args = [], []
+        if valid is not None:
+            clauses.append("valid=?")
+            args.append(1 if valid else 0)
+        if since is not None:
+            clauses.append("updated>?")
+            args.append(since)
+        if until is not None:
+            clauses.append("updated<=?")
+            args.append(until)
+        if date_from or date_to:
+            clauses.append("date GLOB '[0-9][0-9][0-9][0-9]*'")
+        if date_from:
+            clauses.append("date>=?")
+            args.append(date_from)
+        if date_to:
+            clauses.append("substr(date, 1, ?)<=?")
+            args += [len(date_to), date_to]
+        return (f" WHERE {' AND '.join(clauses)}" if clauses else ""), args
+
+    def search(self, text: str = "", filters: Optional[Dict[str, Sequence[str]]] = None, offset: int = 0, limit: int = 20,
+               facet_limit: int = 10, facet_sample: int = FACET_SAMPLE, total_cap: int = TOTAL_CAP) -> Dict[str, Any]:
+        """Ranked full-text search over title, description, subjects, transcript and text_reading.
+
+        filters maps facet names (FACETS) to values an item must all have. Returns {total, total_capped,
+        items: [{key, score, snippet}], facets: {facet: [[value, count], ...]}, facets_sampled}. Hits come
+        from the newest total_cap items matching the text (or, without text, the filters); total_capped
+        says there were more. Facet counts cover every hit, or the newest facet_sample when there are more
+        (facets_sampled is then that number, else 0). Snippets mark matches with \x02 ... \x03.
+        """
+        match = _fts_query(text)
+        conditions = [(facet, value) for facet, values in (filters or {}).items() for value in values]
+        for facet, _ in conditions:
+            if facet not in FACETS:
+                raise ValueError(f"unknown facet: {facet}")
+        conn = self._conn()
+        if not match and not conditions:
+            return self._browse(conn, offset, limit, facet_limit)
+
+        # One pass over the indexes collects the hits, newest (highest id) first, with their bm25 scores;
+        # the count, the page and the facet sample all come from that list. Ranking every hit of a word
+        # found in most items would cost more than a keystroke's budget, and such a word barely moves
+        # bm25 anyway. Filters are checked per hit on the facets index, or drive the scan without text.
+        has = "EXISTS (SELECT 1 FROM facets WHERE item = {} AND facet = ? AND value = ?)"
+        args = [x for c in conditions for x in c]
+        if match:
+            where, bounds = ["items_fts MATCH ?"], [match]
+            oldest = None
+            if conditions:  # filters narrow the newest total_cap matches, so the scan stays bounded
+                oldest = conn.execute("SELECT rowid FROM items_fts WHERE items_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+                                      (match, total_cap)).fetchone()
+                if oldest:
+                    where.append("rowid > ?")
+                    bounds += oldest
+                where += [has.format("items_fts.rowid")] * len(conditions)
+            hits = conn.execute(f"SELECT rowid, bm25(items_fts, 10.0, 2.0, 4.0, 1.0, 1.0) FROM items_fts WHERE {' AND '.join(where)}"
+                                " ORDER BY rowid DESC LIMIT ?", bounds + args + [total_cap + 1]).fetchall()
+            capped = oldest is not None or len(hits) > total_cap
+        else:
+            if len(conditions) > 1:  # start from the rarest value
+                sizes = [conn.execute("SELECT COUNT(*) FROM facets WHERE facet = ? AND value = ?", c).fetchone()[0] for c in conditions]
+                args = [x for _, c in sorted(zip(sizes, conditions)) for x in c]
+            hits = [(i, 0.0) for i, in conn.execute(
+                "SELECT item FROM facets AS f WHERE facet = ? AND value = ?" + "".join(f" AND {has.format('f.item')}" for _ in conditions[1:])
+                + " ORDER BY item DESC LIMIT ?", args + [total_cap + 1])]
+            capped = len(hits) > total_cap
+        hits = hits[:total_cap]
+        ids = [i for i, _ in hits]
+        if match:
+            page = heapq.nsmallest(offset + limit, hits, key=lambda h: (h[1], -h[0]))[offset:]
+            keys = dict(conn.execute(f"SELECT id, key FROM items WHERE id IN ({', '.join('?' * len(page))})", [i for i, _ in page]))
+            rows = [(i, keys[i], score) for i, score in page if i in keys]
+        else:
+            rows = [(i, k, 0.0) for i, k in conn.execute("SELECT id, key FROM items WHERE id IN (SELECT value FROM json_each(?))"
+                                                           " ORDER BY key LIMIT ? OFFSET ?", (json.dumps(ids), limit, offset))]
+        sampled = facet_sample if len(ids) > facet_sample else 0
+        facet_rows = conn.execute("SELECT facet, facets.value, COUNT(*) AS n FROM json_each(?) AS h CROSS JOIN facets ON facets.item = h.value"
+                                  " GROUP BY facet, facets.value ORDER BY facet, n DESC, facets.value",
+                                  (json.dumps(ids[:facet_sample]),)).fetchall()
+        snippets: Dict[int, str] = {}
+        if match and rows:
+            # The rowid range lets FTS5 seek to the page instead of walking every hit.
+            page_ids = [r[0] for r in rows]
+            snippets = dict(conn.execute(
+                f"SELECT rowid, snippet(items_fts, -1, char(2), char(3), '…', 16) FROM items_fts WHERE items_fts MATCH ?"
+                f" AND rowid BETWEEN ? AND ? AND +rowid IN ({', '.join('?' * len(page_ids))})",
+                [match, min(page_ids), max(page_ids)] + page_ids).fetchall())
+        return {"total": len(hits), "total_capped": capped,
+                "items": [{"key": k, "score": round(-score, 4) + 0.0, "snippet": snippets.get(i, "")} for i, k, score in rows],
+                "facets": _top_facets(facet_rows, facet_limit), "facets_sampled": sampled}
+
+    def _browse(self, conn: sqlite3.Connection, offset: int, limit: int, facet_limit: int) -> Dict[str, Any]:
+        # No query: everything in key order, with facet counts read straight off the facets index.
+        total = conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        rows = conn.execute("SELECT key FROM items ORDER BY key LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+        facet_rows = conn.execute("SELECT facet, value, COUNT(*) AS n FROM facets GROUP BY facet, value ORDER BY facet, n DESC, value").fetchall()
+        return {"total": total, "total_capped": False, "items": [{"key": k, "score": 0.0, "snippet": ""} for k, in rows],
+                "facets": _top_facets(facet_rows, facet_limit), "facets_sampled": 0}
+
+    def _synced(self) -> Dict[str, Tuple[int, int, float]]:
+        return {p: (size, mtime, updated) for p, size, mtime, updated in
+                self._conn().execute("SELECT path, size, mtime_ns, updated FROM files")}
+
+    def import_dir(self, src_dir: str, batch: int = 500, changed_only: bool = False) -> int:
+        """Upsert every <stem>.loc15.json under src_dir; returns how many items were added or changed.
+
+        Imported items get the import time as their update time, unless the envelope is already in the
+        store unchanged. With changed_only, files whose size and mtime are as last imported or exported
+        are not read at all.
+        """
+        synced = self._synced() if changed_only else {}
+        pending: List[Tuple[str, Dict[str, Any], os.stat_result]] = []
+        n = 0
+        for f in sorted(Path(src_dir).rglob(f"*{ENVELOPE_SUFFIX}")):
+            st = f.stat()
+            if synced.get(os.path.abspath(f), ())[:2] == (st.st_size, st.st_mtime_ns):
+                continue
+            try:
+                envelope = json.loads(f.read_text(encoding="utf-8"))
+            except Exception as e:
+                print(f"✗ Error reading {f}: {e}")
+                continue
+            pending.append((os.path.abspath(f), envelope, st))
+            if len(pending) >= batch:
+                n += self._import(pending)
+                pending = []
+        if pending:
+            n += self._import(pending)
+        return n
+
+    def _import(self, files: Sequence[Tuple[str, Dict[str, Any], os.stat_result]]) -> int:
+        now = time.time()
+        keys = [os.path.basename(p)[:-len(ENVELOPE_SUFFIX)] for p, _, _ in files]
+        return self._write((_UPSERT, [self._row(k, e, "", now) for k, (_, e, _) in zip(keys, files)]),
+                           (_SYNC, [(p, st.st_size, st.st_mtime_ns, k) for k, (p, _, st) in zip(keys, files)]))
+
+    def export_dir(self, dest_dir: str, since: Optional[float] = None, batch: int = 500) -> int:
+        """Write each item as <dest_dir>/<key>.loc15.json (indent=2, the per-file layout); returns how many were written.
+
+        Files that already hold the item's envelope are left as they are.
+        """
+        synced = self._synced()
+        n = 0
+        for rows in self.iter_batches(since=since, batch=batch):
+            done = []
+            for key, raw, updated in rows:
+                out = Path(dest_dir) / f"{key}{ENVELOPE_SUFFIX}"
+                path = os.path.abspath(out)
+                st = out.stat() if out.exists() else None
+                if st is not None and synced.get(path) == (st.st_size, st.st_mtime_ns, updated):
+                    continue
+                envelope = json.loads(raw)
+                text = envelope_json(envelope)
+                if st is None or st.st_size != len(text.encode("utf-8")) or out.read_text(encoding="utf-8") != text:
+                    write_json(envelope, out)
+                    st = out.stat()
+                    n += 1
+                done.append((path, st.st_size, st.st_mtime_ns, key))
+            if done:
+                self._write((_SYNC, done))
+        return n
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
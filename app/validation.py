@@ -0,0 +1,238 @@
+import re, json, calendar
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from .schema import LOC15_SCHEMA
+
+# Schema validation and normalization of metadata, with no model calls.
+# The validator is compiled once per process. normalize() coerces a model answer towards the current
+# LOC15_SCHEMA, driven by the schema itself so schema changes roll out without code changes: missing
+# fields become null and unknown ones are dropped, strings and list items are cut to maxLength, lists
+# to maxItems, integer maps (field_confidence) are rounded into their bounds, and dates go to ISO.
+# revalidate() applies it to every envelope in a result store, in parallel.
+
+_VALIDATOR = None  # per-process Draft7Validator, compiled on first use
+
+ISO_DATE = re.compile(r"^(\d{4}(-\d{2}(-\d{2})?)?|undated)$")
+_UNDATED = {"", "undated", "n.d", "nd", "no date", "s.d", "sd", "unknown", "unk", "none", "null"}
+_MONTHS = {m.lower(): i for names in (calendar.month_name, calendar.month_abbr) for i, m in enumerate(names) if m}
+_MONTHS["sept"] = 9
+_MONTH = r"(?P<month>" + "|".join(sorted(_MONTHS, key=len, reverse=True)) + r")\.?"
+_DATE_FORMS = [
+    re.compile(r"^(?P<year>\d{4})[-/.](?P<mnum>\d{1,2})(?:[-/.](?P<day>\d{1,2}))?(?!\d)"),  # 1942-6-2, 1942/06/02, 1942-06-02T00:00
+    re.compile(r"^(?P<mnum>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})$"),  # US order: 6/2/1942
+    re.compile(r"\b(?P<day>\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?" + _MONTH + r",?\s+(?P<year>\d{4})\b", re.IGNORECASE),  # 2 June 1942
+    re.compile(r"\b" + _MONTH + r"\s+(?:(?P<day>\d{1,2})(?:st|nd|rd|th)?,?\s+)?(?P<year>\d{4})\b", re.IGNORECASE),  # June 2, 1942
+]
+_YEAR = re.compile(r"\b(1[0-9]{3}|20[0-9]{2})\b")
+
+def validator() -> Any:
+    """The compiled LOC15_SCHEMA validator, or None without jsonschema."""
+    global _VALIDATOR
+    if _VALIDATOR is None:
+        try:
+            from jsonschema import Draft7Validator
+        except Exception:
+            return None
+        _VALIDATOR = Draft7Validator(LOC15_SCHEMA)
+    return _VALIDATOR
+
+def validate(obj: Dict[str, Any]) -> str:
+    """Schema errors as "field: message; ..." ("" when valid, or when jsonschema is not installed)."""
+    v = validator()
+    if v is None:
+        return ""
+    errs = sorted(v.iter_errors(obj), key=lambda e: e.path)
+    return "; ".join([f"{'.'.join(map(str, e.path))}: {e.message}" for e in errs])
+
+def _iso(year: int, month: Optional[int] = None, day: Optional[int] = None) -> Optional[str]:
+    if month is None:
+        return f"{year:04d}"
+    if not 1 <= month <= 12:
+        return None
+    if day is None:
+        return f"{year:04d}-{month:02d}"
+    if not 1 <= day <= calendar.monthrange(year, month)[1]:
+        return None
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+def normalize_date(value: Any) -> Any:
+    """ISO (YYYY, YYYY-MM, YYYY-MM-DD) or 'undated' for common date spellings; anything unrecognized is returned as-is."""
+    if value is None or isinstance(value, bool):
+        return value
+    text = str(value).strip()
+    if ISO_DATE.match(text):
+        return text
+    if text.lower().strip(" .?[]()") in _UNDATED or not re.search(r"[^\W_]", text):  # no letters or digits at all
+        return "undated"
+    for rx in _DATE_FORMS:
+        m = rx.search(text)
+        if m:
+            parts = m.groupdict()
+            month = _MONTHS[parts["month"].lower()] if parts.get("month") else (int(parts["mnum"]) if parts.get("mnum") else None)
+            iso = _iso(int(parts["year"]), month, int(parts["day"]) if parts.get("day") else None)
+            if iso:
+                return iso
+    years = set(_YEAR.findall(text))
+    if len(years) == 1:  # "circa 1923", "[1923?]"; ranges and decades stay as they are
+        return years.pop()
+    return value
+
+def _types(spec: Dict[str, Any]) -> List[str]:
+    t = spec.get("type", [])
+    return [t] if isinstance(t, str) else list(t)
+
+def _string(value: Any, spec: Dict[str, Any]) -> Any:
+    if isinstance(value, (list, tuple)):
+        value = "; ".join(str(v).strip() for v in value if v is not None and str(v).strip())
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    if isinstance(value, str) and "maxLength" in spec and len(value) > spec["maxLength"]:
+        value = value[:spec["maxLength"]].rstrip()
+    return value
+
+def _array(value: Any, spec: Dict[str, Any]) -> Any:
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        return value
+    item = spec.get("items", {})
+    out, seen = [], set()
+    for v in value:
+        if v is None or isinstance(v, (dict, list)):
+            continue
+        v = _string(str(v).strip(), item) if "string" in _types(item) else v
+        if v == "" or (isinstance(v, str) and v.lower() in seen):
+            continue
+        seen.add(v.lower() if isinstance(v, str) else v)
+        out.append(v)
+    return out[:spec["maxItems"]] if "maxItems" in spec else out
+
+def _integer(value: Any, spec: Dict[str, Any]) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value.strip().rstrip("%"))
+        except ValueError:
+            return None
+    if not isinstance(value, (int, float)) or value != value:
+        return None
+    if isinstance(value, float) and 0 < value < 1 and spec.get("maximum") == 100:
+        value *= 100  # a 0-1 probability where a percentage was asked for
+    value = int(round(value))
+    if "minimum" in spec:
+        value = max(spec["minimum"], value)
+    if "maximum" in spec:
+        value = min(spec["maximum"], value)
+    return value
+
+def _object(value: Any, spec: Dict[str, Any]) -> Any:
+    extra = spec.get("additionalProperties")
+    if not isinstance(value, dict) or not isinstance(extra, dict) or "integer" not in _types(extra):
+        return value
+    out = {}
+    for k, v in value.items():
+        v = _integer(v, extra)
+        if v is not None:
+            out[str(k)] = v
+    return out
+
+def _boolean(value: Any) -> Any:
+    if isinstance(value, str) and value.strip().lower() in ("true", "yes", "false", "no"):
+        return value.strip().lower() in ("true", "yes")
+    return value
+
+def normalize(md: Dict[str, Any], schema: Dict[str, Any] = LOC15_SCHEMA) -> Tuple[Dict[str, Any], List[str]]:
+    """(normalized copy of md, names of the fields that changed). Empty or non-dict metadata is returned as-is."""
+    if not isinstance(md, dict) or not md:
+        return md, []
+    props = schema["properties"]
+    out: Dict[str, Any] = {}
+    changed: List[str] = []
+    for name, value in md.items():
+        if name not in props and schema.get("additionalProperties") is False:
+            changed.append(name)
+        else:
+            out[name] = value
+    for name in schema.get("required", []):
+        if name not in out:
+            out[name] = None
+            changed.append(name)
+    for name, spec in props.items():
+        if name not in out or out[name] is None:
+            continue
+        value, types = out[name], _types(spec)
+        if name == "date":
+            value = normalize_date(value)
+        if "array" in types:
+            value = _array(value, spec)
+        elif "string" in types:
+            value = _string(value, spec)
+        elif "object" in types:
+            value = _object(value, spec)
+        elif "boolean" in types:
+            value = _boolean(value)
+        if value != out[name] or type(value) is not type(out[name]):
+            out[name] = value
+            changed.append(name)
+    return out, changed
+
+def revalidate_envelope(envelope: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+    """(updated envelope, or None if nothing changed; changed field names) against the current schema."""
+    md, changed = normalize(envelope.get("metadata"))
+    ctx = dict(envelope.get("context") or {})
+    err = validate(md) if md else ctx.get("validation_error", "")
+    if err:
+        ctx["validation_error"] = err
+    else:
+        ctx.pop("validation_error", None)
+    if not changed and ctx == (envelope.get("context") or {}):
+        return None, []
+    return dict(envelope, metadata=md, context=ctx), changed
+
+def _revalidate_batch(rows: List[Tuple[str, str, float]]) -> Tuple[List[Tuple[str, Dict[str, Any]]], Counter, int]:
+    # One store batch: (changed (key, envelope) pairs, changes per field, envelopes still invalid).
+    updates, fields, invalid = [], Counter(), 0
+    for key, raw, _ in rows:
+        envelope = json.loads(raw)
+        new, changed = revalidate_envelope(envelope)
+        if new is not None:
+            updates.append((key, new))
+            fields.update(changed or ["validation_error"])
+        if (new or envelope).get("context", {}).get("validation_error"):
+            invalid += 1
+    return updates, fields, invalid
+
+def _batches(store: Any, workers: int, batch: int) -> Iterator[Tuple[List[Tuple[str, Dict[str, Any]]], Counter, int, int]]:
+    rows_iter = store.iter_batches(batch=batch)
+    if workers <= 1:
+        for rows in rows_iter:
+            yield _revalidate_batch(rows) + (len(rows),)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window: deque = deque()
+        for rows in rows_iter:
+            window.append((pool.submit(_revalidate_batch, rows), len(rows)))
+            if len(window) >= workers * 2:
+                future, n = window.popleft()
+                yield future.result() + (n,)
+        while window:
+            future, n = window.popleft()
+            yield future.result() + (n,)
+
+def revalidate(store: Any, workers: int = 1, batch: int = 500, dry_run: bool = False) -> Dict[str, Any]:
+    """Normalize and re-check every envelope in store against the current schema; no model calls.
+
+    Batches are processed in `workers` processes and changed envelopes are written back per batch
+    (unless dry_run). Returns {"checked", "updated", "invalid", "fields": changes per field}.
+    """
+    report = {"checked": 0, "updated": 0, "invalid": 0, "fields": Counter()}
+    for updates, fields, invalid, n in _batches(store, workers, batch):
+        if updates and not dry_run:
+            store.update_many(updates)
+        report["checked"] += n
+        report["updated"] += len(updates)
+        report["invalid"] += invalid
+        report["fields"].update(fields)
+    return report
@@ -0,0 +1,345 @@
+import os, io, sys, json, time, base64, random, shutil, hashlib, argparse, tempfile, resource, threading, types
+from pathlib import Path
+from typing import Any, Dict, List
+
+from PIL import Image
+
+import app.main as cli
+from app import ai_metadata, gdrive
+from app.ocr import estimate_image_tokens
+from app.schema import LOC15_SCHEMA
+from app.store import ResultStore
+
+# Offline throughput benchmark: runs app.main end to end on the _gdrive/ samples, replicated N times,
+# against in-process stand-ins for the OpenAI chat-completions API and (with --drive) Google Drive.
+# Nothing leaves the machine and no quota is spent.
+#
+#   python bench.py --files 2000 --workers 0 --api-concurrency 16
+#   python bench.py --files 500 --drive --report bench.json
+#   python bench.py --files 2000 --baseline bench.json      # exit 1 if files/s regressed
+#
+# Arguments after "--" are passed through to app.main (e.g. -- --image-format webp).
+
+SAMPLES_DIR = "_gdrive"
+SAMPLE_EXTS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".pdf")
+
+class RateLimitError(Exception):
+    status_code = 429
+
+def conformant_metadata(filename: str, transcript: str) -> Dict[str, Any]:
+    """A LOC15_SCHEMA-valid answer of realistic size: every required key, arrays at typical lengths."""
+    md: Dict[str, Any] = {k: None for k in LOC15_SCHEMA["required"]}
+    md.update({
+        "title": f"Letter ({Path(filename).stem})", "creator": "Unknown", "date": "1923-05-14", "place": "Oxford, Ohio",
+        "language": "English", "subjects": ["Correspondence", "Universities and colleges", "Ohio"],
+        "theme": ["Education"], "genre": ["Letters"], "description": "Handwritten letter on institutional letterhead. " * 6,
+        "format": "image/jpeg", "type": "Text", "digitized": True, "transcript": transcript, "text_reading": transcript[:400],
+        "generated_title": f"Letter, 1923 ({Path(filename).stem})",
+        "field_confidence": {"title": 70, "date": 85, "creator": 30, "subjects": 60},
+    })
+    return md
+
+class FakeChatCompletions:
+    """Mimics client.chat.completions.create: lognormal latency, 429s when over capacity or at random,
+    usage blocks with plausible token counts, and schema-conformant JSON for structured requests.
+
+    Prompt caching is modelled like the real API: the longest previously seen prefix (schema, then text
+    parts up to the first image) of at least 1024 tokens is reported as cached, in 128-token steps."""
+
+    def __init__(self, latency: float, jitter: float, capacity: int, error_rate: float, seed: int = 0):
+        self.latency, self.jitter, self.capacity, self.error_rate = latency, jitter, capacity, error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.active = self.peak = 0
+        self.stats = {"calls": 0, "rate_limited": 0, "request_bytes": 0, "image_bytes": 0, "prompt_tokens": 0,
+                      "cached_tokens": 0, "completion_tokens": 0}
+        self.prefixes = set()
+
+    def _prompt(self, messages: List[Dict[str, Any]], response_format: Any) -> tuple:
+        tokens, image_bytes, filename = 0, 0, ""
+        h, prefixes, static = hashlib.sha256(), [], True  # (digest, tokens) at each boundary of the text-only prefix
+        if response_format:
+            schema = json.dumps(response_format, sort_keys=True)
+            tokens += len(schema) // 4
+            h.update(schema.encode())
+            prefixes.append((h.hexdigest(), tokens))
+        for m in messages:
+            parts = m["content"] if isinstance(m["content"], list) else [{"type": "text", "text": m["content"]}]
+            for p in parts:
+                if p["type"] == "text":
+                    tokens += len(p["text"]) // 4
+                    if p["text"].startswith("FILENAME: "):
+                        filename = p["text"].split("\n", 1)[0][len("FILENAME: "):]
+                    if static:
+                        h.update(p["text"].encode())
+                        prefixes.append((h.hexdigest(), tokens))
+                else:
+                    static = False
+                    data = base64.b64decode(p["image_url"]["url"].split(",", 1)[1])
+                    image_bytes += len(data)
+                    tokens += estimate_image_tokens(*Image.open(io.BytesIO(data)).size)
+        return tokens, image_bytes, filename, prefixes
+
+    def create(self, **kw: Any) -> Any:
+        prompt_tokens, image_bytes, filename, prefixes = self._prompt(kw["messages"], kw.get("response_format"))
+        with self.lock:
+            cached = max((n for digest, n in prefixes if digest in self.prefixes), default=0)
+            cached = cached // 128 * 128 if cached >= 1024 else 0
+            self.prefixes.update(digest for digest, _ in prefixes)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.stats["calls"] += 1
+            self.stats["request_bytes"] += len(json.dumps(kw))
+            self.stats["image_bytes"] += image_bytes
+            over = (self.capacity and self.active > self.capacity) or self.random.random() < self.error_rate
+            delay = self.random.lognormvariate(0, self.jitter) * self.latency
+        try:
+            if over:
+                time.sleep(min(delay, 0.05))
+                with self.lock:
+                    self.stats["rate_limited"] += 1
+                raise RateLimitError("429 Too Many Requests (fake)")
+            time.sleep(delay)
+        finally:
+            with self.lock:
+                self.active -= 1
+        if "response_format" in kw:
+            content = json.dumps(conformant_metadata(filename, "Dear Sir,\nThank you for your letter of the 3rd.\n" * 8))
+        else:
+            content = "Dear Sir,\nThank you for your letter of the 3rd.\n" * 8
+        completion_tokens = len(content) // 4
+        with self.lock:
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["cached_tokens"] += cached
+            self.stats["completion_tokens"] += completion_tokens
+        usage = types.SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                      prompt_tokens_details=types.SimpleNamespace(cached_tokens=cached))
+        return types.SimpleNamespace(usage=usage, choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))])
+
+class FakeDrive:
+    """Just enough of the Drive v3 service for gdrive.sync_folder: one folder, ranged media downloads
+    served at a fixed bandwidth."""
+
+    FOLDER = "bench-folder"
+
+    def __init__(self, files: Dict[str, bytes], mbps: float):
+        self.mbps = mbps
+        self.blobs: Dict[str, bytes] = {}
+        self.meta: List[Dict[str, Any]] = []
+        digests: Dict[int, str] = {}
+        for i, (name, data) in enumerate(files.items()):
+            fid = f"f{i:07d}"
+            self.blobs[fid] = data
+            md5 = digests.setdefault(id(data), hashlib.md5(data).hexdigest())
+            self.meta.append({"id": fid, "name": name, "mimeType": "image/jpeg", "md5Checksum": md5, "modifiedTime": "2024-01-01T00:00:00Z",
+                              "size": str(len(data)), "parents": [self.FOLDER], "trashed": False})
+
+    def _exec(self, value: Any) -> Any:
+        return types.SimpleNamespace(execute=lambda: value)
+
+    def files(self) -> Any:
+        def list_(pageToken=None, pageSize=1000, **_):
+            start = int(pageToken or 0)
+            page = {"files": self.meta[start:start + pageSize]}
+            if start + pageSize < len(self.meta):
+                page["nextPageToken"] = str(start + pageSize)
+            return self._exec(page)
+        def get_media(fileId):
+            return types.SimpleNamespace(uri=fileId, headers={}, http=types.SimpleNamespace(request=self._ranged))
+        return types.SimpleNamespace(list=list_, get_media=get_media)
+
+    def changes(self) -> Any:
+        return types.SimpleNamespace(getStartPageToken=lambda: self._exec({"startPageToken": "1"}),
+                                     list=lambda **_: self._exec({"changes": [], "newStartPageToken": "1"}))
+
+    def _ranged(self, uri: str, method: str = "GET", headers: Dict[str, str] = None) -> tuple:
+        data = self.blobs[uri]
+        start, end = (int(x) for x in headers["range"][len("bytes="):].split("-"))
+        if start >= len(data):
+            return types.SimpleNamespace(status=416), b""
+        chunk = data[start:end + 1]
+        if self.mbps:
+            time.sleep(len(chunk) / (self.mbps * 1024 ** 2))
+        return types.SimpleNamespace(status=206), chunk
+
+def replicate(samples: List[Path], n: int, dest: Path) -> Dict[str, Path]:
+    """Hard-link (or copy) the samples into dest until there are n files; returns name -> source."""
+    dest.mkdir(parents=True, exist_ok=True)
+    names: Dict[str, Path] = {}
+    for i in range(n):
+        src = samples[i % len(samples)]
+        name = f"{i:06d}_{src.name}"
+        target = dest / name
+        if not target.exists():
+            try:
+                os.link(src, target)
+            except OSError:
+                shutil.copy2(src, target)
+        names[name] = src
+    return names
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def stage_latencies(trace: Path) -> Dict[str, List[float]]:
+    stages: Dict[str, List[float]] = {}
+    with open(trace, encoding="utf-8") as f:
+        for line in f:
+            ev = json.loads(line)
+            stages.setdefault(ev["stage"], []).append(ev["seconds"])
+    return stages
+
+def _rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+class RssSampler(threading.Thread):
+    """Polls /proc for the RSS of this process and its pool workers. Pool workers are not reaped before
+    the report, so getrusage(RUSAGE_CHILDREN) would miss them; on non-Linux systems it is the fallback."""
+
+    def __init__(self, interval: float = 0.2):
+        super().__init__(name="rss", daemon=True)
+        self.interval = interval
+        self.peak = {"parent": 0.0, "worker": 0.0, "total": 0.0}
+        self._done = threading.Event()
+
+    def _children(self) -> List[int]:
+        me, pids = str(os.getpid()), []
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        if f.read().rsplit(")", 1)[1].split()[1] == me:
+                            pids.append(int(entry))
+                except (OSError, IndexError):
+                    continue
+        return pids
+
+    def run(self) -> None:
+        while not self._done.wait(self.interval):
+            parent = _rss_mb(os.getpid())
+            workers = [_rss_mb(pid) for pid in self._children()]
+            self.peak["parent"] = max(self.peak["parent"], parent)
+            self.peak["worker"] = max([self.peak["worker"]] + workers)
+            self.peak["total"] = max(self.peak["total"], parent + sum(workers))
+
+    def stop(self) -> Dict[str, float]:
+        self._done.set()
+        self.join()
+        if not os.path.isdir("/proc"):
+            # ru_maxrss is in KiB on Linux, bytes on macOS; "worker" is the largest reaped child.
+            scale = 1024 ** 2 if sys.platform == "darwin" else 1024
+            self.peak["parent"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+            self.peak["worker"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+        return self.peak
+
+def main():
+    argv = sys.argv[1:]
+    passthrough = argv[argv.index("--") + 1:] if "--" in argv else []
+    argv = argv[:argv.index("--")] if "--" in argv else argv
+
+    ap = argparse.ArgumentParser(description="Offline mini_loc15 throughput benchmark (fake OpenAI / Drive backends)")
+    ap.add_argument("--files", type=int, default=1000, help="Number of input files (samples are replicated; default: 1000)")
+    ap.add_argument("--samples", default=SAMPLES_DIR, help=f"Directory with sample scans (default: {SAMPLES_DIR})")
+    ap.add_argument("--workdir", default="", help="Keep inputs/outputs here instead of a temp dir (inputs are reused between runs)")
+    ap.add_argument("--workers", type=int, default=0, help="OCR/image-prep processes (default: 0 = one per core)")
+    ap.add_argument("--api-concurrency", type=int, default=8, help="Concurrent model calls (default: 8)")
+    ap.add_argument("--latency", type=float, default=1.5, help="Median fake model latency in seconds (default: 1.5)")
+    ap.add_argument("--jitter", type=float, default=0.4, help="Lognormal sigma of the latency (default: 0.4)")
+    ap.add_argument("--capacity", type=int, default=6, help="Concurrent calls the fake API accepts before answering 429 (0 = unlimited; default: 6)")
+    ap.add_argument("--error-rate", type=float, default=0.01, help="Fraction of calls answered with a random 429 (default: 0.01)")
+    ap.add_argument("--drive", action="store_true", help="Feed inputs through gdrive.sync_folder from a fake Drive folder")
+    ap.add_argument("--drive-mbps", type=float, default=50.0, help="Fake Drive bandwidth per download in MB/s (0 = unlimited; default: 50)")
+    ap.add_argument("--report", default="", help="Write the results as JSON")
+    ap.add_argument("--baseline", default="", help="Compare with an earlier --report and exit 1 if files/s dropped more than --tolerance")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="Allowed files/s regression against --baseline (default: 0.10)")
+    args = ap.parse_args(argv)
+
+    samples = sorted(p for p in Path(args.samples).iterdir() if p.suffix.lower() in SAMPLE_EXTS)
+    if not samples:
+        raise SystemExit(f"No sample scans in {args.samples}")
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix="loc15-bench-"))
+    out_dir = workdir / "out"
+    shutil.rmtree(out_dir, ignore_errors=True)  # always measure a cold run
+    trace = workdir / "trace.jsonl"
+    trace.unlink(missing_ok=True)
+
+    fake = FakeChatCompletions(args.latency, args.jitter, args.capacity, args.error_rate)
+    ai_metadata.set_client_factory(lambda: types.SimpleNamespace(chat=types.SimpleNamespace(completions=fake)))
+
+    main_argv = ["--out", str(out_dir), "--no-cache", "--trace", str(trace), "--workers", str(args.workers),
+                 "--api-concurrency", str(args.api_concurrency)]
+    if args.drive:
+        contents = {p: p.read_bytes() for p in samples}
+        names = {f"{i:06d}_{p.name}": contents[p] for i, p in ((i, samples[i % len(samples)]) for i in range(args.files))}
+        drive = FakeDrive(names, args.drive_mbps)
+        dl = workdir / "drive"
+        shutil.rmtree(dl, ignore_errors=True)
+        gdrive.drive_service_factory = lambda: (lambda: drive)
+        os.environ["GDRIVE_FOLDER_ID"] = FakeDrive.FOLDER
+        main_argv += ["--gdrive", "--dltemp", str(dl)]
+    else:
+        replicate(samples, args.files, workdir / "in")
+        main_argv += ["--in", str(workdir / "in")]
+
+    print(f"→ Benchmark: {args.files} files from {len(samples)} samples in {workdir}")
+    sys.argv = ["app.main"] + main_argv + passthrough
+    sampler = RssSampler()
+    sampler.start()
+    t0 = time.perf_counter()
+    try:
+        cli.main()
+    finally:
+        wall = time.perf_counter() - t0
+        rss = sampler.stop()
+
+    written = len(ResultStore.for_output(str(out_dir)))
+    stages = stage_latencies(trace) if trace.exists() else {}
+    api = dict(fake.stats, peak_concurrency=fake.peak)
+    result = {
+        "files": args.files, "written": written, "wall_seconds": round(wall, 2),
+        "files_per_second": round(written / wall, 3) if wall else 0.0,
+        "stages": {s: {"p50": round(percentile(v, 0.50), 4), "p99": round(percentile(v, 0.99), 4), "n": len(v)} for s, v in stages.items()},
+        "peak_rss_mb": {k: round(v, 1) for k, v in rss.items()},
+        "bytes_sent_per_file": round(api["request_bytes"] / written) if written else 0,
+        "image_bytes_per_file": round(api["image_bytes"] / written) if written else 0,
+        "tokens_per_file": round((api["prompt_tokens"] + api["completion_tokens"]) / written) if written else 0,
+        "cached_tokens_per_file": round(api["cached_tokens"] / written) if written else 0,
+        "calls_per_file": round(api["calls"] / written, 2) if written else 0,
+        "api": api,
+        "config": {k: v for k, v in vars(args).items() if k not in ("report", "baseline")} | {"passthrough": passthrough},
+    }
+
+    print(f"\nBenchmark: {written}/{args.files} files in {wall:.1f}s → {result['files_per_second']:.2f} files/s")
+    print(f"  {'stage':<11}{'n':>7}{'p50 s':>9}{'p99 s':>9}")
+    for s, v in result["stages"].items():
+        print(f"  {s:<11}{v['n']:>7}{v['p50']:>9.3f}{v['p99']:>9.3f}")
+    print(f"  Peak RSS: parent {rss['parent']:.0f} MB, largest worker {rss['worker']:.0f} MB, all processes {rss['total']:.0f} MB")
+    print(f"  Sent per file: {result['bytes_sent_per_file'] / 1024:.1f} KB ({result['image_bytes_per_file'] / 1024:.1f} KB image), "
+          f"{result['tokens_per_file']} tokens ({result['cached_tokens_per_file']} prompt tokens cached), {result['calls_per_file']} calls")
+    print(f"  API: {api['calls']} calls, {api['rate_limited']} answered 429, peak {api['peak_concurrency']} concurrent")
+
+    if args.report:
+        Path(args.report).write_text(json.dumps(result, indent=2), encoding="utf-8")
+        print(f"→ Report written to {args.report}")
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.baseline:
+        base = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        floor = base["files_per_second"] * (1 - args.tolerance)
+        if result["files_per_second"] < floor:
+            print(f"✗ Regression: {result['files_per_second']:.2f} files/s < {floor:.2f} (baseline {base['files_per_second']:.2f})")
+            sys.exit(1)
+        print(f"✓ Within {args.tolerance:.0%} of baseline ({base['files_per_second']:.2f} files/s)")
+
+if __name__ == "__main__":
+    main()
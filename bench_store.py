@@ -0,0 +1,150 @@
+import os, re, sys, json, time, random, shutil, argparse, tempfile, subprocess
+from pathlib import Path
+from typing import Any, Dict, List
+
+from app.store import ENVELOPE_SUFFIX, ResultStore
+
+# Offline result-store checks: runs app.main against a copy of the checked-in out/ and exits 1 if any
+# check fails.
+#
+#   python bench_store.py
+#   python bench_store.py --items 100000 --workdir /tmp/loc15-store   # keep (and reuse) the search corpus
+#
+# incremental-export: `export --watermark` writes each changed item exactly once, with export-json,
+# a re-import on open and files copied in with old mtimes in between.
+# search-latency: ResultStore.search on a synthetic corpus of --items envelopes (the samples with
+# generated titles, transcripts and catalog numbers) answers SEARCH_QUERIES within --budget-ms (median).
+
+ENVELOPES_DIR = "out"
+SEARCH_QUERIES = [("letter", {}), ("w12", {}), ("lett", {}), ("le", {}), ("dear murray", {}), ("commencement university", {}),
+                  ("", {"decade": ["1930s"]}), ("", {"genre": ["Letter"], "decade": ["1940s"]}),
+                  ("letter", {"genre": ["Letter"], "decade": ["1940s"]}), ("zzzzqx", {})]
+
+def cli(*argv: str) -> str:
+    """Run python -m app.main with argv; its stdout (exits on failure)."""
+    proc = subprocess.run([sys.executable, "-m", "app.main", *argv], capture_output=True, text=True)
+    if proc.returncode:
+        raise SystemExit(f"✗ app.main {' '.join(argv)} failed:\n{proc.stdout}{proc.stderr}")
+    return proc.stdout
+
+def exported_rows(out_dir: Path, export_file: Path, watermark: Path) -> int:
+    stdout = cli("export", "--out", str(out_dir), "--export-file", str(export_file), "--watermark", str(watermark), "--workers", "1")
+    return int(re.search(r"Exported (\d+) rows", stdout).group(1))
+
+def check_incremental_export(workdir: Path, envelopes: List[Path]) -> List[str]:
+    out_dir, export_file, watermark = workdir / "out", workdir / "samples.jsonl", workdir / "samples.watermark.json"
+    out_dir.mkdir(parents=True)
+    for f in envelopes:
+        shutil.copy2(f, out_dir / f.name)
+    steps = []
+
+    def expect(label: str, want: int) -> None:
+        got = exported_rows(out_dir, export_file, watermark)
+        steps.append(f"{'✓' if got == want else '✗'} {label}: {got} rows (expected {want})")
+
+    expect("first export", len(envelopes))
+    expect("nothing changed", 0)
+    cli("export-json", "--out", str(out_dir))
+    expect("after export-json", 0)
+
+    store = ResultStore.for_output(str(out_dir))
+    key = envelopes[0].name[:-len(ENVELOPE_SUFFIX)]
+    envelope = store.get(key)
+    envelope["metadata"]["title"] = "Changed in the store"
+    store.put(key, envelope)
+    store.close()
+    cli("export-json", "--out", str(out_dir))
+    expect("one item written, then export-json", 1)
+
+    f = out_dir / envelopes[-1].name
+    envelope = json.loads(f.read_text(encoding="utf-8"))
+    envelope["metadata"]["title"] = "Changed on disk"
+    f.write_text(json.dumps(envelope, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.utime(f, (1, 1))  # e.g. restored from an archive: older than anything in the store
+    expect("one file copied in with an old mtime", 1)
+    cli("export-json", "--out", str(out_dir))
+    expect("after export-json again", 0)
+    return steps
+
+def build_corpus(store: ResultStore, n: int, envelopes: List[Path], batch: int = 2000) -> None:
+    """n envelopes built from the samples: the same fields, with generated titles, dates, subjects and text.
+
+    Text draws from the samples' words plus generated ones with a Zipf-like spread, and every transcript
+    carries a catalog number (w<n>), so short prefixes match many different terms."""
+    rng = random.Random(0)
+    samples = [json.loads(f.read_text(encoding="utf-8")) for f in envelopes]
+    words = sorted({w.lower() for e in samples for field in ("title", "description", "transcript")
+                    for w in re.findall(r"[^\W\d_]+", str(e["metadata"].get(field) or ""))})
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words += ["".join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(30000)]
+    weights = [1 / (i + 1) for i in range(len(words))]
+    rng.shuffle(words)
+    subjects = sorted({s for e in samples for s in e["metadata"].get("subjects") or []})
+    pending = []
+    for i in range(n):
+        base = samples[i % len(samples)]
+        text = rng.choices(words, weights, k=rng.randint(80, 400))
+        md = dict(base["metadata"], title=f"{' '.join(text[:6]).capitalize()} ({i})", description=" ".join(text[6:40]),
+                  transcript=f"w{i} " + " ".join(text), text_reading=" ".join(text[:60]),
+                  date=f"{rng.randint(1850, 1990)}-{rng.randint(1, 12):02d}", subjects=rng.sample(subjects, min(3, len(subjects))))
+        pending.append((f"item{i:07d}", dict(base, metadata=md), "", None))
+        if len(pending) >= batch:
+            store.put_many(pending)
+            pending = []
+    if pending:
+        store.put_many(pending)
+
+def check_search_latency(store: ResultStore, budget_ms: float, repeat: int = 5) -> List[str]:
+    steps = []
+    for text, filters in SEARCH_QUERIES:
+        times: List[float] = []
+        result: Dict[str, Any] = {}
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            result = store.search(text, filters, limit=50)
+            times.append((time.perf_counter() - t0) * 1000)
+        median = sorted(times)[len(times) // 2]
+        total = f"{result['total']}{'+' if result.get('total_capped') else ''}"
+        label = " ".join([repr(text)] + [f"{f}={v}" for f, vs in filters.items() for v in vs])
+        steps.append(f"{'✓' if median <= budget_ms else '✗'} {label}: {median:.1f} ms median, {max(times):.1f} ms max, {total} hits")
+    return steps
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline mini_loc15 result-store checks")
+    ap.add_argument("--envelopes", default=ENVELOPES_DIR, help=f"Directory with sample *{ENVELOPE_SUFFIX} files (default: {ENVELOPES_DIR})")
+    ap.add_argument("--workdir", default="", help="Keep the working files here instead of a temp dir")
+    ap.add_argument("--items", type=int, default=100000, help="Search corpus size (default: 100000; 0 skips search-latency)")
+    ap.add_argument("--budget-ms", type=float, default=50.0, help="Allowed median search latency (default: 50)")
+    args = ap.parse_args()
+
+    envelopes = sorted(Path(args.envelopes).glob(f"*{ENVELOPE_SUFFIX}"))
+    if len(envelopes) < 2:
+        raise SystemExit(f"Need at least two sample envelopes in {args.envelopes}")
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix="loc15-store-"))
+    shutil.rmtree(workdir / "export", ignore_errors=True)
+
+    print("incremental-export:")
+    steps = check_incremental_export(workdir / "export", envelopes)
+    for line in steps:
+        print(f"  {line}")
+    if args.items:
+        store = ResultStore.for_output(str(workdir / f"corpus-{args.items}"))
+        if len(store) != args.items:
+            print(f"→ Building a {args.items}-item search corpus in {store.path}")
+            t0 = time.perf_counter()
+            build_corpus(store, args.items, envelopes)
+            print(f"  built in {time.perf_counter() - t0:.0f}s")
+        print(f"search-latency ({args.items} items, budget {args.budget_ms:.0f} ms):")
+        for line in check_search_latency(store, args.budget_ms):
+            print(f"  {line}")
+            steps.append(line)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    failed = [s for s in steps if s.startswith("✗")]
+    if failed:
+        print(f"✗ {len(failed)} check(s) failed")
+        sys.exit(1)
+    print("✓ All store checks passed")
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,48 @@
 """
 Build script to generate static files for Vercel deployment.
 This creates a standalone viewer with all data pre-generated.
+
+Output layout in public/:
+  index.json           total, page count, list fields and search shard names
+  list/<n>.json        compact list pages: [id, title, date, image, detail version]
+  items/<id>.json      full record for one item, fetched when its card scrolls into view
+  search/<xx>.json     inverted index for terms starting with xx: {term: [ordinal delta, score, ...]}
+  images/<stem>.<hash>.<width>.<avif|webp|jpg>
+                       responsive derivatives (thumbnail, reading and zoom widths); the hash covers
+                       the source bytes and derivative settings, so files can be cached forever
+JSON outputs over COMPRESS_MIN_BYTES get .gz (and .br, if brotli is installed) sidecars.
+
+Builds are incremental: a manifest records each item's envelope digest, each source image's
+stat and content hash, and the stat and hash of every file written. A rebuild copies only
+new or changed images, rewrites only changed shards, and prunes outputs whose items are
+gone. Rendered derivatives are kept in .cache/static_images, so a fresh public/ is refilled
+by linking instead of re-encoding. Use --full to ignore the manifest.
+
+Without Pillow the original scans are copied to images/<file> instead.
 """
 
 import os
+import re
+import math
+import gzip
 import json
 import shutil
+import hashlib
+import argparse
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-import base64
+from app.cache import file_sha256, make_key
+from app.store import ResultStore
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
 
 # Configure paths
 BASE_DIR = Path(__file__).parent
@@ -16,58 +51,449 @@ IMAGE_DIR = BASE_DIR / "_gdrive"
 METADATA_DIR = BASE_DIR / "out"
 OUTPUT_DIR = BASE_DIR / "public"
 IMAGES_OUTPUT_DIR = OUTPUT_DIR / "images"
+MANIFEST_FILE = BASE_DIR / ".cache" / "build_static.json"
+DERIVATIVE_CACHE_DIR = BASE_DIR / ".cache" / "static_images"
+IMAGE_EXTS = ['.jpg', '.jpeg', '.png', '.tif', '.tiff']
+
+# Bump when the output layout changes so the next build starts from scratch.
+MANIFEST_VERSION = 4
+MANAGED_DIRS = ('images', 'items', 'list', 'search')
+
+LIST_PAGE_SIZE = 1000
+LIST_FIELDS = ['id', 'title', 'date', 'image', 'widths', 'v']
+COMPRESS_MIN_BYTES = 1024
+
+# Per-field weight of a term occurrence; an item's score for a term is the weighted count,
+# with each field's count capped so long transcripts don't drown out titles.
+SEARCH_FIELDS = {'title': 10, 'generated_title': 10, 'filename': 5, 'creator': 5, 'subjects': 4, 'theme': 4, 'genre': 4,
+                 'description': 2, 'collection': 1, 'transcript': 1, 'text_reading': 1}
+SEARCH_TERM_CAP = 5
+SEARCH_MIN_LENGTH = 2  # also the shard prefix length
+SEARCH_POOL_MIN_ITEMS = 500
+
+# Thumbnail, reading and zoom widths. Sources narrower than a width get their own width instead.
+DERIVATIVE_WIDTHS = [400, 1200, 2400]
+DERIVATIVE_FORMATS = {'avif': ('AVIF', {'quality': 50, 'speed': 8}),
+                      'webp': ('WEBP', {'quality': 80, 'method': 4}),
+                      'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True})}
+
+def format_supported(fmt):
+    """False for AVIF when Pillow predates it (11.2) or was built without libavif."""
+    if fmt != 'avif':
+        return True
+    return Image is not None and 'avif' in features.modules and bool(features.check_module('avif'))
+
+# Bump when derivative rendering changes; it is part of every derivative's hash.
+DERIVATIVE_VERSION = 1
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+def empty_manifest():
+    return {'version': MANIFEST_VERSION, 'items': {}, 'outputs': {}, 'search': None}
+
+def load_manifest(path=MANIFEST_FILE):
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return empty_manifest()
+
+def save_manifest(manifest, path=MANIFEST_FILE):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+def source_images(image_dir=IMAGE_DIR):
+    """stem -> file name, one directory listing; the first extension in IMAGE_EXTS wins."""
+    found = {}
+    if image_dir.exists():
+        for entry in os.scandir(image_dir):
+            stem, ext = os.path.splitext(entry.name)
+            if ext.lower() in IMAGE_EXTS:
+                prev = found.get(stem)
+                if prev is None or IMAGE_EXTS.index(ext.lower()) < IMAGE_EXTS.index(os.path.splitext(prev)[1].lower()):
+                    found[stem] = entry.name
+    return found
+
+def sync_image(name, previous, outputs):
+    """Copy one source image unless the manifest shows the output already matches.
+
+    Returns (source entry for the manifest, output entry, copied?).
+    """
+    src = IMAGE_DIR / name
+    dest = IMAGES_OUTPUT_DIR / name
+    rel = f"images/{name}"
+    src_stat = _stat(src)
+    dest_stat = _stat(dest)
+    known = dest_stat is not None and (outputs.get(rel) or {}).get('stat') == dest_stat and previous and previous.get('name') == name
+    if known and previous.get('stat') == src_stat:
+        return previous, outputs[rel], False
+    # Touched but identical content (e.g. re-downloaded): keep the existing copy.
+    sha = file_sha256(str(src))
+    if known and previous.get('sha256') == sha:
+        return {'name': name, 'stat': src_stat, 'sha256': sha}, outputs[rel], False
+    tmp = dest.with_name(dest.name + '.tmp')
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+    return {'name': name, 'stat': src_stat, 'sha256': sha}, {'stat': _stat(dest), 'sha': sha}, True
+
+def derivative_settings(widths, formats):
+    return [DERIVATIVE_VERSION, sorted(widths), [[f] + [sorted(DERIVATIVE_FORMATS[f][1].items())] for f in formats]]
+
+def derivative_files(stem, digest, widths, formats):
+    return [f"{stem}.{digest}.{w}.{fmt}" for w in widths for fmt in formats]
+
+def _link(src, dest):
+    if os.path.exists(dest):
+        return
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+def make_derivatives(name, sha, widths, formats):
+    """Render (or take from the derivative cache) every width/format of one scan and link them into images/.
+
+    Runs in a worker process. Returns the source entry for the manifest.
+    """
+    src = IMAGE_DIR / name
+    src_stat = _stat(src)
+    sha = sha or file_sha256(str(src))
+    digest = make_key(sha, derivative_settings(widths, formats))[:12]
+    stem = os.path.splitext(name)[0]
+    with Image.open(src) as im:
+        rotated = im.getexif().get(0x0112, 1) in (5, 6, 7, 8)  # EXIF orientations that swap width and height
+        width = im.size[1] if rotated else im.size[0]
+        available = sorted(set(min(w, width) for w in widths))
+        files = derivative_files(stem, digest, available, formats)
+        missing = [f for f in files if not (DERIVATIVE_CACHE_DIR / f).exists()]
+        if missing:
+            # Decode once, at the smallest JPEG draft scale that still covers the widest derivative.
+            scale = available[-1] / width
+            im.draft('RGB', (max(1, math.ceil(im.size[0] * scale)), max(1, math.ceil(im.size[1] * scale))))
+            base = ImageOps.exif_transpose(im)
+            base = base.convert('RGBA' if 'A' in base.getbands() else 'RGB')
+            DERIVATIVE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            for w in reversed(available):
+                h = max(1, round(base.size[1] * w / base.size[0]))
+                if base.size[0] != w:
+                    base = base.resize((w, h), Image.LANCZOS, reducing_gap=3.0)
+                for fmt in formats:
+                    fname = f"{stem}.{digest}.{w}.{fmt}"
+                    if fname not in missing:
+                        continue
+                    pil_fmt, options = DERIVATIVE_FORMATS[fmt]
+                    out = base.convert('RGB') if pil_fmt == 'JPEG' and base.mode != 'RGB' else base
+                    tmp = DERIVATIVE_CACHE_DIR / f"{fname}.{os.getpid()}.tmp"
+                    out.save(tmp, pil_fmt, **options)
+                    os.replace(tmp, DERIVATIVE_CACHE_DIR / fname)
+    for f in files:
+        _link(DERIVATIVE_CACHE_DIR / f, IMAGES_OUTPUT_DIR / f)
+    return {'name': name, 'stat': src_stat, 'sha256': sha, 'digest': digest, 'widths': available,
+            'rendered': len(missing)}
+
+def image_fields(source, formats):
+    """(list image value, widths, extra record fields) for a source entry."""
+    if source is None:
+        return None, None, {}
+    if 'digest' not in source:
+        return f"images/{source['name']}", None, {}
+    stem = os.path.splitext(source['name'])[0]
+    base = f"images/{stem}.{source['digest']}"
+    widths = source['widths']
+    fallback = 'jpg' if 'jpg' in formats else formats[-1]
+    return base, widths, {
+        'image': f"{base}.{widths[-1]}.{fallback}",
+        'thumbnail': f"{base}.{widths[0]}.{fallback}",
+        'srcset': {fmt: ', '.join(f"{base}.{w}.{fmt} {w}w" for w in widths) for fmt in formats},
+    }
+
+def encode_json(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _sidecars(rel, size):
+    if size < COMPRESS_MIN_BYTES:
+        return []
+    return [rel + '.gz'] + ([rel + '.br'] if brotli is not None else [])
+
+def write_output(rel, data, outputs):
+    """Write public/<rel> and its compressed sidecars unless the recorded hash and stat still match.
+
+    Returns (output entry for the manifest, written?).
+    """
+    path = OUTPUT_DIR / rel
+    sha = hashlib.sha1(data).hexdigest()
+    prev = outputs.get(rel)
+    sidecars = _sidecars(rel, len(data))
+    if prev and prev.get('sha') == sha and prev.get('stat') == _stat(path) and all((OUTPUT_DIR / s).exists() for s in sidecars):
+        return prev, False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for name, payload in [(rel, data)] + [(s, gzip.compress(data, 9, mtime=0) if s.endswith('.gz') else brotli.compress(data))
+                                           for s in sidecars]:
+        target = OUTPUT_DIR / name
+        tmp = target.with_name(target.name + '.tmp')
+        tmp.write_bytes(payload)
+        os.replace(tmp, target)
+    return {'stat': _stat(path), 'sha': sha}, True
+
+def tokenize(text):
+    """Lowercased letter/digit runs with accents stripped; public/index.html tokenizes queries the same way."""
+    text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return [t for t in re.findall(r'[^\W_]+', text.lower()) if len(t) >= SEARCH_MIN_LENGTH]
+
+def shard_name(term):
+    return ''.join(c if c.isascii() and c.isalnum() else f"_{ord(c):x}" for c in term[:SEARCH_MIN_LENGTH])
+
+def item_terms(metadata):
+    """term -> score for one item's metadata."""
+    scores = defaultdict(int)
+    for field, weight in SEARCH_FIELDS.items():
+        value = metadata.get(field)
+        if not value:
+            continue
+        text = ' '.join(str(v) for v in value) if isinstance(value, list) else str(value)
+        counts = defaultdict(int)
+        for term in tokenize(text):
+            counts[term] += 1
+        for term, n in counts.items():
+            scores[term] += weight * min(n, SEARCH_TERM_CAP)
+    return dict(scores)
+
+def build_search_shards(store, ordinals):
+    """{shard: {term: [ordinal delta, score, ...]}} over every item in the store."""
+    keys, docs = [], []
+    for key, data in store.iter_envelopes():
+        if key in ordinals:
+            metadata = dict(data.get('metadata') or {})
+            metadata.setdefault('filename', key)
+            keys.append(key)
+            docs.append({f: metadata.get(f) for f in SEARCH_FIELDS})
+    if len(docs) >= SEARCH_POOL_MIN_ITEMS:
+        with ProcessPoolExecutor() as pool:
+            term_maps = list(pool.map(item_terms, docs, chunksize=64))
+    else:
+        term_maps = [item_terms(doc) for doc in docs]
+    postings = defaultdict(list)
+    for key, terms in sorted(zip(keys, term_maps), key=lambda kt: ordinals[kt[0]]):
+        for term, score in terms.items():
+            postings[term].append((ordinals[key], score))
+    shards = defaultdict(dict)
+    for term in sorted(postings):
+        flat, last = [], 0
+        for ordinal, score in postings[term]:
+            flat += [ordinal - last, score]
+            last = ordinal
+        shards[shard_name(term)][term] = flat
+    return shards
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the static viewer into public/")
+    parser.add_argument("--full", action="store_true", help="ignore the build manifest and rebuild everything")
+    parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 1) * 4),
+                        help="parallel file copies and writes")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="parallel image derivative workers")
+    parser.add_argument("--widths", default=",".join(map(str, DERIVATIVE_WIDTHS)), help="derivative widths in pixels")
+    parser.add_argument("--formats", default=None,
+                        help=f"derivative formats, best first ({', '.join(DERIVATIVE_FORMATS)}; default: all this Pillow can write)")
+    parser.add_argument("--originals", action="store_true", help="copy the original scans instead of making derivatives")
+    args = parser.parse_args(argv)
+    widths = sorted(set(int(w) for w in args.widths.split(',') if w))
+    formats = [f for f in (args.formats or ",".join(DERIVATIVE_FORMATS)).split(',') if f]
+    bad = [f for f in formats if f not in DERIVATIVE_FORMATS]
+    if bad or not formats or not widths:
+        parser.error(f"bad --formats/--widths: {', '.join(bad) or 'empty'}")
+    derivatives = Image is not None and not args.originals
+    unsupported = [f for f in formats if not format_supported(f)] if derivatives else []
+    if unsupported and args.formats:
+        parser.error(f"--formats: this Pillow can't write {', '.join(unsupported)}")
+    formats = [f for f in formats if f not in unsupported]
 
-def main():
     print("=" * 60)
     print("🚀 Building static site for Vercel deployment")
     print("=" * 60)
-    
+
     # Create output directories
     OUTPUT_DIR.mkdir(exist_ok=True)
     IMAGES_OUTPUT_DIR.mkdir(exist_ok=True)
-    
-    items = []
-    
-    # Process all JSON files
+
+    old = empty_manifest() if args.full else load_manifest()
+    manifest = empty_manifest()
+    outputs = manifest['outputs']
+    if Image is None and not args.originals:
+        print("⊘ Pillow not installed; copying original scans. pip install pillow")
+    if unsupported:
+        print(f"⊘ Pillow has no {', '.join(unsupported)} support; skipping those derivatives. pip install -U pillow")
+    settings = derivative_settings(widths, formats) if derivatives else None
+    manifest['derivatives'] = settings
+    if old.get('derivatives') != settings:
+        old['items'] = {k: dict(v, source=None) for k, v in old['items'].items()}
+
+    # Summary rows only: envelopes are read for new or changed items.
+    rows = []
+    store = None
     if METADATA_DIR.exists():
-        for json_file in sorted(METADATA_DIR.glob("*.loc15.json")):
-            base_name = json_file.stem.replace(".loc15", "")
-            
-            # Check if corresponding image exists and copy it
-            image_path = None
-            for ext in ['.jpg', '.jpeg', '.png', '.tif', '.tiff']:
-                img_file = IMAGE_DIR / f"{base_name}{ext}"
-                if img_file.exists():
-                    # Copy image to public/images
-                    dest_file = IMAGES_OUTPUT_DIR / f"{base_name}{ext}"
-                    shutil.copy2(img_file, dest_file)
-                    image_path = f"images/{base_name}{ext}"
-                    print(f"✓ Copied: {base_name}{ext}")
-                    break
-            
-            # Read metadata
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                items.append({
+        store = ResultStore.open(str(METADATA_DIR))
+        rows = store.list(columns=("key", "filename", "title", "date", "digest"))
+    # key -> scan; grouped objects (app/grouping.py) are keyed by object id and use their first member's scan.
+    found = source_images()
+    images = {}
+    for row in rows:
+        name = found.get(row['key']) or found.get(os.path.splitext(row['filename'] or '')[0])
+        if name:
+            images[row['key']] = name
+
+    copied = 0
+    image_entries = {}
+    if derivatives:
+        # Scans whose stat and derivative files are unchanged are skipped without decoding;
+        # the rest render in a process pool, reusing anything already in the derivative cache.
+        with ProcessPoolExecutor(max_workers=max(1, args.processes)) as procs:
+            futures = {}
+            for row in rows:
+                base_name = row['key']
+                if base_name not in images:
+                    continue
+                previous = (old['items'].get(base_name) or {}).get('source')
+                if previous and previous.get('name') == images[base_name] and 'digest' in previous:
+                    stem = os.path.splitext(previous['name'])[0]
+                    files = [f"images/{f}" for f in derivative_files(stem, previous['digest'], previous['widths'], formats)]
+                    if previous['stat'] == _stat(IMAGE_DIR / previous['name']) and all(
+                            f in old['outputs'] and old['outputs'][f]['stat'] == _stat(OUTPUT_DIR / f) for f in files):
+                        image_entries[base_name] = previous
+                        continue
+                same = previous and previous.get('name') == images[base_name] and previous.get('stat') == _stat(IMAGE_DIR / images[base_name])
+                futures[base_name] = procs.submit(make_derivatives, images[base_name],
+                                                  previous['sha256'] if same else None, widths, formats)
+            for base_name, fut in futures.items():
+                source = fut.result()
+                if source.pop('rendered'):
+                    copied += 1
+                    print(f"✓ Rendered: {source['name']} ({', '.join(map(str, source['widths']))} px)")
+                image_entries[base_name] = source
+        for source in image_entries.values():
+            stem = os.path.splitext(source['name'])[0]
+            for f in derivative_files(stem, source['digest'], source['widths'], formats):
+                rel = f"images/{f}"
+                outputs[rel] = old['outputs'].get(rel) if rel in old['outputs'] else {'stat': _stat(OUTPUT_DIR / rel), 'sha': source['digest']}
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        if not derivatives:
+            # Copy images in parallel; most are skipped by a stat comparison.
+            futures = {}
+            for row in rows:
+                base_name = row['key']
+                if base_name in images:
+                    previous = (old['items'].get(base_name) or {}).get('source')
+                    futures[base_name] = pool.submit(sync_image, images[base_name], previous, old['outputs'])
+            for base_name, fut in futures.items():
+                source, entry, was_copied = fut.result()
+                image_entries[base_name] = source
+                outputs[f"images/{source['name']}"] = entry
+                if was_copied:
+                    copied += 1
+                    print(f"✓ Copied: {source['name']}")
+
+        # One detail shard per item, rewritten only when its envelope or image changed.
+        changed = set(old['items']) != set(row['key'] for row in rows)
+        entries, writes = [], {}
+        for row in rows:
+            base_name = row['key']
+            source = image_entries.get(base_name)
+            image_path, image_widths, image_record = image_fields(source, formats)
+            rel = f"items/{base_name}.json"
+            prev = old['items'].get(base_name)
+            if (prev and prev.get('envelope') == row['digest'] and prev.get('image') == image_path
+                    and prev.get('widths') == image_widths
+                    and rel in old['outputs'] and old['outputs'][rel]['stat'] == _stat(OUTPUT_DIR / rel)):
+                version = prev['v']
+                outputs[rel] = old['outputs'][rel]
+            else:
+                data = store.get(base_name) or {}
+                record = encode_json(dict({
                     'id': base_name,
                     'image': image_path,
                     'metadata': data.get('metadata', {}),
                     'context': data.get('context', {}),
                     'filename': base_name
-                })
-            except Exception as e:
-                print(f"✗ Error reading {json_file}: {e}")
-    
-    # Write items data to JSON
-    data_file = OUTPUT_DIR / "data.json"
-    with open(data_file, 'w', encoding='utf-8') as f:
-        json.dump(items, f, indent=2, ensure_ascii=False)
-    
-    print(f"\n📦 Generated data.json with {len(items)} items")
+                }, **image_record))
+                version = hashlib.sha1(record).hexdigest()[:10]
+                writes[rel] = pool.submit(write_output, rel, record, old['outputs'])
+                changed = True
+            manifest['items'][base_name] = {'envelope': row['digest'], 'image': image_path, 'widths': image_widths,
+                                            'source': source, 'v': version}
+            entries.append([base_name, row['title'], row['date'], image_path, image_widths, version])
+
+        # List pages; a page whose bytes are unchanged is not rewritten.
+        pages = [entries[i:i + LIST_PAGE_SIZE] for i in range(0, len(entries), LIST_PAGE_SIZE)]
+        for n, page in enumerate(pages):
+            writes[f"list/{n}.json"] = pool.submit(write_output, f"list/{n}.json", encode_json(page), old['outputs'])
+
+        # Search shards are rebuilt only when some item changed.
+        search_intact = old['search'] is not None and all(
+            (old['outputs'].get(f"search/{shard}.json") or {}).get('stat') == _stat(OUTPUT_DIR / f"search/{shard}.json")
+            for shard in old['search'])
+        if changed or not search_intact:
+            ordinals = {entry[0]: i for i, entry in enumerate(entries)}
+            shards = build_search_shards(store, ordinals) if store is not None else {}
+            for shard, terms in shards.items():
+                writes[f"search/{shard}.json"] = pool.submit(write_output, f"search/{shard}.json", encode_json(terms), old['outputs'])
+            manifest['search'] = sorted(shards)
+        else:
+            manifest['search'] = old['search']
+            for shard in old['search']:
+                outputs[f"search/{shard}.json"] = old['outputs'][f"search/{shard}.json"]
+
+        written = 0
+        for rel, fut in writes.items():
+            outputs[rel], was_written = fut.result()
+            written += was_written
+
+    version = hashlib.sha1(''.join(e['sha'] or '' for _, e in sorted(outputs.items())).encode()).hexdigest()[:12]
+    index = {'version': version, 'total': len(entries), 'page_size': LIST_PAGE_SIZE, 'pages': len(pages),
+             'fields': LIST_FIELDS, 'formats': formats if derivatives else [],
+             'search': {'shards': manifest['search'], 'prefix': SEARCH_MIN_LENGTH}}
+    outputs['index.json'], was_written = write_output('index.json', encode_json(index), old['outputs'])
+    written += was_written
+    print(f"\n📦 {len(entries)} items in {len(pages)} list pages, {len(manifest['search'])} search shards "
+          f"({written} files written)")
+
+    # Prune everything in the managed directories (and stray top-level JSON such as the old
+    # data.json) that this build did not produce.
+    expected = set()
+    for rel, entry in outputs.items():
+        expected.add(rel)
+        if not rel.startswith('images/'):
+            expected.update(_sidecars(rel, entry['stat'][1]))
+    stale = [e.path for e in os.scandir(OUTPUT_DIR) if e.is_file() and e.name.endswith(('.json', '.gz', '.br')) and e.name not in expected]
+    for d in MANAGED_DIRS:
+        if (OUTPUT_DIR / d).is_dir():
+            stale += [e.path for e in os.scandir(OUTPUT_DIR / d) if e.is_file() and f"{d}/{e.name}" not in expected]
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        list(pool.map(os.remove, stale))
+    for path in stale:
+        print(f"✗ Removed: {os.path.relpath(path, OUTPUT_DIR)}")
+    if derivatives and DERIVATIVE_CACHE_DIR.is_dir():
+        for e in os.scandir(DERIVATIVE_CACHE_DIR):
+            if f"images/{e.name}" not in expected:
+                os.remove(e.path)
+
+    save_manifest(manifest)
+
+    n_images = len(image_entries)
     print(f"📁 Output directory: {OUTPUT_DIR}")
-    print(f"🖼️  Images copied: {len(list(IMAGES_OUTPUT_DIR.glob('*')))}")
+    print(f"🖼️  Images: {n_images} ({copied} {'rendered' if derivatives else 'copied'}, {n_images - copied} unchanged)")
     print("\n✅ Build complete! Ready for Vercel deployment.")
     print("\nNext steps:")
     print("1. Copy public/index.html to public/ (will be created next)")
@@ -5,16 +5,122 @@ Usage: python3 viewer.py
 Then open http://localhost:5000 in your browser
 """
 
+import io
 import os
-import json
+import hashlib
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from flask import Flask, render_template, jsonify, send_from_directory
+from PIL import Image
+from flask import Flask, Response, render_template, jsonify, send_file, send_from_directory, request, abort
+from app.store import ResultStore, STORE_FILE, FACETS
+from app import iiif
 
 app = Flask(__name__)
 
 # Configure paths
 IMAGE_DIR = Path(__file__).parent / "_gdrive"
 METADATA_DIR = Path(__file__).parent / "out"
+DERIVATIVE_DIR = Path(__file__).parent / ".cache" / "iiif"
+IMAGE_EXTS = ['.jpg', '.jpeg', '.png', '.tif', '.tiff']
+
+# Long text fields are left out of list responses; /api/items/<id> returns them.
+LIST_EXCLUDE = ('transcript', 'text_reading')
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+SEARCH_CACHE_SIZE = 256
+
+# Derivative URLs change only when the source scan does (the ETag follows its mtime), so browsers
+# may reuse them for a day without asking. Originals are revalidated hourly.
+THUMBNAIL_SIZE = '!600,600'
+DERIVATIVE_MAX_AGE = 86400
+ORIGINAL_MAX_AGE = 3600
+
+class ItemIndex:
+    """In-memory listing of the result store, rebuilt only when the store or the image folder changes.
+
+    Change detection is a stat() of the SQLite file, its WAL and the image directory per request.
+    """
+
+    def __init__(self, metadata_dir: Path, image_dir: Path):
+        self.metadata_dir = metadata_dir
+        self.image_dir = image_dir
+        self.signature = None
+        self.snapshot = ([], {}, "")  # (items, id -> position, etag), replaced as a whole
+        self._lock = threading.Lock()
+
+    def _signature(self):
+        parts = []
+        for p in (self.metadata_dir / STORE_FILE, self.metadata_dir / f"{STORE_FILE}-wal", self.image_dir):
+            try:
+                st = p.stat()
+                parts.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                parts.append(None)
+        return tuple(parts)
+
+    def _images(self):
+        # One directory listing instead of a stat per extension per item.
+        found = {}
+        if self.image_dir.exists():
+            for entry in os.scandir(self.image_dir):
+                stem, ext = os.path.splitext(entry.name)
+                if ext.lower() in IMAGE_EXTS:
+                    prev = found.get(stem)
+                    if prev is None or IMAGE_EXTS.index(ext.lower()) < IMAGE_EXTS.index(os.path.splitext(prev)[1].lower()):
+                        found[stem] = entry.name
+        return found
+
+    def current(self):
+        """Rebuild if anything changed on disk, then return (items, positions, etag)."""
+        if self._signature() != self.signature:
+            self._rebuild()
+        return self.snapshot
+
+    def _rebuild(self):
+        with self._lock:
+            signature = self._signature()
+            if signature == self.signature:
+                return
+            items = []
+            if self.metadata_dir.exists():
+                images = self._images()
+                store = ResultStore.open(str(self.metadata_dir))
+                for base_name, data in store.iter_envelopes():
+                    metadata = data.get('metadata') or {}
+                    # Grouped objects are keyed by object id; show their first member's scan.
+                    image = images.get(base_name) or images.get(Path(data.get('context', {}).get('filename', '')).stem)
+                    items.append({
+                        'id': base_name,
+                        'image': f"/images/{image}" if image else None,
+                        'thumbnail': f"/iiif/{base_name}/full/{THUMBNAIL_SIZE}/0/default.webp" if image else None,
+                        'metadata': {k: v for k, v in metadata.items() if k not in LIST_EXCLUDE},
+                        'context': data.get('context', {}),
+                        'filename': base_name,
+                        'has_transcript': bool(metadata.get('transcript')),
+                        'has_text_reading': bool(metadata.get('text_reading')),
+                    })
+                signature = self._signature()  # opening the store may have created or imported it
+            positions = {item['id']: i for i, item in enumerate(items)}
+            self.snapshot = (items, positions, hashlib.sha1(repr(signature).encode()).hexdigest()[:16])
+            self.signature = signature
+
+index_cache = ItemIndex(METADATA_DIR, IMAGE_DIR)
+
+def _project(item, fields):
+    if fields is None:
+        return item
+    return dict(item, metadata={k: v for k, v in item['metadata'].items() if k in fields})
+
+def _conditional(etag, build):
+    """304 when the client's ETag matches, otherwise build() as JSON; clients always revalidate."""
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(build())
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
 @app.route('/')
 def index():
@@ -23,50 +129,126 @@ def index():
 
 @app.route('/api/items')
 def get_items():
-    """Get all items with metadata"""
-    items = []
-    
-    # Iterate through all JSON files in the output directory
-    if METADATA_DIR.exists():
-        for json_file in sorted(METADATA_DIR.glob("*.loc15.json")):
-            # Extract the base filename (e.g., BC-0692_Recto)
-            base_name = json_file.stem.replace(".loc15", "")
-            
-            # Check if corresponding image exists
-            image_path = None
-            for ext in ['.jpg', '.jpeg', '.png', '.tif', '.tiff']:
-                img_file = IMAGE_DIR / f"{base_name}{ext}"
-                if img_file.exists():
-                    image_path = f"/images/{base_name}{ext}"
-                    break
-            
-            # Read metadata
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                items.append({
-                    'id': base_name,
-                    'image': image_path,
-                    'metadata': data.get('metadata', {}),
-                    'context': data.get('context', {}),
-                    'filename': base_name
-                })
-            except Exception as e:
-                print(f"Error reading {json_file}: {e}")
-    
-    return jsonify(items)
+    """Get one page of items: ?offset=0&limit=100&fields=title,creator (metadata fields to include)"""
+    items, _, version = index_cache.current()
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(MAX_PAGE_SIZE, max(1, request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)))
+    fields = request.args.get('fields')
+    fields = set(f for f in fields.split(',') if f) if fields else None
+    etag = f"{version}-{hashlib.sha1(request.query_string).hexdigest()[:8]}"
+    return _conditional(etag, lambda: {
+        'total': len(items),
+        'offset': offset,
+        'limit': limit,
+        'items': [_project(item, fields) for item in items[offset:offset + limit]],
+    })
+
+@app.route('/api/items/<item_id>')
+def get_item(item_id):
+    """Get one item with all metadata, including transcript and text_reading"""
+    items, positions, version = index_cache.current()
+    pos = positions.get(item_id)
+    if pos is None:
+        abort(404)
+    def build():
+        data = ResultStore.for_output(str(METADATA_DIR)).get(item_id) or {}
+        return dict(items[pos], metadata=data.get('metadata', {}), context=data.get('context', {}))
+    return _conditional(f"{version}-{item_id}", build)
+
+search_cache = OrderedDict()
+search_lock = threading.Lock()
+
+@app.route('/api/search')
+def search():
+    """Ranked full-text search with facets: ?q=letter&subjects=Travel&decade=1930s&offset=0&limit=50
+
+    Facet filters (subjects, theme, genre, decade, creator) may repeat; an item must match all of them.
+    """
+    items, positions, version = index_cache.current()
+    etag = f"{version}-{hashlib.sha1(request.query_string).hexdigest()[:12]}"
+
+    def build():
+        with search_lock:
+            if etag in search_cache:
+                search_cache.move_to_end(etag)
+                return search_cache[etag]
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = min(MAX_PAGE_SIZE, max(1, request.args.get('limit', 50, type=int)))
+        filters = {f: request.args.getlist(f) for f in FACETS if request.args.getlist(f)}
+        result = ResultStore.for_output(str(METADATA_DIR)).search(request.args.get('q', ''), filters, offset, limit)
+        hits = []
+        for hit in result['items']:
+            if hit['key'] in positions:
+                hits.append(dict(items[positions[hit['key']]], score=hit['score'], snippet=hit['snippet']))
+        body = {'total': result['total'], 'total_capped': result['total_capped'], 'offset': offset, 'limit': limit, 'items': hits,
+                'facets': result['facets'], 'facets_sampled': result['facets_sampled']}
+        with search_lock:
+            search_cache[etag] = body
+            while len(search_cache) > SEARCH_CACHE_SIZE:
+                search_cache.popitem(last=False)
+        return body
+    return _conditional(etag, build)
+
+derivatives = iiif.DerivativeCache(str(DERIVATIVE_DIR))
+
+def _source_image(item_id):
+    items, positions, _ = index_cache.current()
+    pos = positions.get(item_id)
+    if pos is None or not items[pos]['image']:
+        abort(404)
+    return IMAGE_DIR / items[pos]['image'][len('/images/'):]
+
+def _decoding(build):
+    """build(), with bad requests as 400 and scans Pillow refuses to decode as 413."""
+    try:
+        return build()
+    except Image.DecompressionBombError as e:
+        abort(413, str(e))
+    except ValueError as e:
+        abort(400, str(e))
+
+@app.route('/iiif/<item_id>/info.json')
+def image_info(item_id):
+    """IIIF Image API info.json: dimensions, sizes and tiles for deep-zoom clients"""
+    source = _source_image(item_id)
+    etag = iiif.derivative_key(str(source), 'info')
+    resp = _conditional(etag, lambda: _decoding(lambda: iiif.info(str(source), f"{request.host_url.rstrip('/')}/iiif/{item_id}")))
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+@app.route('/iiif/<item_id>')
+def image_service(item_id):
+    return Response(status=303, headers={'Location': f"/iiif/{item_id}/info.json"})
+
+@app.route('/iiif/<item_id>/<region>/<size>/<rotation>/<quality>.<fmt>')
+def image_derivative(item_id, region, size, rotation, quality, fmt):
+    """Resized, cropped or re-encoded copy of a scan: /iiif/BC-0688/full/!600,600/0/default.webp"""
+    source = _source_image(item_id)
+    if fmt not in iiif.FORMATS:
+        abort(400, f"unsupported format: {fmt}")
+    key = iiif.derivative_key(str(source), region, size, rotation, quality, fmt)
+    if request.if_none_match.contains(key):
+        resp = Response(status=304)
+        resp.set_etag(key)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = DERIVATIVE_MAX_AGE
+        return resp
+    data = _decoding(lambda: derivatives.get(key, lambda: iiif.render(str(source), region, size, rotation, quality, fmt)))
+    resp = send_file(io.BytesIO(data), mimetype=iiif.FORMATS[fmt][1], etag=key, conditional=True,
+                     max_age=DERIVATIVE_MAX_AGE)
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
 
 @app.route('/images/<path:filename>')
 def serve_image(filename):
-    """Serve images from the _gdrive directory"""
-    return send_from_directory(IMAGE_DIR, filename)
+    """Serve original scans from the _gdrive directory (with Range support for large TIFFs)"""
+    return send_from_directory(IMAGE_DIR, filename, max_age=ORIGINAL_MAX_AGE)
 
 if __name__ == '__main__':
     # Create templates directory if it doesn't exist
     templates_dir = Path(__file__).parent / "templates"
     templates_dir.mkdir(exist_ok=True)
-    
+
     print("=" * 60)
     print("🖼️  LOC15 Metadata Viewer")
     print("=" * 60)
@@ -74,5 +256,5 @@ if __name__ == '__main__':
     print(f"Metadata: {METADATA_DIR}")
     print("\n📂 Starting server at http://localhost:5000")
     print("Press Ctrl+C to stop\n")
-    
+
     app.run(debug=True, port=5000)